@@ -14,6 +14,7 @@ The Cabf and CabfIterator are really closely tied together.  A bit disturbing, b
 
 @requires: U{Python<http://python.org/>} >= 2.5
 @requires: U{epydoc<http://epydoc.sourceforge.net/>} >= 3.0.1
+@requires: U{numpy<http://numpy.scipy.org/>} For joining the soundings to the waveforms
 @requires: U{matplotlib<http://matplotlib.org/>} If you want to plot graphs
 
 @undocumented: __doc__
@@ -24,8 +25,18 @@ The Cabf and CabfIterator are really closely tied together.  A bit disturbing, b
 
 import caf 
 import cbf
+import cabf_profile
+import os
+import re
 import sys
+import glob
 import time
+import itertools
+import Queue
+import datetime
+import threading
+
+import numpy as np
 
 class CabfIterator:
     '@todo: perhaps this should be inside the Cabf class?  Seems strange to be separate'
@@ -38,6 +49,7 @@ class CabfIterator:
         return self
 
     def next(self):
+        start = cabf_profile.enabled and cabf_profile.clock()
         scan = self.cabf.caf_iter.next()
         if isinstance(scan,caf.RunHeader):
             self.filecount += 1
@@ -53,15 +65,212 @@ class CabfIterator:
 
         self.scancount += 1
         scan_bin = self.cabf.cbf_iter.next()
+        if start:
+            cabf_profile.add('cabf.scan', start, 0, 1, 1)
         return (self.filecount,self.scancount,scan,scan_bin)
-        
-    
+
+
+class _Prefetch(threading.Thread):
+    '''Open a CBF and read it through once in the background so its
+    pages are in the OS cache before the decoder gets to it.  The reads
+    release the GIL, so the other stages keep going during the I/O.
+    '''
+    def __init__(self, filename, block_size=1<<20):
+        threading.Thread.__init__(self, name='prefetch ' + os.path.basename(filename))
+        self.daemon = True
+        self.filename = filename
+        self.block_size = block_size
+        self.cbf = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        start = cabf_profile.enabled and cabf_profile.clock()
+        try:
+            self.cbf = cbf.Cbf(self.filename)
+            infile = open(self.filename, 'rb')
+            num_bytes = 0
+            while True:
+                block = infile.read(self.block_size)
+                if not block:
+                    break
+                num_bytes += len(block)
+            infile.close()
+        except Exception:
+            self.error = sys.exc_info()
+            return
+        if start:
+            cabf_profile.add('cabf.prefetch', start, num_bytes, 0, 1)
+
+    def result(self):
+        'Wait for the prefetch and return the Cbf or raise what opening it raised'
+        self.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.cbf
+
+
+class _End:
+    'Marks the end of a pipeline queue.  error is the exc_info that ended it or None'
+    def __init__(self, error=None):
+        self.error = error
+
+
+class _Pipeline:
+    '''The queues and stage threads of a PipelinedCabfIterator.  Kept apart
+    from the iterator so the threads do not hold a reference to it, and
+    dropping the iterator can close them.
+    '''
+    def __init__(self, cabf_handle, queue_size):
+        self.cabf = cabf_handle
+        self.closed = False
+        self.caf_queue = Queue.Queue(queue_size)
+        self.out_queue = Queue.Queue(queue_size)
+        self.threads = [threading.Thread(target=self._caf_stage, name='caf stage'),
+                        threading.Thread(target=self._cbf_stage, name='cbf stage')]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, queue, item):
+        'Blocking put.  @return: False once the pipeline is closed'
+        queue.put(item)
+        return not self.closed
+
+    def _caf_stage(self):
+        try:
+            for item in self.cabf.caf_iter:
+                if isinstance(item, caf.RunHeader):
+                    item = (item, _Prefetch(cbf_filename(self.cabf.base, (item.run, item.section, item.seq, item.child))))
+                if not self._put(self.caf_queue, item):
+                    return
+        except Exception:
+            self._put(self.caf_queue, _End(sys.exc_info()))
+            return
+        self._put(self.caf_queue, _End())
+
+    def _cbf_stage(self):
+        filecount = 0
+        scancount = 0
+        cbf_iter = None
+        try:
+            while True:
+                item = self.caf_queue.get()
+                if isinstance(item, _End):
+                    self._put(self.out_queue, item)
+                    return
+                if self.closed:
+                    return
+                if isinstance(item, tuple):
+                    filecount += 1
+                    self.cabf.cbf = item[1].result()
+                    self.cabf.cbf_iter = cbf_iter = self.cabf.cbf.__iter__()
+                    continue
+                scancount += 1
+                scan_bin = cbf_iter.next()
+                if not self._put(self.out_queue, (filecount, scancount, item, scan_bin)):
+                    return
+        except StopIteration:
+            # A CBF with fewer scans than the CAF ends the stream, as in CabfIterator
+            self._put(self.out_queue, _End())
+        except Exception:
+            self._put(self.out_queue, _End(sys.exc_info()))
+
+    def close(self):
+        '''Stop the stage threads.  A stage blocked on a full queue is let go
+        by emptying it, and the CBF stage waiting for the CAF stage is sent
+        an _End, since the one the CAF stage sent may have been emptied
+        out.'''
+        self.closed = True
+        for thread in self.threads:
+            while thread.is_alive():
+                for queue in (self.caf_queue, self.out_queue):
+                    try:
+                        while True:
+                            queue.get_nowait()
+                    except Queue.Empty:
+                        pass
+                try:
+                    self.caf_queue.put_nowait(_End())
+                except Queue.Full:
+                    pass
+                thread.join(0.01)
+        # Let go of the scans and prefetched CBFs still queued
+        for queue in (self.caf_queue, self.out_queue):
+            try:
+                while True:
+                    queue.get_nowait()
+            except Queue.Empty:
+                pass
+
+
+class PipelinedCabfIterator:
+    '''Same tuples in the same order as CabfIterator, but made by two
+    threads joined by bounded queues:
+
+     - the CAF stage parses the CAF.  When it reaches a run header it
+       starts a _Prefetch of that run's CBF, so the file is being opened
+       and read while the scans of the run before it are decoded
+     - the CBF stage matches each CAF scan to the next CBF scan
+
+    The caller takes finished tuples from the second queue.  Errors in
+    either stage are raised from next at the same point in the stream
+    where CabfIterator would raise them.  The threads are stopped at the
+    end of the stream, by close, at the end of a with block, or when the
+    iterator is garbage collected, such as after a break out of a for
+    loop over it.
+    '''
+    def __init__(self, cabf_handle, queue_size=256):
+        self.cabf = cabf_handle
+        self._done = False
+        self._pipeline = _Pipeline(cabf_handle, queue_size)
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        start = cabf_profile.enabled and cabf_profile.clock()
+        item = self._pipeline.out_queue.get()
+        if start:
+            cabf_profile.add('cabf.wait', start, 0, 1, 0)
+        if isinstance(item, _End):
+            self.close()
+            if item.error is not None:
+                raise item.error[0], item.error[1], item.error[2]
+            raise StopIteration
+        return item
+
+    def close(self):
+        'Stop the stage threads.  Safe to call more than once'
+        self._done = True
+        self._pipeline.close()
+
+
 class Cabf:
     '''
     Handle reading lidar ascii and binary waveform files together
     '''
-    def __init__(self,caf_filename):
+    def __init__(self,caf_filename, pipeline=False, queue_size=256):
+        '''
+        @param pipeline: iterate with a PipelinedCabfIterator that parses
+            the CAF, reads ahead the next CBF and decodes the CBF scans
+            in threads
+        @param queue_size: scans held between the pipeline stages
+        '''
         self.caf_filename = caf_filename
+        self.pipeline = pipeline
+        self.queue_size = queue_size
         self.base = caf_filename[:-4]
         self.caf = caf.Caf(caf_filename)
         self.caf_iter = self.caf.__iter__()
@@ -70,10 +279,334 @@ class Cabf:
         self.cbf_iter = None
 
         self.scan_num = 0
+        self._catalog = None
+        self._cbf_files = {}
 
     def __iter__(self):
+        if self.pipeline:
+            return PipelinedCabfIterator(self, self.queue_size)
         return CabfIterator(self)
 
+    def join(self, names=caf.default_sounding_columns, with_samples=False):
+        '''Match every sounding in the CAF to its waveform.  See join_shots
+
+        @param names: CAF columns to read.  frame, row and col are always read.
+        '''
+        if names is not None:
+            names = tuple(names) + ('frame', 'row', 'col')
+        return join_shots(self.caf.read_columns(names), self.base, with_samples)
+
+    def iter_batches(self, max_shots=1<<16, names=caf.default_sounding_columns, with_samples=True):
+        '''Soundings joined to their waveforms in batches of max_shots.
+        See Caf.iter_batches for the batches and ShotJoiner.join for the
+        columns added from the CBFs, such as 'cbf_file', 'cbf_offset' and
+        'samples'.  The joiner is kept from batch to batch, so repeated
+        keys are matched the same as one big join.
+
+        @param names: CAF columns to read.  frame, row and col are always read.
+        @return: generator of batch dicts
+        '''
+        if names is not None:
+            names = tuple(names) + ('frame', 'row', 'col')
+        joiner = ShotJoiner(self.base)
+        for batch in self.caf.iter_batches(max_shots, names):
+            joined, report = joiner.join(batch, with_samples)
+            yield joined
+
+    def time_catalog(self):
+        '''TimeCatalog of the CBFs next to the CAF.  Built once per Cabf'''
+        if self._catalog is None:
+            self._catalog = TimeCatalog.build(survey_cbf_filenames(self.base))
+        return self._catalog
+
+    def between(self, start, end, with_caf=False):
+        '''Decode only the CBF scans recorded from start up to but not including end.
+
+        @param start: datetime or seconds since 1970
+        @param with_caf: also parse the CAF scan that goes with each CBF
+            scan, found with the CAF's CafTimeIndex.  As in CabfIterator,
+            the nth scan of a run in the CAF goes with the nth scan of
+            its CBF.
+        @return: generator of (cbf filename, scan number, cbf.ScanHeader)
+            ordered by the time of the first scan in each file, plus the
+            caf.ScanHeader or None if the CAF has no scan for it when
+            with_caf is set
+        '''
+        for filename in self.time_catalog().files_between(start, end):
+            if filename not in self._cbf_files:
+                self._cbf_files[filename] = cbf.Cbf(filename)
+            cbf_file = self._cbf_files[filename]
+            if with_caf:
+                run = tuple([int(v) for v in cbf_name_re.search(filename).groups()])
+                caf_offsets = self.caf.time_index().run_offsets(run)
+            for scan_num in cbf_file.index().scans_between(start, end):
+                if not with_caf:
+                    yield filename, int(scan_num), cbf_file[scan_num]
+                    continue
+                caf_scan = None
+                if scan_num < len(caf_offsets):
+                    caf_scan = self.caf.scan_at(caf_offsets[scan_num])
+                yield filename, int(scan_num), cbf_file[scan_num], caf_scan
+
+
+def cbf_filename(base, run):
+    '''Name of the CBF that goes with a run header.
+
+    @param run: (run, section, seq, child)
+    '''
+    return '%s_%d_%d_%d_%d.CBF' % ((base,) + tuple(run))
+
+
+cbf_name_re = re.compile(r'_(\d+)_(\d+)_(\d+)_(\d+)\.CBF$', re.IGNORECASE)
+
+
+def survey_cbf_filenames(base):
+    '''The base_run_section_seq_child.CBF files of a survey sorted by run'''
+    filenames = []
+    for filename in glob.glob(base + '_*'):
+        match = cbf_name_re.match(filename[len(base):])
+        if match is not None:
+            filenames.append((tuple([int(v) for v in match.groups()]), filename))
+    return [filename for run, filename in sorted(filenames)]
+
+
+class TimeCatalog:
+    '''First and last scan time of each CBF in a survey, sorted by the
+    first time, so a time window can be sent straight to the files that
+    hold it.  The times come from each file's CbfIndex sidecar.
+    '''
+    def __init__(self, filenames, first, last, num_scans):
+        order = np.argsort(first, kind='mergesort')
+        self.filenames = [filenames[i] for i in order]
+        self.first = np.asarray(first, dtype=np.int64)[order]
+        self.last = np.asarray(last, dtype=np.int64)[order]
+        self.num_scans = np.asarray(num_scans, dtype=np.int64)[order]
+        # Latest end of any file up to each one so the start can be bisected too
+        self.last_so_far = np.maximum.accumulate(self.last) if len(self.last) else self.last
+
+    @classmethod
+    def build(cls, cbf_filenames):
+        'Files without any scans are left out'
+        start = cabf_profile.enabled and cabf_profile.clock()
+        filenames, first, last, num_scans = [], [], [], []
+        for filename in cbf_filenames:
+            epochs = cbf.Cbf(filename).index().sorted_epochs
+            if len(epochs):
+                filenames.append(filename)
+                first.append(epochs[0])
+                last.append(epochs[-1])
+                num_scans.append(len(epochs))
+        if start:
+            cabf_profile.add('cabf.time_catalog', start, 0, len(filenames), 1)
+        return cls(filenames, first, last, num_scans)
+
+    def files_between(self, start, end):
+        '''CBFs with any scan from start up to but not including end'''
+        start, end = cbf.as_epoch(start), cbf.as_epoch(end)
+        lo = np.searchsorted(self.last_so_far, start, side='left')
+        hi = np.searchsorted(self.first, end, side='left')
+        return [self.filenames[i] for i in range(lo, hi) if self.last[i] >= start]
+
+    def __str__(self):
+        if not len(self.first):
+            return 'TimeCatalog: no scans'
+        return 'TimeCatalog: %d files with %d scans from %s to %s' % (
+            len(self.filenames), self.num_scans.sum(),
+            datetime.datetime.utcfromtimestamp(self.first[0]),
+            datetime.datetime.utcfromtimestamp(self.last_so_far[-1]))
+
+
+def _rank_in_group(sorted_keys):
+    'For each entry of a sorted array, how many equal keys come before it'
+    n = len(sorted_keys)
+    starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    sizes = np.diff(np.append(starts, n))
+    return np.arange(n) - np.repeat(starts, sizes)
+
+
+class ShotJoiner:
+    '''Sort-merge join of CAF soundings to CBF waveforms on run, section,
+    seq, child, frame, row and col.  Nothing depends on the scans lining
+    up.  When a key is repeated, the nth sounding gets the nth waveform.
+
+    Each CBF is opened once and its CbfIndex supplies the waveform keys
+    already sorted, so the soundings can be joined in as many chunks as
+    needed (e.g. those of Caf.column_chunks) and the nth repeat is still
+    counted across chunks.  So are shots out of order, by comparing the
+    first of each chunk with the last of the chunk before in its run.
+    '''
+    def __init__(self, base):
+        '@param base: CAF filename without the .CAF'
+        self.base = base
+        self.cbf_files = {} # (run, section, seq, child) -> Cbf or None if missing
+        self.seen = {} # run -> repeats already used at each sorted key position
+        self.matched = {} # run -> waveforms matched so far
+        self.duplicate_waveforms = {} # run -> waveforms with the same key as one before
+        self.last_shot = {} # run -> CBF shot of the last sounding matched in an earlier block
+
+    def cbf(self, run):
+        '''The Cbf for a run or None if the file does not exist'''
+        if run not in self.cbf_files:
+            filename = cbf_filename(self.base, run)
+            cbf_file = None
+            if os.path.exists(filename):
+                cbf_file = cbf.Cbf(filename)
+                keys = cbf_file.index().keys
+                self.seen[run] = np.zeros(len(keys), dtype=np.int32)
+                self.matched[run] = 0
+                self.duplicate_waveforms[run] = int(np.count_nonzero(_rank_in_group(keys)))
+            self.cbf_files[run] = cbf_file
+        return self.cbf_files[run]
+
+    def join(self, columns, with_samples=False, chunk=1<<16):
+        '''Join one block of soundings.
+
+        @param columns: from Caf.read_columns or Caf.column_chunks with at
+            least frame, row, col and run.  columns['runs'] must hold every
+            RunHeader up to the last one the soundings refer to.
+        @param with_samples: also copy the (N,120) waveform samples
+        @return: (joined, report).  joined is columns plus 'cbf_file' (index
+            into joined['cbf_filenames'] or -1 before the first run header),
+            'cbf_shot' (shot number in that CBF or -1), 'cbf_offset' (byte
+            offset of its WF record or -1), 'selected_depth_index' and
+            'contend_depth_index' (-1 if not matched) and maybe 'samples'.
+            report is a dict of counts.  Counts of waveforms only cover the
+            CBFs seen so far.
+        '''
+        start_time = cabf_profile.enabled and cabf_profile.clock()
+        runs = [(rh.run, rh.section, rh.seq, rh.child) for rh in columns['runs']]
+        num_soundings = len(columns['frame'])
+        used_runs = np.unique(columns['run'])
+        file_runs = sorted(set([runs[i] for i in used_runs if i >= 0]))
+        file_of_run = np.array([file_runs.index(run) if run in file_runs else -1 for run in runs] + [-1],
+                               dtype=np.int64)
+        file_nums = file_of_run[columns['run']]
+        keys = cbf.shot_key(columns['frame'], columns['row'], columns['col'])
+
+        cbf_shot = np.empty(num_soundings, dtype=np.int64)
+        cbf_shot.fill(-1)
+        cbf_offset = cbf_shot.copy()
+        selected = np.empty(num_soundings, dtype=np.int16)
+        selected.fill(-1)
+        contender = selected.copy()
+        if with_samples:
+            samples = np.zeros((num_soundings, 120), dtype=np.uint8)
+        sample_cols = np.arange(8, cbf.wave_form_block_size)
+        missing = []
+        duplicates = 0
+        out_of_order = 0
+        for file_num, run in enumerate(file_runs):
+            rows = np.flatnonzero(file_nums == file_num)
+            cbf_file = self.cbf(run)
+            if cbf_file is None:
+                missing.append(cbf_filename(self.base, run))
+                continue
+            index = cbf_file.index()
+            order = np.argsort(keys[rows], kind='mergesort')
+            rows = rows[order]
+            file_keys = keys[rows]
+            first = np.searchsorted(index.keys, file_keys)
+            exists = first < len(index.keys)
+            exists[exists] = index.keys[first[exists]] == file_keys[exists]
+            seen = self.seen[run]
+            rank = _rank_in_group(file_keys)
+            rank[exists] += seen[first[exists]]
+            duplicates += np.count_nonzero(rank)
+            np.add.at(seen, first[exists], 1)
+            pos = first + rank
+            ok = exists & (pos < len(index.keys))
+            ok[ok] = index.keys[pos[ok]] == file_keys[ok]
+
+            rows = rows[ok]
+            shots = index.key_order[pos[ok]]
+            cbf_shot[rows] = shots
+            self.matched[run] += len(rows)
+            offsets = index.shot_offsets[shots]
+            cbf_offset[rows] = offsets
+            raw = np.frombuffer(cbf_file.data, dtype=np.uint8, count=cbf_file.size)
+            selected[rows] = raw[offsets + 6]
+            contender[rows] = raw[offsets + 7]
+            if with_samples:
+                for start in xrange(0, len(rows), chunk):
+                    samples[rows[start:start+chunk]] = raw[offsets[start:start+chunk, None] + sample_cols]
+
+            # Shots should come in the same order in both files, also from
+            # the end of the block before
+            shots = cbf_shot[np.sort(rows)]
+            out_of_order += np.count_nonzero(shots[1:] < shots[:-1])
+            if len(shots):
+                if run in self.last_shot and shots[0] < self.last_shot[run]:
+                    out_of_order += 1
+                self.last_shot[run] = shots[-1]
+
+        num_matched = int(np.count_nonzero(cbf_shot >= 0))
+        num_waveforms = sum([len(self.seen[run]) for run in self.seen])
+        report = {'soundings': num_soundings,
+                  'waveforms': num_waveforms,
+                  'matched': num_matched,
+                  'unmatched_soundings': num_soundings - num_matched,
+                  'unmatched_waveforms': num_waveforms - sum(self.matched.values()),
+                  'duplicate_soundings': int(duplicates),
+                  'duplicate_waveforms': sum(self.duplicate_waveforms.values()),
+                  'out_of_order': int(out_of_order),
+                  'missing_cbf_files': missing,
+                  }
+
+        joined = dict(columns)
+        joined['cbf_filenames'] = [cbf_filename(self.base, run) for run in file_runs]
+        joined['cbf_file'] = file_nums
+        joined['cbf_shot'] = cbf_shot
+        joined['cbf_offset'] = cbf_offset
+        joined['selected_depth_index'] = selected
+        joined['contend_depth_index'] = contender
+        if with_samples:
+            joined['samples'] = samples
+        if start_time:
+            cabf_profile.add('cabf.join', start_time, 0, num_soundings, 0)
+        return joined, report
+
+
+def join_shots(columns, base, with_samples=False):
+    '''Join all the soundings of a CAF to their waveforms in one go.
+    See ShotJoiner.join
+    '''
+    return ShotJoiner(base).join(columns, with_samples)
+
+
+def check_close(caf_filename, trials=200, queue_size=4, max_items=6, timeout=10.):
+    '''Regression check that a PipelinedCabfIterator given up part way
+    through always stops its threads.  Each trial takes 0 to max_items
+    tuples and then either calls close or, every other time, just drops
+    the iterator.  A small queue_size keeps both queues full.
+
+    @return: list of (trial, items taken) that did not stop within timeout
+    '''
+    import random
+    import gc
+    rng = random.Random(0)
+    failed = []
+    for trial in range(trials):
+        num_items = rng.randint(0, max_items)
+        pipeline_iter = Cabf(caf_filename, pipeline=True, queue_size=queue_size).__iter__()
+        threads = pipeline_iter._pipeline.threads
+        for item in itertools.islice(pipeline_iter, num_items):
+            pass
+        if trial % 2:
+            del pipeline_iter
+            gc.collect()
+        else:
+            closer = threading.Thread(target=pipeline_iter.close)
+            closer.daemon = True
+            closer.start()
+            closer.join(timeout)
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        if [thread for thread in threads if thread.is_alive()]:
+            failed.append((trial, num_items))
+    return failed
+
+
 def main():
 
     from optparse import OptionParser
@@ -86,17 +619,64 @@ def main():
                       help='print out the summary for each scan')
     parser.add_option('-S', '--shot', dest='shot', default=False, action='store_true',
                       help='print out the summary for each shot (there will be many!)')
+    parser.add_option('--join', dest='join', default=False, action='store_true',
+                      help='match the soundings to the waveforms by key and report what did not match')
+    parser.add_option('--between', dest='between', default=None,
+                      help='only decode the CBF scans in START,END given as YYYY-MM-DDTHH:MM:SS (UTC)')
+    parser.add_option('-p', '--pipeline', dest='pipeline', default=False, action='store_true',
+                      help='parse the CAF, read ahead the CBFs and decode the scans in threads')
+    parser.add_option('--check-close', dest='check_close', default=None, type='int',
+                      help='check that closing the pipeline part way through never hangs, over this many trials')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
     parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
                       help='run the tests run in verbose mode')
 
     (opts, args) = parser.parse_args()
     v = opts.verbose
     opts.info = True
+    if opts.stats:
+        cabf_profile.report_at_exit()
 
     for filename in args:
         print 'File:',filename
-        if opts.info:
+        if opts.check_close is not None:
+            failed = check_close(filename, opts.check_close)
+            print 'Close check for %s: trials(%d) hung(%d)' % (filename, opts.check_close, len(failed))
+            for trial, num_items in failed:
+                print '  trial %d hung after %d items' % (trial, num_items)
+            continue
+        if opts.between is not None:
+            start, end = [datetime.datetime.strptime(when, '%Y-%m-%dT%H:%M:%S') for when in opts.between.split(',')]
             cabf = Cabf(filename)
+            if v:
+                print cabf.time_catalog()
+            numscans = 0
+            for item in cabf.between(start, end, with_caf=opts.scan):
+                cbf_name, scan_num, scan_bin = item[:3]
+                numscans += 1
+                if opts.scan:
+                    print 'scan: %s scannum(%d): %s' % (os.path.basename(cbf_name), scan_num, scan_bin)
+                    print '  caf: %s' % item[3]
+                if opts.shot:
+                    for i, waveform in enumerate(scan_bin.waveforms):
+                        print '    shot %d: %s' % (i, waveform)
+            print 'Summary for %s: scans(%d) from %s to %s' % (filename, numscans, start, end)
+            continue
+        if opts.join:
+            joined, report = Cabf(filename).join(names=())
+            print 'Join for %s: soundings(%d) waveforms(%d) matched(%d)' % (
+                filename, report['soundings'], report['waveforms'], report['matched'])
+            print '  unmatched: soundings(%d) waveforms(%d)' % (report['unmatched_soundings'],
+                                                               report['unmatched_waveforms'])
+            print '  duplicates: soundings(%d) waveforms(%d)' % (report['duplicate_soundings'],
+                                                                report['duplicate_waveforms'])
+            print '  out of order(%d)' % report['out_of_order']
+            for missing in report['missing_cbf_files']:
+                print '  missing:', missing
+            continue
+        if opts.info:
+            cabf = Cabf(filename, pipeline=opts.pipeline)
             files = 0
             scans = 0
             for filecount, scancount, scan, scan_bin in cabf:
@@ -108,14 +688,12 @@ def main():
                     print '     bin:',scan_bin
                 if opts.shot:
                     for i,sounding in enumerate(scan.soundings):
-                        waveform = scan_bin.waveform[i]
+                        waveform = scan_bin.waveforms[i]
                         print 'shot: %d' % i
                         print '   ascii:',sounding
                         print '     bin:',waveform
             print 'Summary for %s: binfiles(%d) scans(%s)' % (filename,filecount,scancount)
 
-    print 'FIX: seems like this quits too soon!'
-
 if __name__ == '__main__':
     main()
 
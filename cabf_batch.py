@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Summarize a whole survey of LADS lidar CAF and CBF files at once.
+
+Each file is handed to a bounded pool of worker processes.  The
+summaries come back in the order the files were given no matter
+which worker finishes first.  A file that fails to parse is reported
+with its error and the rest of the batch carries on.
+
+@requires: U{Python<http://python.org/>} >= 2.6 for multiprocessing
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import sys
+import glob
+import datetime
+import traceback
+import multiprocessing
+
+import caf
+import cbf
+import cabf_profile
+
+
+def _time_span(epochs):
+    'first and last of seconds since 1970 as ints or None when empty'
+    if len(epochs) == 0:
+        return None, None
+    return int(epochs.min()), int(epochs.max())
+
+
+def summarize_cbf(filename):
+    '''Count the scans and shots in a CBF from its scan table.  No
+    waveforms are decoded.
+
+    @return: summary dict
+    '''
+    cbf_file = cbf.Cbf(filename)
+    scans = cbf_file.as_array()
+    first, last = _time_span(cbf.scan_epochs(scans))
+    end = cbf.header_size
+    if len(scans):
+        end = int(scans['offset'][-1]) + cbf.scan_header_block_size + int(scans['num_shots'][-1]) * cbf.wave_form_block_size
+    return {'filename': filename,
+            'kind': 'CBF',
+            'run_headers': 1,
+            'runs': [(cbf_file.run_id, cbf_file.run_segment, cbf_file.run_sequence, cbf_file.run_child)],
+            'scans': len(scans),
+            'shots': int(scans['num_shots'].sum()),
+            'first': first,
+            'last': last,
+            'unparsed_bytes': cbf_file.size - end,
+            }
+
+
+def summarize_caf(filename):
+    '''Count the run headers, scans and soundings in a CAF.  Only the W1
+    columns are converted.
+
+    @return: summary dict
+    '''
+    caf_file = caf.Caf(filename)
+    runs = []
+    num_scans = 0
+    num_shots = 0
+    first, last = None, None
+    for soundings, scans, chunk_runs in caf_file.column_chunks(names=()):
+        runs += [(rh.run, rh.section, rh.seq, rh.child) for rh in chunk_runs]
+        num_scans += len(scans['run'])
+        num_shots += len(soundings['scan'])
+        chunk_first, chunk_last = _time_span(cbf.scan_epochs(scans))
+        if chunk_first is not None:
+            first = chunk_first if first is None else min(first, chunk_first)
+            last = chunk_last if last is None else max(last, chunk_last)
+    return {'filename': filename,
+            'kind': 'CAF',
+            'run_headers': len(runs),
+            'runs': runs,
+            'scans': num_scans,
+            'shots': num_shots,
+            'first': first,
+            'last': last,
+            'unparsed_bytes': 0,
+            }
+
+
+def summarize(filename):
+    'Pick summarize_caf or summarize_cbf from the file extension'
+    ext = os.path.splitext(filename)[1].upper()
+    if ext == '.CAF':
+        return summarize_caf(filename)
+    if ext == '.CBF':
+        return summarize_cbf(filename)
+    raise ValueError('not a .CAF or .CBF file: %s' % filename)
+
+
+def summarize_safely(filename):
+    '''Run summarize in a worker.  Any exception is caught so one bad
+    file can not take down the pool.
+
+    @return: (filename, summary or None, error message or None)
+    '''
+    try:
+        return filename, summarize(filename), None
+    except Exception, e:
+        lines = traceback.format_exception_only(type(e), e)
+        return filename, None, ''.join(lines).strip()
+
+
+def _summarize_in_worker(filename):
+    '''summarize_safely in a pool worker.  The cabf_profile counts of
+    the file come back with it so they can be added up in the parent.
+    '''
+    cabf_profile.reset()
+    return summarize_safely(filename), cabf_profile.snapshot()
+
+
+def run_batch(filenames, jobs=None, callback=None):
+    '''Summarize each file using up to jobs processes.
+
+    @param jobs: number of worker processes.  None for one per cpu and 1
+        to do everything in this process.
+    @param callback: called with each (filename, summary, error) as they
+        arrive, which is in the same order as filenames
+    @return: list of (filename, summary, error) in the order of filenames.
+        The cabf_profile counts of the workers are added to this process
+    '''
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = max(1, min(jobs, len(filenames)))
+    results = []
+    if jobs == 1:
+        outcomes = (summarize_safely(filename) for filename in filenames)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        outcomes = pool.imap(_summarize_in_worker, filenames, chunksize=1)
+    try:
+        for outcome in outcomes:
+            if pool is not None:
+                outcome, counts = outcome
+                cabf_profile.merge(counts)
+            if callback is not None:
+                callback(outcome)
+            results.append(outcome)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return results
+
+
+def merge_summaries(results):
+    '''Combine the per file summaries of run_batch into survey totals.
+    Failed files are only counted.
+
+    @return: dict of totals with first and last as datetimes (or None)
+    '''
+    total = {'files': len(results), 'failed': 0, 'caf_files': 0, 'cbf_files': 0,
+             'run_headers': 0, 'caf_scans': 0, 'caf_shots': 0, 'cbf_scans': 0, 'cbf_shots': 0,
+             'first': None, 'last': None}
+    for filename, summary, error in results:
+        if summary is None:
+            total['failed'] += 1
+            continue
+        kind = summary['kind'].lower()
+        total[kind + '_files'] += 1
+        total[kind + '_scans'] += summary['scans']
+        total[kind + '_shots'] += summary['shots']
+        if kind == 'caf':
+            total['run_headers'] += summary['run_headers']
+        if summary['first'] is not None:
+            if total['first'] is None or summary['first'] < total['first']:
+                total['first'] = summary['first']
+            if total['last'] is None or summary['last'] > total['last']:
+                total['last'] = summary['last']
+    for key in ('first', 'last'):
+        if total[key] is not None:
+            total[key] = datetime.datetime.utcfromtimestamp(total[key])
+    return total
+
+
+def expand_filenames(args):
+    'Directories are replaced by the sorted CAF and CBF files in them'
+    filenames = []
+    for arg in args:
+        if os.path.isdir(arg):
+            found = [name for name in glob.glob(os.path.join(arg, '*'))
+                     if os.path.splitext(name)[1].upper() in ('.CAF', '.CBF')]
+            filenames += sorted(found)
+        else:
+            filenames.append(arg)
+    return filenames
+
+
+def format_summary(summary):
+    span = ''
+    if summary['first'] is not None:
+        span = ' %s to %s' % (datetime.datetime.utcfromtimestamp(summary['first']),
+                              datetime.datetime.utcfromtimestamp(summary['last']))
+    text = 'Summary for %s: runheaders(%d) scans(%d) shots(%d)%s' % (
+        summary['filename'], summary['run_headers'], summary['scans'], summary['shots'], span)
+    if summary['unparsed_bytes']:
+        text += ' WARNING: %d bytes after the last scan' % summary['unparsed_bytes']
+    return text
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CAF file2.CBF dir ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-j', '--jobs', dest='jobs', default=None, type='int',
+                      help='number of worker processes [default: one per cpu]')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if opts.jobs is not None and opts.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    filenames = expand_filenames(args)
+
+    def report(outcome):
+        filename, summary, error = outcome
+        if error is not None:
+            sys.stderr.write('ERROR in %s: %s\n' % (filename, error))
+        else:
+            print format_summary(summary)
+            if opts.verbose:
+                for run in summary['runs']:
+                    print '    run %d.%d.%d.%d' % run
+
+    results = run_batch(filenames, opts.jobs, callback=report)
+    total = merge_summaries(results)
+    print 'Total: files(%(files)d) failed(%(failed)d) runheaders(%(run_headers)d)' % total,
+    print 'caf: files(%(caf_files)d) scans(%(caf_scans)d) shots(%(caf_shots)d)' % total,
+    print 'cbf: files(%(cbf_files)d) scans(%(cbf_scans)d) shots(%(cbf_shots)d)' % total
+    if total['first'] is not None:
+        print 'Time span: %s to %s' % (total['first'], total['last'])
+    if total['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
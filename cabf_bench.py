@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Time the hot paths of the CAF and CBF readers on a synthetic survey
+written by cabf_synth.
+
+Each case runs in its own child process, so the peak resident memory
+reported is for that case alone and no case can reuse the objects or
+the CBF indexes of another.  For every case the best of the repeats is
+kept and reported as seconds, shots/sec, MB/sec of input file read and
+peak RSS.  The results can be saved as JSON and later runs compared
+against them, so a slow down in a hot path shows up before a deploy.
+
+@requires: U{Python<http://python.org/>} >= 2.6 for multiprocessing
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import sys
+import glob
+import time
+import json
+import Queue
+import shutil
+import resource
+import tempfile
+import multiprocessing
+
+import caf
+import cbf
+import cabf
+import cabf_synth
+import cabf_export
+import cbf_peaks
+
+
+def _caf_iter(base):
+    shots = 0
+    for item in caf.Caf(base + '.CAF'):
+        if isinstance(item, caf.ScanHeader):
+            shots += len(item.soundings)
+    return shots, [base + '.CAF']
+
+
+def _caf_columns(base):
+    columns = caf.Caf(base + '.CAF').read_columns()
+    return len(columns['frame']), [base + '.CAF']
+
+
+def _cbf_files(base):
+    return cabf.survey_cbf_filenames(base)
+
+
+def _cbf_iter(base):
+    shots = 0
+    for filename in _cbf_files(base):
+        for scan in cbf.Cbf(filename):
+            for waveform in scan.waveforms:
+                shots += 1
+    return shots, _cbf_files(base)
+
+
+def _cbf_index(base):
+    shots = 0
+    for filename in _cbf_files(base):
+        shots += len(cbf.CbfIndex.build(cbf.Cbf(filename)).shot_offsets)
+    return shots, _cbf_files(base)
+
+
+def _cbf_waveforms(base):
+    shots = 0
+    for filename in _cbf_files(base):
+        shots += len(cbf.Cbf(filename).waveforms())
+    return shots, _cbf_files(base)
+
+
+def _cabf_iter(base):
+    shots = 0
+    for filecount, scancount, scan, scan_bin in cabf.Cabf(base + '.CAF'):
+        shots += len(scan_bin.waveforms)
+    return shots, [base + '.CAF'] + _cbf_files(base)
+
+
+def _cabf_pipeline(base):
+    shots = 0
+    for filecount, scancount, scan, scan_bin in cabf.Cabf(base + '.CAF', pipeline=True):
+        shots += len(scan_bin.waveforms)
+    return shots, [base + '.CAF'] + _cbf_files(base)
+
+
+def _cabf_join(base):
+    columns, report = cabf.Cabf(base + '.CAF').join(with_samples=True)
+    return report['soundings'], [base + '.CAF'] + _cbf_files(base)
+
+
+def _export(base):
+    path, report = cabf_export.export(base + '.CAF', base + '.bench.npy', 'npy')
+    shutil.rmtree(path)
+    return report['soundings'], [base + '.CAF'] + _cbf_files(base)
+
+
+def _peaks(base):
+    shots = 0
+    for filename in _cbf_files(base):
+        shots += len(cbf_peaks.cbf_peaks(filename))
+    return shots, _cbf_files(base)
+
+
+cases = (
+    ('caf_iter', _caf_iter, 'Caf object iterator'),
+    ('caf_columns', _caf_columns, 'Caf.read_columns'),
+    ('cbf_iter', _cbf_iter, 'Cbf object iterator with every WaveForm'),
+    ('cbf_index', _cbf_index, 'CbfIndex.build'),
+    ('cbf_waveforms', _cbf_waveforms, 'Cbf.waveforms of the whole file'),
+    ('cabf_iter', _cabf_iter, 'Cabf object iterator'),
+    ('cabf_pipeline', _cabf_pipeline, 'Cabf iterator with the threaded pipeline'),
+    ('cabf_join', _cabf_join, 'Cabf.join with samples'),
+    ('export', _export, 'cabf_export to npy'),
+    ('peaks', _peaks, 'cbf_peaks'),
+    )
+'(name, function, description).  Each function takes the survey base and returns the shots done and the files read'
+
+case_names = [name for name, func, description in cases]
+
+
+def copy_survey(base, dest_dir):
+    '''Copy base.CAF and its CBF files, but not their indexes, into dest_dir
+
+    @return: base of the copy
+    '''
+    for filename in [base + '.CAF'] + _cbf_files(base):
+        shutil.copy(filename, dest_dir)
+    return os.path.join(dest_dir, os.path.basename(base))
+
+
+def _remove_indexes(base):
+    'Only ever called on the copy of the survey in the scratch directory of run_benchmarks'
+    for filename in glob.glob(base + '_*.CBF' + cbf.index_suffix):
+        os.remove(filename)
+
+
+def _run_case(func, base, queue):
+    'Child process body.  Puts (seconds, shots, bytes, peak rss in KB) or the error on the queue'
+    try:
+        start = time.time()
+        shots, filenames = func(base)
+        elapsed = time.time() - start
+        num_bytes = sum([os.path.getsize(filename) for filename in filenames])
+        queue.put((elapsed, shots, num_bytes, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    except Exception, e:
+        queue.put('%s: %s' % (e.__class__.__name__, e))
+
+
+def time_case(func, base, poll=1.):
+    '''Run one case in a fresh process with no CBF indexes on disk
+
+    @param base: a scratch copy of the survey.  Its CBF indexes are removed
+    @param poll: seconds between checks that the child is still alive
+    @return: seconds, shots, bytes read and peak rss in KB
+    @raise RuntimeError: if the case fails or the child dies without a result
+    '''
+    _remove_indexes(base)
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_case, args=(func, base, queue))
+    child.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=poll)
+        except Queue.Empty:
+            if not child.is_alive():
+                try:
+                    result = queue.get(timeout=poll)
+                except Queue.Empty:
+                    child.join()
+                    raise RuntimeError('%s died with exit code %s' % (func.__name__, child.exitcode))
+    child.join()
+    if isinstance(result, str):
+        raise RuntimeError(result)
+    return result
+
+
+def run_benchmarks(base, names=None, repeat=3, callback=None, scratch=False):
+    '''Time each case repeat times and keep the fastest.
+
+    The cases run on a copy of the survey in a temporary directory, so
+    the indexes next to the original CBF files are never touched.
+
+    @param names: cases to run.  Defaults to all of them
+    @param callback: called with each result dict as it finishes
+    @param scratch: base is already a throw away copy, so run on it in place
+    @return: list of dicts with name, seconds, shots, shots_per_sec, mb_per_sec and peak_rss_mb
+    '''
+    tmp_dir = None
+    if not scratch:
+        tmp_dir = tempfile.mkdtemp(prefix='cabf_bench')
+        base = copy_survey(base, tmp_dir)
+    results = []
+    try:
+        for name, func, description in cases:
+            if names and name not in names:
+                continue
+            times = [time_case(func, base) for i in range(repeat)]
+            seconds, shots, num_bytes, rss = min(times)
+            rss = max([t[3] for t in times])
+            seconds = max(seconds, 1e-6)
+            result = {'name': name, 'description': description, 'seconds': seconds, 'shots': shots,
+                      'shots_per_sec': shots / seconds, 'mb_per_sec': num_bytes / seconds / 2.**20,
+                      'peak_rss_mb': rss / 1024.}
+            results.append(result)
+            if callback is not None:
+                callback(result)
+        _remove_indexes(base)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''Find the cases that got slower or bigger than the baseline by more than tolerance
+
+    @param baseline: results of an earlier run_benchmarks, for example from --save
+    @return: list of (name, what, old, new)
+    '''
+    old = dict([(result['name'], result) for result in baseline])
+    regressions = []
+    for result in results:
+        if result['name'] not in old:
+            continue
+        before = old[result['name']]
+        if result['shots_per_sec'] < before['shots_per_sec'] * (1 - tolerance):
+            regressions.append((result['name'], 'shots/sec', before['shots_per_sec'], result['shots_per_sec']))
+        if result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance):
+            regressions.append((result['name'], 'peak RSS MB', before['peak_rss_mb'], result['peak_rss_mb']))
+    return regressions
+
+
+def format_result(result):
+    return '%(name)-14s %(seconds)8.3fs %(shots)9d shots %(shots_per_sec)12.0f shots/s %(mb_per_sec)8.1f MB/s %(peak_rss_mb)8.1f MB RSS' % result
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] [case1 case2 ...]",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-b', '--base', dest='base', default=None,
+                      help='use an existing survey base.CAF instead of writing a new one.  It is copied to a temporary directory first')
+    parser.add_option('-r', '--runs', dest='runs', default=2, type='int',
+                      help='run headers / CBF files in the synthetic survey [default: %default]')
+    parser.add_option('-s', '--scans', dest='scans', default=2000, type='int',
+                      help='scans in each run [default: %default]')
+    parser.add_option('-S', '--shots', dest='shots', default=24, type='int',
+                      help='shots in each scan [default: %default]')
+    parser.add_option('-n', '--repeat', dest='repeat', default=3, type='int',
+                      help='times to run each case, keeping the fastest [default: %default]')
+    parser.add_option('--save', dest='save', default=None,
+                      help='write the results to this JSON file')
+    parser.add_option('--baseline', dest='baseline', default=None,
+                      help='compare against the JSON results of an earlier --save and exit 1 on a regression')
+    parser.add_option('-t', '--tolerance', dest='tolerance', default=0.25, type='float',
+                      help='fraction slower or larger than the baseline that counts as a regression [default: %default]')
+    parser.add_option('-l', '--list', dest='list', default=False, action='store_true',
+                      help='list the cases and exit')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.list:
+        for name, func, description in cases:
+            print '%-14s %s' % (name, description)
+        return
+    for name in args:
+        if name not in case_names:
+            parser.error('unknown case %s.  Use one of %s' % (name, ', '.join(case_names)))
+
+    tmp_dir = None
+    base = opts.base
+    if base is None:
+        tmp_dir = tempfile.mkdtemp(prefix='cabf_bench')
+        base = os.path.join(tmp_dir, 'BENCH')
+        if opts.verbose:
+            print 'Writing synthetic survey', base
+        cabf_synth.write_survey(base, opts.runs, opts.scans, opts.shots)
+    elif base.upper().endswith('.CAF'):
+        base = base[:-4]
+
+    try:
+        results = run_benchmarks(base, args, opts.repeat, callback=lambda result: sys.stdout.write(format_result(result) + '\n'),
+                                 scratch=tmp_dir is not None)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    if opts.save:
+        json.dump(results, open(opts.save, 'w'), indent=1)
+    if opts.baseline:
+        regressions = compare(results, json.load(open(opts.baseline)), opts.tolerance)
+        for name, what, old, new in regressions:
+            print 'REGRESSION %s %s: %.1f -> %.1f' % (name, what, old, new)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
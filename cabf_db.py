@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Build a SQLite database of LADS lidar surveys from the CAF and CBF files.
+
+Each sounding row keeps the CBF file and the byte offset of its WF
+record, so a waveform is one mmap slice away.  Times are seconds since
+1970 (UTC) so they can be indexed and compared.
+
+The files table remembers the size and mtime of every CAF and CBF.
+Loading a survey again is skipped when nothing changed.  If only some
+CBFs changed, just the waveform pointers of their soundings are
+redone.  A changed CAF replaces only the rows of that survey.
+
+@requires: U{Python<http://python.org/>} >= 2.5 with sqlite3
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import mmap
+import sqlite3
+
+import numpy as np
+
+import caf
+import cbf
+import cabf
+import cabf_profile
+
+schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS surveys (
+    id INTEGER PRIMARY KEY,
+    caf_file_id INTEGER UNIQUE NOT NULL REFERENCES files(id),
+    title TEXT,
+    survey_num INTEGER,
+    date TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    survey_id INTEGER NOT NULL REFERENCES surveys(id),
+    num INTEGER NOT NULL,
+    run INTEGER, section INTEGER, seq INTEGER, child INTEGER,
+    year INTEGER, julian_day INTEGER, planned_task INTEGER, status TEXT,
+    cbf_file_id INTEGER REFERENCES files(id)
+);
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    survey_id INTEGER NOT NULL REFERENCES surveys(id),
+    num INTEGER NOT NULL,
+    run_num INTEGER,
+    time INTEGER,
+    lat REAL, lon REAL, scan_row INTEGER, tide_cor REAL
+);
+CREATE TABLE IF NOT EXISTS soundings (
+    id INTEGER PRIMARY KEY,
+    survey_id INTEGER NOT NULL REFERENCES surveys(id),
+    num INTEGER NOT NULL,
+    scan_num INTEGER,
+    run_num INTEGER,
+    entry_id TEXT,
+    time INTEGER,
+    lat REAL, lon REAL,
+    easting INTEGER, northing INTEGER,
+    lat_contender REAL, lon_contender REAL,
+    easting_contender INTEGER, northing_contender INTEGER,
+    frame INTEGER, row INTEGER, col INTEGER,
+    depth_selected REAL, depth_contender REAL,
+    flag INTEGER,
+    cbf_file_id INTEGER REFERENCES files(id),
+    cbf_offset INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS runs_survey ON runs(survey_id, num);
+CREATE INDEX IF NOT EXISTS runs_run ON runs(run, section, seq, child);
+CREATE UNIQUE INDEX IF NOT EXISTS scans_survey ON scans(survey_id, num);
+CREATE INDEX IF NOT EXISTS scans_time ON scans(time);
+CREATE UNIQUE INDEX IF NOT EXISTS soundings_survey ON soundings(survey_id, num);
+CREATE INDEX IF NOT EXISTS soundings_time ON soundings(time);
+CREATE INDEX IF NOT EXISTS soundings_run ON soundings(survey_id, run_num);
+CREATE INDEX IF NOT EXISTS soundings_flag ON soundings(flag);
+CREATE INDEX IF NOT EXISTS soundings_position ON soundings(lat, lon);
+'''
+
+insert_run = '''INSERT INTO runs (survey_id, num, run, section, seq, child, year, julian_day,
+    planned_task, status, cbf_file_id) VALUES (?,?,?,?,?,?,?,?,?,?,?)'''
+insert_scan = '''INSERT INTO scans (survey_id, num, run_num, time, lat, lon, scan_row, tide_cor)
+    VALUES (?,?,?,?,?,?,?,?)'''
+insert_sounding = '''INSERT INTO soundings (survey_id, num, scan_num, run_num, entry_id, time,
+    lat, lon, easting, northing, lat_contender, lon_contender, easting_contender, northing_contender,
+    frame, row, col, depth_selected, depth_contender, flag, cbf_file_id, cbf_offset)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'''
+update_offset = '''UPDATE soundings SET cbf_file_id=?, cbf_offset=? WHERE survey_id=? AND num=?'''
+
+sounding_columns_in_order = ('lat', 'lon', 'easting_selected_depth', 'northing_selected_depth',
+                             'lat_contender_depth', 'lon_contender_depth', 'easting_contender',
+                             'northing_contender', 'frame', 'row', 'col', 'depth_selected',
+                             'depth_contender', 'flag')
+'caf.Caf.read_columns names in the same order as insert_sounding'
+
+
+def file_stat(path):
+    '@return: (size, mtime) or (None, None) if the file does not exist'
+    if not os.path.exists(path):
+        return None, None
+    return os.path.getsize(path), os.path.getmtime(path)
+
+
+def _or_null(values, keep):
+    '@return: list of values with None (NULL) where keep is False'
+    return [value if ok else None for value, ok in zip(values.tolist(), keep.tolist())]
+
+
+class SurveyDb:
+    '''A SQLite database of surveys.  Soundings point at their waveforms
+    with cbf_file_id and cbf_offset, which are both NULL for a sounding
+    with no waveform.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(schema)
+        self.mmaps = {}
+
+    def close(self):
+        for data in self.mmaps.values():
+            data.close()
+        self.mmaps = {}
+        self.conn.close()
+
+    def _forget(self, path):
+        'Drop the mmap of a CBF whose rows are being redone so the new file gets mapped'
+        data = self.mmaps.pop(path, None)
+        if data is not None:
+            data.close()
+
+    def _file_id(self, path, kind):
+        '''Row id of a file, adding it if needed.  Does not update the stat'''
+        row = self.conn.execute('SELECT id FROM files WHERE path=?', (path,)).fetchone()
+        if row is not None:
+            return row[0]
+        size, mtime = file_stat(path)
+        return self.conn.execute('INSERT INTO files (path, kind, size, mtime) VALUES (?,?,?,?)',
+                                 (path, kind, size, mtime)).lastrowid
+
+    def _set_stat(self, file_id, path):
+        size, mtime = file_stat(path)
+        self.conn.execute('UPDATE files SET size=?, mtime=? WHERE id=?', (size, mtime, file_id))
+
+    def _changed(self, file_id, path):
+        row = self.conn.execute('SELECT size, mtime FROM files WHERE id=?', (file_id,)).fetchone()
+        return row is None or tuple(row) != file_stat(path)
+
+    def delete_survey(self, survey_id):
+        for table in ('soundings', 'scans', 'runs'):
+            self.conn.execute('DELETE FROM %s WHERE survey_id=?' % table, (survey_id,))
+        self.conn.execute('DELETE FROM surveys WHERE id=?', (survey_id,))
+
+    def ingest(self, caf_filename, chunk_bytes=1<<22, force=False):
+        '''Load a survey or bring it up to date.
+
+        @param force: reload even if nothing changed
+        @return: 'skipped', 'waveforms' (only the pointers into changed CBFs
+            were redone) or 'loaded'
+        '''
+        caf_path = os.path.abspath(caf_filename)
+        row = self.conn.execute('SELECT surveys.id, files.id FROM surveys JOIN files'
+                                ' ON surveys.caf_file_id=files.id WHERE files.path=?', (caf_path,)).fetchone()
+        if row is not None and not force and not self._changed(row[1], caf_path):
+            survey_id = row[0]
+            changed = [(run_num, file_id, path) for run_num, file_id, path in self.conn.execute(
+                'SELECT runs.num, files.id, files.path FROM runs JOIN files ON runs.cbf_file_id=files.id'
+                ' WHERE runs.survey_id=?', (survey_id,)) if self._changed(file_id, path)]
+            if not changed:
+                return 'skipped'
+            self._update_waveforms(survey_id, caf_path, changed, chunk_bytes)
+            return 'waveforms'
+
+        with self.conn:
+            if row is not None:
+                self.delete_survey(row[0])
+        self._load(caf_path, chunk_bytes)
+        return 'loaded'
+
+    def _load(self, caf_path, chunk_bytes):
+        caf_file = caf.Caf(caf_path)
+        base = caf_path[:-4]
+        joiner = cabf.ShotJoiner(base)
+        with self.conn:
+            caf_file_id = self._file_id(caf_path, 'CAF')
+            # The stat is only recorded at the end so a load that dies part way is redone
+            self.conn.execute('UPDATE files SET size=NULL, mtime=NULL WHERE id=?', (caf_file_id,))
+            survey_id = self.conn.execute('INSERT INTO surveys (caf_file_id, title, survey_num, date) VALUES (?,?,?,?)',
+                                          (caf_file_id, caf_file.title, caf_file.id_num,
+                                           caf_file.date.strftime('%Y-%m-%d'))).lastrowid
+
+        run_headers = []
+        run_file_ids = []
+        scan_times = np.zeros(0, dtype=np.int64)
+        num_soundings = 0
+        for soundings, scans, chunk_runs in caf_file.column_chunks(names=None, chunk_bytes=chunk_bytes):
+            with self.conn: # One transaction per chunk
+                for rh in chunk_runs:
+                    cbf_path = cabf.cbf_filename(base, (rh.run, rh.section, rh.seq, rh.child))
+                    file_id = self._file_id(cbf_path, 'CBF')
+                    self._set_stat(file_id, cbf_path)
+                    self._forget(cbf_path)
+                    self.conn.execute(insert_run, (survey_id, len(run_headers), rh.run, rh.section, rh.seq, rh.child,
+                                                   rh.date.year, rh.julian_day, rh.planned_task, rh.status, file_id))
+                    run_headers.append(rh)
+                    run_file_ids.append(file_id)
+
+                first_scan = len(scan_times)
+                times = cbf.scan_epochs(scans)
+                scan_times = np.concatenate((scan_times, times))
+                self.conn.executemany(insert_scan, zip(
+                    [survey_id] * len(times), range(first_scan, len(scan_times)), scans['run'].tolist(),
+                    times.tolist(), scans['lat'].tolist(), scans['lon'].tolist(),
+                    scans['scan_row'].tolist(), scans['tide_cor'].tolist()))
+
+                soundings['runs'] = run_headers
+                joined, report = joiner.join(soundings)
+                count = len(joined['scan'])
+                file_ids = np.array(run_file_ids + [-1], dtype=np.int64)[joined['run']]
+                matched = joined['cbf_offset'] >= 0
+                file_ids = _or_null(file_ids, matched)
+                columns = [[survey_id] * count, range(num_soundings, num_soundings + count),
+                           joined['scan'].tolist(), joined['run'].tolist(), joined['entry_id'].tolist(),
+                           scan_times[joined['scan']].tolist()]
+                columns += [joined[name].tolist() for name in sounding_columns_in_order]
+                columns += [file_ids, _or_null(joined['cbf_offset'], matched)]
+                self.conn.executemany(insert_sounding, zip(*columns))
+                num_soundings += count
+        with self.conn:
+            self._set_stat(caf_file_id, caf_path)
+        return survey_id
+
+    def _update_waveforms(self, survey_id, caf_path, changed, chunk_bytes):
+        '''Redo cbf_offset for the soundings of the runs whose CBF changed'''
+        caf_file = caf.Caf(caf_path)
+        joiner = cabf.ShotJoiner(caf_path[:-4])
+        changed_runs = dict([(run_num, file_id) for run_num, file_id, path in changed])
+        for run_num, file_id, path in changed:
+            self._forget(path)
+        run_headers = []
+        num_soundings = 0
+        for soundings, scans, chunk_runs in caf_file.column_chunks(names=('frame', 'row', 'col'), chunk_bytes=chunk_bytes):
+            run_headers += chunk_runs
+            count = len(soundings['run'])
+            rows = np.flatnonzero(np.in1d(soundings['run'], changed_runs.keys()))
+            if len(rows):
+                subset = dict([(name, soundings[name][rows]) for name in ('frame', 'row', 'col', 'run')])
+                subset['runs'] = run_headers
+                joined, report = joiner.join(subset)
+                file_ids = np.array([changed_runs[run_num] for run_num in joined['run'].tolist()], dtype=np.int64)
+                matched = joined['cbf_offset'] >= 0
+                with self.conn:
+                    self.conn.executemany(update_offset, zip(
+                        _or_null(file_ids, matched), _or_null(joined['cbf_offset'], matched),
+                        [survey_id] * len(rows), (rows + num_soundings).tolist()))
+            num_soundings += count
+        with self.conn:
+            for run_num, file_id, path in changed:
+                self._set_stat(file_id, path)
+
+    def waveform(self, sounding_id):
+        '''The cbf.WaveForm of a sounding by its row id, read with one mmap slice
+
+        @return: WaveForm or None if the sounding has no waveform
+        '''
+        row = self.conn.execute('SELECT files.path, soundings.cbf_offset FROM soundings'
+                                ' JOIN files ON soundings.cbf_file_id=files.id WHERE soundings.id=?',
+                                (sounding_id,)).fetchone()
+        if row is None or row[1] is None:
+            return None
+        path, offset = row
+        if path not in self.mmaps:
+            infile = open(path, 'rb')
+            self.mmaps[path] = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            infile.close()
+        return cbf.WaveForm(self.mmaps[path][offset:offset + cbf.wave_form_block_size])
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] survey.db file1.CAF file2.CAF ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-f', '--force', dest='force', default=False, action='store_true',
+                      help='reload surveys even if the files did not change')
+    parser.add_option('-c', '--chunk-bytes', dest='chunk_bytes', default=1<<22, type='int',
+                      help='CAF bytes per transaction [default: %default]')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if len(args) < 1:
+        parser.error('need a database file')
+
+    db = SurveyDb(args[0])
+    for filename in args[1:]:
+        print '%s: %s' % (filename, db.ingest(filename, opts.chunk_bytes, opts.force))
+    if opts.verbose:
+        for table in ('files', 'surveys', 'runs', 'scans', 'soundings'):
+            print '  %s: %d' % (table, db.conn.execute('SELECT count(*) FROM %s' % table).fetchone()[0])
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
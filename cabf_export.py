@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Convert a LADS lidar survey (one CAF and its CBFs) into a columnar
+dataset so that later jobs never have to parse the text or walk the
+binary files again.
+
+A dataset has three tables:
+ - soundings: one row per CAF sounding with every sounding attribute,
+   the scan and run it belongs to, where its waveform is in the CBF and
+   the 120 waveform samples as a fixed width column
+ - scans: the W1 scan headers with first_sounding and num_soundings
+ - runs: the R1 run headers and the CBF file of each
+
+The CAF is read a block at a time with Caf.column_chunks and joined to
+the CBFs with cabf.ShotJoiner, so memory use for the soundings is set
+by chunk_bytes and not by the size of the survey.  Each block becomes a
+row group.  Only the much smaller scans table is held until the end.
+
+Formats:
+ - npy: a directory with a subdirectory per table and one .npy file per
+   column.  load_column memory maps a column, so it is the fastest to read
+ - npz: the same .npy files in one uncompressed zip
+ - hdf5: one file with a group per table.  Needs h5py
+ - parquet: a directory with one parquet file per table.  Needs pyarrow
+
+@requires: U{Python<http://python.org/>} >= 2.6
+@requires: U{numpy<http://numpy.scipy.org/>}
+@requires: U{h5py<http://www.h5py.org/>} For the hdf5 format.  Tried with 2.10
+@requires: U{pyarrow<http://arrow.apache.org/>} For the parquet format.  Tried with 0.16
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import sys
+import json
+import shutil
+import struct
+import zipfile
+
+import numpy as np
+
+import caf
+import cabf
+import cabf_profile
+
+formats = ('npy', 'npz', 'hdf5', 'parquet')
+
+default_suffix = {'npy': '.cabf', 'npz': '.npz', 'hdf5': '.h5', 'parquet': '.parquet'}
+'Added to the CAF name without .CAF when no output name is given'
+
+tables = ('soundings', 'scans', 'runs')
+
+sounding_extra_columns = ('entry_id', 'scan', 'run', 'cbf_shot', 'cbf_offset',
+                          'selected_depth_index', 'contend_depth_index', 'samples')
+'Columns of the soundings table that do not come from caf.sounding_columns'
+
+
+_npy_header_size = 128
+
+
+def _npy_header(dtype, shape):
+    '''A version 1.0 .npy header padded to a fixed size so it can be
+    rewritten with the final shape once all the rows are written.
+    '''
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    header = header.ljust(_npy_header_size - 11) + '\n'
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header
+
+
+class NpyColumn:
+    'Append rows to a .npy file without knowing how many there will be'
+    def __init__(self, filename, dtype, row_shape=()):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.num_rows = 0
+        self.out = open(filename, 'wb')
+        self.out.write(_npy_header(self.dtype, (0,) + self.row_shape))
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        assert values.shape[1:] == self.row_shape
+        values.tofile(self.out)
+        self.num_rows += len(values)
+
+    def close(self):
+        self.out.seek(0)
+        self.out.write(_npy_header(self.dtype, (self.num_rows,) + self.row_shape))
+        self.out.close()
+
+
+class NpyWriter:
+    'A directory per dataset, a directory per table and a .npy per column'
+    def __init__(self, path):
+        self.path = path
+        self.columns = {}
+        for table in tables:
+            table_dir = os.path.join(path, table)
+            if not os.path.isdir(table_dir):
+                os.makedirs(table_dir)
+
+    def append(self, table, columns):
+        for name, values in columns.iteritems():
+            if (table, name) not in self.columns:
+                filename = os.path.join(self.path, table, name + '.npy')
+                self.columns[(table, name)] = NpyColumn(filename, values.dtype, values.shape[1:])
+            self.columns[(table, name)].append(values)
+
+    def close(self, metadata):
+        for column in self.columns.values():
+            column.close()
+        out = open(os.path.join(self.path, 'survey.json'), 'w')
+        json.dump(metadata, out, indent=1, sort_keys=True)
+        out.close()
+
+
+class NpzWriter(NpyWriter):
+    '''Write the npy layout to a temporary directory and then store it
+    uncompressed in one zip, which np.load reads a member at a time.
+    '''
+    def __init__(self, path):
+        self.npz_path = path
+        NpyWriter.__init__(self, path + '.tmp')
+
+    def close(self, metadata):
+        NpyWriter.close(self, metadata)
+        tmp_filename = self.npz_path + '.tmp.npz'
+        npz = zipfile.ZipFile(tmp_filename, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        for (table, name) in sorted(self.columns):
+            npz.write(self.columns[(table, name)].filename, '%s/%s.npy' % (table, name))
+        npz.writestr('survey.json', json.dumps(metadata, sort_keys=True))
+        npz.close()
+        os.rename(tmp_filename, self.npz_path)
+        shutil.rmtree(self.path)
+
+
+class Hdf5Writer:
+    'One HDF5 file with a group per table and a chunked, growing dataset per column'
+    def __init__(self, path):
+        import h5py
+        self.h5 = h5py.File(path, 'w')
+
+    def append(self, table, columns):
+        group = self.h5.require_group(table)
+        for name, values in columns.iteritems():
+            if name not in group:
+                group.create_dataset(name, shape=(0,) + values.shape[1:], maxshape=(None,) + values.shape[1:],
+                                     dtype=values.dtype, chunks=(max(1, min(len(values), 1<<16)),) + values.shape[1:])
+            dataset = group[name]
+            start = dataset.shape[0]
+            dataset.resize(start + len(values), axis=0)
+            dataset[start:] = values
+
+    def close(self, metadata):
+        for key, value in metadata.iteritems():
+            self.h5.attrs[key] = json.dumps(value)
+        self.h5.close()
+
+
+class ParquetWriter:
+    '''A directory with one parquet file per table.  Each append is a row
+    group.  The samples become a fixed size binary column.
+    '''
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.writers = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _array(self, values):
+        pa = self.pa
+        if values.ndim == 2:
+            values = np.ascontiguousarray(values)
+            return pa.Array.from_buffers(pa.binary(values.shape[1]), len(values),
+                                         [None, pa.py_buffer(values.tostring())])
+        return pa.array(values)
+
+    def append(self, table, columns):
+        names = sorted(columns)
+        batch = self.pa.Table.from_arrays([self._array(columns[name]) for name in names], names)
+        if table not in self.writers:
+            filename = os.path.join(self.path, table + '.parquet')
+            self.writers[table] = self.pq.ParquetWriter(filename, batch.schema)
+        self.writers[table].write_table(batch)
+
+    def close(self, metadata):
+        for writer in self.writers.values():
+            writer.close()
+        out = open(os.path.join(self.path, 'survey.json'), 'w')
+        json.dump(metadata, out, indent=1, sort_keys=True)
+        out.close()
+
+
+writers = {'npy': NpyWriter, 'npz': NpzWriter, 'hdf5': Hdf5Writer, 'parquet': ParquetWriter}
+
+
+def _run_table(run_headers, base):
+    'The runs side table from a list of caf.RunHeader'
+    runs = [(rh.run, rh.section, rh.seq, rh.child) for rh in run_headers]
+    columns = {}
+    for i, name in enumerate(('run', 'section', 'seq', 'child')):
+        columns[name] = np.array([run[i] for run in runs], dtype=np.int32)
+    columns['year'] = np.array([rh.date.year for rh in run_headers], dtype=np.int32)
+    columns['julian_day'] = np.array([rh.julian_day for rh in run_headers], dtype=np.int32)
+    columns['planned_task'] = np.array([rh.planned_task for rh in run_headers], dtype=np.int32)
+    columns['status'] = np.array([rh.status for rh in run_headers], dtype='S16')
+    columns['cbf_filename'] = np.array([os.path.basename(cabf.cbf_filename(base, run)) for run in runs],
+                                       dtype='S64')
+    return columns
+
+
+def _add_reports(total, report):
+    'Sum the per sounding counts of ShotJoiner.join reports.  The waveform counts are already running totals'
+    if total is None:
+        return report
+    report = dict(report)
+    for key in ('soundings', 'matched', 'unmatched_soundings', 'duplicate_soundings', 'out_of_order'):
+        report[key] += total[key]
+    report['missing_cbf_files'] = sorted(set(total['missing_cbf_files'] + report['missing_cbf_files']))
+    return report
+
+
+def export(caf_filename, path=None, format='npy', chunk_bytes=1<<23, with_samples=True, verbose=False):
+    '''Write the survey of a CAF and its CBFs as a columnar dataset.
+
+    @param path: output name.  Defaults to the CAF name with default_suffix
+    @param format: one of formats
+    @param chunk_bytes: CAF text per block, which sets the row group size
+        and the memory used
+    @param with_samples: include the (N,120) uint8 samples column
+    @return: the path written and the join report summed over the blocks
+    '''
+    if format not in writers:
+        raise ValueError('unknown format %s.  Use one of %s' % (format, ', '.join(formats)))
+    base = caf_filename[:-4]
+    if path is None:
+        path = base + default_suffix[format]
+    caf_file = caf.Caf(caf_filename)
+    joiner = cabf.ShotJoiner(base)
+    writer = writers[format](path)
+
+    sounding_names = [column[0] for column in caf.sounding_columns] + list(sounding_extra_columns)
+    run_headers = []
+    num_soundings = np.zeros(0, dtype=np.int64)
+    num_scans = 0
+    scan_chunks = []
+    total = 0
+    report = None
+    for soundings, scans, chunk_runs in caf_file.column_chunks(names=None, chunk_bytes=chunk_bytes):
+        run_headers += chunk_runs
+        soundings['runs'] = run_headers
+        joined, chunk_report = joiner.join(soundings, with_samples)
+        report = _add_reports(report, chunk_report)
+        writer.append('soundings', dict([(name, joined[name]) for name in sounding_names if name in joined]))
+        scan_chunks.append(scans)
+        num_scans += len(scans['run'])
+
+        scan_ids = soundings['scan']
+        if len(scan_ids):
+            counts = np.bincount(scan_ids - scan_ids[0])
+            end = scan_ids[0] + len(counts)
+            if end > len(num_soundings):
+                num_soundings = np.concatenate((num_soundings, np.zeros(end - len(num_soundings), dtype=np.int64)))
+            num_soundings[scan_ids[0]:end] += counts
+        total += len(scan_ids)
+        if verbose:
+            sys.stderr.write('%s: %d soundings\n' % (caf_filename, total))
+
+    num_soundings = np.concatenate((num_soundings, np.zeros(num_scans - len(num_soundings), dtype=np.int64)))
+    # The scan table is small, so it is kept until the end and written in one go
+    if scan_chunks:
+        scans = dict([(name, np.concatenate([chunk[name] for chunk in scan_chunks])) for name in scan_chunks[0]])
+        scans['num_soundings'] = num_soundings
+        scans['first_sounding'] = np.cumsum(num_soundings) - num_soundings
+        writer.append('scans', scans)
+    writer.append('runs', _run_table(run_headers, base))
+    metadata = {'caf_filename': os.path.basename(caf_filename),
+                'title': caf_file.title,
+                'survey_id': caf_file.id_num,
+                'date': caf_file.date.strftime('%Y-%m-%d'),
+                'num_soundings': total,
+                'num_scans': num_scans,
+                'num_runs': len(run_headers),
+                'chunk_bytes': chunk_bytes,
+                }
+    writer.close(metadata)
+    return path, report
+
+
+def load_column(path, name, table='soundings'):
+    '''Read one column of a dataset written by export without touching the
+    rest.  For the npy format the column is memory mapped.
+
+    @return: numpy array.  samples has shape (N,120)
+    '''
+    if os.path.isdir(os.path.join(path, table)):
+        return np.load(os.path.join(path, table, name + '.npy'), mmap_mode='r')
+    if path.endswith('.npz'):
+        npz = np.load(path)
+        try:
+            return npz['%s/%s' % (table, name)]
+        finally:
+            npz.close()
+    if os.path.isdir(path):
+        import pyarrow.parquet as pq
+        column = pq.read_table(os.path.join(path, table + '.parquet'), columns=[name]).column(name)
+        if not hasattr(column, 'chunks'):
+            column = column.data # pyarrow before 0.15 wraps the ChunkedArray in a Column
+        chunks = []
+        for chunk in column.chunks:
+            if name == 'samples':
+                width = chunk.type.byte_width
+                data = np.frombuffer(chunk.buffers()[1], dtype=np.uint8)
+                chunks.append(data[chunk.offset * width:(chunk.offset + len(chunk)) * width].reshape(-1, width))
+            else:
+                chunks.append(chunk.to_numpy(zero_copy_only=False))
+        values = np.concatenate(chunks)
+        if values.dtype == object:
+            values = np.array(values.tolist(), dtype='S') # Strings come back as python objects
+        return values
+    import h5py
+    h5 = h5py.File(path, 'r')
+    try:
+        return h5[table][name][...]
+    finally:
+        h5.close()
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CAF file2.CAF ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-f', '--format', dest='format', default='npy', type='choice', choices=formats,
+                      help='one of ' + ', '.join(formats) + ' [default: %default]')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='output name when there is only one CAF [default: CAF name plus a suffix]')
+    parser.add_option('-c', '--chunk-bytes', dest='chunk_bytes', default=1<<23, type='int',
+                      help='CAF bytes per row group [default: %default]')
+    parser.add_option('--no-samples', dest='with_samples', default=True, action='store_false',
+                      help='leave out the waveform samples')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if opts.output is not None and len(args) != 1:
+        parser.error('--output only works with one CAF')
+
+    for filename in args:
+        path, report = export(filename, opts.output, opts.format, opts.chunk_bytes, opts.with_samples,
+                              opts.verbose)
+        print 'Wrote', path
+        if report is not None and report['unmatched_soundings']:
+            print '  WARNING: %d soundings have no waveform' % report['unmatched_soundings']
+
+
+if __name__ == '__main__':
+    main()
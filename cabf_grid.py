@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Grid the soundings of a LADS lidar CAF into a bathymetric raster.
+
+The soundings are read in chunks of numpy columns with
+Caf.column_chunks and binned by their projected easting and northing.
+Each cell keeps the count, sum, sum of squares, min and max of its
+depths, so the memory used is set by the number of cells and not the
+number of soundings.  Row 0 is the north edge, as in a GeoTIFF.
+99.99 (no bottom) depths are always left out, and soundings can be
+limited to some flags and entry types (S, P, N or X).
+
+A grid with more than max_cells cells is made in tiles.  The soundings
+are read once and the easting, northing and depth of each is appended
+to a temporary file for its tile.  The tiles are then gridded and
+written one at a time.
+
+The products (mean, count, std, min and max) are written as float32
+GeoTIFFs with the UTM zone from the CAF G1 grid line, or as an npz
+of the cell accumulators that Grid.load can read back and merge.
+GDAL is not needed.
+
+@requires: U{Python<http://python.org/>} >= 2.5
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import math
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+import caf
+import cabf_profile
+
+no_bottom_depth = 99.99
+products = ('mean', 'count', 'std', 'min', 'max')
+nodata = -9999.
+
+_point_dtype = np.dtype([('x', '<f8'), ('y', '<f8'), ('z', '<f8')])
+
+
+def cell_index(x, y, west, north, cell_size, nx, ny):
+    '@return: column, row and a mask of the points inside the grid'
+    ix = np.floor((x - west) / cell_size).astype(np.int64)
+    iy = np.floor((north - y) / cell_size).astype(np.int64)
+    inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    return ix, iy, inside
+
+
+class Grid:
+    '''Depth statistics on a regular grid of square cells.
+
+    @ivar west: easting of the west edge
+    @ivar north: northing of the north edge
+    '''
+    def __init__(self, west, north, cell_size, nx, ny):
+        self.west = west
+        self.north = north
+        self.cell_size = cell_size
+        self.nx = nx
+        self.ny = ny
+        self.count = np.zeros((ny, nx), dtype=np.int32)
+        self.sum = np.zeros((ny, nx), dtype=np.float64)
+        self.sum_sq = np.zeros((ny, nx), dtype=np.float64)
+        self.min = np.empty((ny, nx), dtype=np.float32)
+        self.min.fill(np.inf)
+        self.max = np.empty((ny, nx), dtype=np.float32)
+        self.max.fill(-np.inf)
+
+    def cells(self, x, y):
+        return cell_index(x, y, self.west, self.north, self.cell_size, self.nx, self.ny)
+
+    def add(self, x, y, z):
+        '''Add depths z at eastings x and northings y.  Points outside the grid are dropped
+
+        @return: number of points added
+        '''
+        start = cabf_profile.enabled and cabf_profile.clock()
+        ix, iy, inside = self.cells(x, y)
+        flat = (iy * self.nx + ix)[inside]
+        z = np.asarray(z, dtype=np.float64)[inside]
+        if not len(flat):
+            return 0
+        order = np.argsort(flat, kind='mergesort')
+        flat = flat[order]
+        z = z[order]
+        starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+        cells = flat[starts]
+        self.count.flat[cells] += np.diff(np.append(starts, len(flat))).astype(np.int32)
+        self.sum.flat[cells] += np.add.reduceat(z, starts)
+        self.sum_sq.flat[cells] += np.add.reduceat(z * z, starts)
+        self.min.flat[cells] = np.minimum(self.min.flat[cells], np.minimum.reduceat(z, starts))
+        self.max.flat[cells] = np.maximum(self.max.flat[cells], np.maximum.reduceat(z, starts))
+        if start:
+            cabf_profile.add('grid.add', start, 0, len(z), 0)
+        return len(z)
+
+    def merge(self, other):
+        'Add the cells of a grid with the same geometry, for example one per file'
+        if (self.west, self.north, self.cell_size, self.nx, self.ny) != (other.west, other.north, other.cell_size, other.nx, other.ny):
+            raise ValueError('grids do not line up')
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        np.minimum(self.min, other.min, self.min)
+        np.maximum(self.max, other.max, self.max)
+        return self
+
+    def product(self, name):
+        '@return: float32 raster of one of products with nan in the empty cells'
+        empty = self.count == 0
+        count = np.maximum(self.count, 1)
+        if name == 'count':
+            return self.count.astype(np.float32)
+        if name == 'mean':
+            result = self.sum / count
+        elif name == 'std':
+            mean = self.sum / count
+            result = np.sqrt(np.maximum(self.sum_sq / count - mean * mean, 0))
+        elif name in ('min', 'max'):
+            result = getattr(self, name)
+        else:
+            raise ValueError('unknown product %s.  Use one of %s' % (name, ', '.join(products)))
+        result = result.astype(np.float32)
+        result[empty] = np.nan
+        return result
+
+    def save(self, filename):
+        np.savez(filename, geometry=np.array([self.west, self.north, self.cell_size, self.nx, self.ny]),
+                 count=self.count, sum=self.sum, sum_sq=self.sum_sq, min=self.min, max=self.max)
+
+    @staticmethod
+    def load(filename):
+        saved = np.load(filename)
+        west, north, cell_size, nx, ny = saved['geometry']
+        grid = Grid(west, north, cell_size, int(nx), int(ny))
+        for name in ('count', 'sum', 'sum_sq', 'min', 'max'):
+            getattr(grid, name)[:] = saved[name]
+        return grid
+
+
+def sounding_chunks(caf_file, flags=None, entry_types=None, contender=False, chunk_bytes=1<<22):
+    '''Easting, northing and depth arrays of the soundings to grid
+
+    @param caf_file: filename or caf.Caf
+    @param flags: flag values to keep, or None for all
+    @param entry_types: entry types to keep such as 'SP', or None for all
+    @param contender: grid the contender depths and positions instead of the selected
+    @return: generator of (x, y, z)
+    '''
+    if not isinstance(caf_file, caf.Caf):
+        caf_file = caf.Caf(caf_file)
+    if contender:
+        names = ('easting_contender', 'northing_contender', 'depth_contender')
+    else:
+        names = ('easting_selected_depth', 'northing_selected_depth', 'depth_selected')
+    for soundings, scans, runs in caf_file.column_chunks(names=names + ('flag',), chunk_bytes=chunk_bytes):
+        keep = soundings[names[2]] != no_bottom_depth
+        if flags is not None:
+            keep &= np.in1d(soundings['flag'], list(flags))
+        if entry_types is not None:
+            keep &= np.in1d(soundings['entry_id'], list(entry_types))
+        yield soundings[names[0]][keep], soundings[names[1]][keep], soundings[names[2]][keep]
+
+
+def extent(chunks):
+    '@return: west, south, east, north of the points or None if there are none'
+    bounds = None
+    for x, y, z in chunks:
+        if not len(x):
+            continue
+        box = (x.min(), y.min(), x.max(), y.max())
+        if bounds is None:
+            bounds = box
+        else:
+            bounds = (min(bounds[0], box[0]), min(bounds[1], box[1]), max(bounds[2], box[2]), max(bounds[3], box[3]))
+    return bounds
+
+
+def grid_geometry(bounds, cell_size):
+    '''Snap a box to whole cells
+
+    @return: west, north, nx, ny
+    '''
+    west = math.floor(bounds[0] / cell_size) * cell_size
+    north = (math.floor(bounds[3] / cell_size) + 1) * cell_size
+    nx = int(math.floor((bounds[2] - west) / cell_size)) + 1
+    ny = int(math.floor((north - bounds[1]) / cell_size)) + 1
+    return west, north, nx, ny
+
+
+def epsg_code(caf_file):
+    '''EPSG code of the output grid of a CAF, or None if it is not WGS84 UTM.
+
+    The G1 line does not say which hemisphere, so the area limits decide.
+    '''
+    grid = caf_file.out_grid
+    if grid['grid_id'].strip().upper() != 'UTM' or not grid['zone_id'].isdigit():
+        return None
+    if 'WGS84' not in caf_file.in_sphereoid.get('ident_text', '').replace(' ', '').upper():
+        return None
+    south = caf_file.bounds and caf_file.bounds[0][1] < 0
+    return (32700 if south else 32600) + int(grid['zone_id'])
+
+
+def write_geotiff(filename, raster, west, north, cell_size, epsg=None):
+    '''Write a float32 raster as an uncompressed GeoTIFF.  nan is written as nodata'''
+    raster = np.where(np.isnan(raster), nodata, raster).astype('<f4')
+    height, width = raster.shape
+    data = raster.tostring()
+    tags = []
+
+    def tag(code, kind, values):
+        tags.append((code, kind, values))
+
+    short, long_, double, ascii = 3, 4, 12, 2
+    geo_keys = [1, 1, 0, 2, 1024, 0, 1, 1, 1025, 0, 1, 1]
+    if epsg is not None:
+        geo_keys[3] = 3
+        geo_keys += [3072, 0, 1, epsg]
+    tag(256, long_, [width])
+    tag(257, long_, [height])
+    tag(258, short, [32])
+    tag(259, short, [1])                # No compression
+    tag(262, short, [1])                # Black is zero
+    tag(273, long_, [0])                # Strip offset, filled in below
+    tag(277, short, [1])
+    tag(278, long_, [height])
+    tag(279, long_, [len(data)])
+    tag(284, short, [1])
+    tag(339, short, [3])                # IEEE float
+    tag(33550, double, [cell_size, cell_size, 0.])
+    tag(33922, double, [0., 0., 0., west, north, 0.])
+    tag(34735, short, geo_keys)
+    tag(42113, ascii, '%g\0' % nodata)  # GDAL_NODATA
+
+    sizes = {short: 2, long_: 4, double: 8, ascii: 1}
+    formats = {short: 'H', long_: 'I', double: 'd'}
+    ifd_size = 2 + 12 * len(tags) + 4
+    extra_offset = 8 + ifd_size
+    extra = ''
+    entries = []
+    for code, kind, values in tags:
+        if kind == ascii:
+            packed = values
+        else:
+            packed = struct.pack('<%d%s' % (len(values), formats[kind]), *values)
+        count = len(packed) // sizes[kind]
+        if len(packed) <= 4:
+            entries.append([code, kind, count, packed.ljust(4, '\0')])
+        else:
+            entries.append([code, kind, count, struct.pack('<I', extra_offset + len(extra))])
+            extra += packed + '\0' * (len(packed) % 2)
+    data_offset = extra_offset + len(extra)
+    for entry in entries:
+        if entry[0] == 273:
+            entry[3] = struct.pack('<I', data_offset)
+
+    out = open(filename, 'wb')
+    out.write('II*\0' + struct.pack('<I', 8))
+    out.write(struct.pack('<H', len(entries)))
+    for code, kind, count, value in entries:
+        out.write(struct.pack('<HHI', code, kind, count) + value)
+    out.write(struct.pack('<I', 0))
+    out.write(extra)
+    out.write(data)
+    out.close()
+
+
+def write_products(grid, prefix, names=products, format='tif', epsg=None):
+    '@return: list of the files written'
+    if format == 'npz':
+        grid.save(prefix + '.npz')
+        return [prefix + '.npz']
+    written = []
+    for name in names:
+        filename = '%s_%s.tif' % (prefix, name)
+        write_geotiff(filename, grid.product(name), grid.west, grid.north, grid.cell_size, epsg)
+        written.append(filename)
+    return written
+
+
+def grid_caf(caf_filename, cell_size=1., prefix=None, bounds=None, max_cells=1<<22, names=products,
+             format='tif', **options):
+    '''Grid the soundings of a CAF and write the products.
+
+    @param bounds: west, south, east, north in projected units.  Found
+        with an extra pass over the CAF if not given
+    @param max_cells: grids with more cells than this are made in tiles of
+        about this many cells.  Each cell takes 36 bytes
+    @param options: flags, entry_types, contender and chunk_bytes for sounding_chunks
+    @return: list of the files written
+    '''
+    caf_file = caf.Caf(caf_filename)
+    if prefix is None:
+        prefix = caf_filename[:-4]
+    if bounds is None:
+        bounds = extent(sounding_chunks(caf_file, **options))
+        if bounds is None:
+            return []
+    west, north, nx, ny = grid_geometry(bounds, cell_size)
+    epsg = epsg_code(caf_file)
+
+    if nx * ny <= max_cells:
+        grid = Grid(west, north, cell_size, nx, ny)
+        for x, y, z in sounding_chunks(caf_file, **options):
+            grid.add(x, y, z)
+        return write_products(grid, prefix, names, format, epsg)
+    return _grid_tiles(caf_file, prefix, west, north, cell_size, nx, ny, max_cells, names, format, epsg, options)
+
+
+def _grid_tiles(caf_file, prefix, west, north, cell_size, nx, ny, max_cells, names, format, epsg, options):
+    tile = max(1, int(math.sqrt(max_cells)))
+    tiles_x = -(-nx // tile)
+    tmp_dir = tempfile.mkdtemp(prefix='cabf_grid')
+    written = []
+    try:
+        for x, y, z in sounding_chunks(caf_file, **options):
+            ix, iy, inside = cell_index(x, y, west, north, cell_size, nx, ny)
+            tile_ids = ((iy // tile) * tiles_x + ix // tile)[inside]
+            points = np.empty(len(tile_ids), dtype=_point_dtype)
+            points['x'], points['y'], points['z'] = x[inside], y[inside], z[inside]
+            order = np.argsort(tile_ids, kind='mergesort')
+            tile_ids = tile_ids[order]
+            points = points[order]
+            cuts = np.flatnonzero(np.diff(tile_ids)) + 1
+            for first, group in zip(np.concatenate(([0], cuts)), np.split(points, cuts)):
+                if len(group):
+                    out = open(os.path.join(tmp_dir, '%d' % tile_ids[first]), 'ab')
+                    group.tofile(out)
+                    out.close()
+
+        for name in sorted(os.listdir(tmp_dir), key=int):
+            tile_id = int(name)
+            row, col = divmod(tile_id, tiles_x)
+            grid = Grid(west + col * tile * cell_size, north - row * tile * cell_size, cell_size,
+                        min(tile, nx - col * tile), min(tile, ny - row * tile))
+            infile = open(os.path.join(tmp_dir, name), 'rb')
+            while True:
+                points = np.fromfile(infile, dtype=_point_dtype, count=1<<20)
+                if not len(points):
+                    break
+                grid.add(points['x'], points['y'], points['z'])
+            infile.close()
+            os.remove(os.path.join(tmp_dir, name))
+            written += write_products(grid, '%s_r%03d_c%03d' % (prefix, row, col), names, format, epsg)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return written
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CAF file2.CAF ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-c', '--cell-size', dest='cell_size', default=1., type='float',
+                      help='cell size in projected units (meters for UTM) [default: %default]')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='prefix of the files for a single CAF [default: the CAF name without .CAF]')
+    parser.add_option('-b', '--bounds', dest='bounds', default=None,
+                      help='WEST,SOUTH,EAST,NORTH in projected units.  Saves a pass over the CAF')
+    parser.add_option('-p', '--products', dest='products', default=','.join(products),
+                      help='comma separated list of %s [default: %%default]' % ', '.join(products))
+    parser.add_option('-f', '--format', dest='format', default='tif', choices=('tif', 'npz'),
+                      help='tif for one GeoTIFF per product or npz for the cell accumulators [default: %default]')
+    parser.add_option('--flags', dest='flags', default=None,
+                      help='comma separated flag values to keep [default: all]')
+    parser.add_option('-e', '--entry-types', dest='entry_types', default=None,
+                      help='entry types to keep, for example SP [default: all]')
+    parser.add_option('--contender', dest='contender', default=False, action='store_true',
+                      help='grid the contender depths instead of the selected depths')
+    parser.add_option('-m', '--max-cells', dest='max_cells', default=1<<22, type='int',
+                      help='make the grid in tiles of about this many cells when larger [default: %default]')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if opts.output is not None and len(args) != 1:
+        parser.error('--output only works with one CAF')
+    names = opts.products.split(',')
+    for name in names:
+        if name not in products:
+            parser.error('unknown product %s' % name)
+    bounds = None
+    if opts.bounds:
+        bounds = [float(value) for value in opts.bounds.split(',')]
+        if len(bounds) != 4:
+            parser.error('--bounds needs WEST,SOUTH,EAST,NORTH')
+    options = {'contender': opts.contender}
+    if opts.flags:
+        options['flags'] = [int(flag) for flag in opts.flags.split(',')]
+    if opts.entry_types:
+        options['entry_types'] = opts.entry_types.upper()
+
+    for filename in args:
+        written = grid_caf(filename, opts.cell_size, opts.output, bounds, opts.max_cells, names, opts.format, **options)
+        if opts.verbose:
+            for name in written:
+                print name
+        print '%s: %d file(s)' % (filename, len(written))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Google Earth KMZ of a LADS lidar survey (a CAF and its CBFs).
+
+The KMZ holds:
+ - a track line for each run header, made from its scan positions,
+   with the time span of the run
+ - the soundings as placemarks colored by depth, in a quadtree of
+   tiles.  Each tile is a separate KML file behind a NetworkLink with a
+   Region, so Google Earth only loads the tiles in view.  A tile holds
+   at most about per_tile soundings picked at random from the soundings
+   under it and not already shown by a tile above it.  Zooming out
+   gives a thinned sample of the shots and zooming in fills in the rest
+ - optionally, a waterfall image of the waveforms of each run, shown in
+   the balloon of its track (the stacked waveform mode)
+
+The CAF is read three times with Caf.column_chunks, so memory use is
+set by chunk_bytes and the tile count and not by the survey size.  The
+passes are for the extent, then the count of soundings in each tile,
+and then the output.  While the output is written, the placemark text
+of each tile goes to a temporary file until the tile is finished.
+
+@requires: U{Python<http://python.org/>} >= 2.6
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import math
+import datetime
+import shutil
+import zipfile
+import tempfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+import cbf
+import cabf
+import cabf_profile
+import cbf_waterfall
+
+no_bottom_depth = 99.99
+'Depth the CAF uses when there is no bottom detect'
+
+depth_colors = ('ffff0000', 'ffff5500', 'ffffaa00', 'ffffff00', 'ffaaff55', 'ff55ffaa', 'ff00ffff', 'ff00aaff')
+'KML aabbggrr colors from the shallowest to the deepest depth bin'
+
+no_bottom_color = 'ff888888'
+
+kml_header = '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+kml_footer = '</Document>\n</kml>\n'
+
+sounding_columns = ('lat', 'lon', 'depth_selected', 'frame', 'row', 'col')
+
+
+def _styles():
+    icon = 'http://maps.google.com/mapfiles/kml/shapes/shaded_dot.png'
+    lines = []
+    for i, color in enumerate(depth_colors + (no_bottom_color,)):
+        lines.append('<Style id="d%d"><IconStyle><color>%s</color><scale>0.4</scale><Icon><href>%s</href></Icon></IconStyle>'
+                     '<LabelStyle><scale>0</scale></LabelStyle></Style>\n' % (i, color, icon))
+    return ''.join(lines)
+
+
+def _region(west, south, east, north, min_pixels):
+    return ('<Region><LatLonAltBox><north>%.8f</north><south>%.8f</south><east>%.8f</east><west>%.8f</west>'
+            '</LatLonAltBox><Lod><minLodPixels>%d</minLodPixels><maxLodPixels>-1</maxLodPixels></Lod></Region>'
+            % (north, south, east, west, min_pixels))
+
+
+def _hash_uniform(ids):
+    'A repeatable random number in [0,1) for each sounding id'
+    x = ids.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    x ^= x >> np.uint64(31)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(29)
+    return (x >> np.uint64(11)).astype(np.float64) / 2. ** 53
+
+
+def _iso(epoch):
+    'KML time of seconds since 1970'
+    return datetime.datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class TileGrid:
+    '''Quadtree of tiles over the extent of the survey.  Level 0 is one
+    tile and level max_level has 2**max_level by 2**max_level tiles.
+    counts[level] is the number of soundings in each tile of that level.
+    '''
+    def __init__(self, west, south, east, north, max_level):
+        self.west, self.south = west, south
+        # Give zero sized extents some room so every sounding lands inside
+        self.east = max(east, west + 1e-6)
+        self.north = max(north, south + 1e-6)
+        self.max_level = max_level
+        size = 2 ** max_level
+        self.counts = [np.zeros((2 ** level, 2 ** level), dtype=np.int64) for level in range(max_level + 1)]
+        self.leaf_size = size
+
+    def leaf_cells(self, lon, lat):
+        size = self.leaf_size
+        ix = ((lon - self.west) / (self.east - self.west) * size).astype(np.int64)
+        iy = ((lat - self.south) / (self.north - self.south) * size).astype(np.int64)
+        return np.clip(ix, 0, size - 1), np.clip(iy, 0, size - 1)
+
+    def add(self, lon, lat):
+        ix, iy = self.leaf_cells(lon, lat)
+        np.add.at(self.counts[-1], (iy, ix), 1)
+
+    def sum_levels(self):
+        'Fill in the counts above the leaves once all the soundings are added'
+        for level in range(self.max_level - 1, -1, -1):
+            child = self.counts[level + 1]
+            self.counts[level] = child[0::2, 0::2] + child[1::2, 0::2] + child[0::2, 1::2] + child[1::2, 1::2]
+
+    def bounds(self, level, tx, ty):
+        'west, south, east, north of a tile'
+        n = 2 ** level
+        dx = (self.east - self.west) / n
+        dy = (self.north - self.south) / n
+        return (self.west + tx * dx, self.south + ty * dy, self.west + (tx + 1) * dx, self.south + (ty + 1) * dy)
+
+    def assign(self, lon, lat, ids, per_tile):
+        '''Pick the level of each sounding.  A sounding goes to the first
+        level where its random number is below per_tile over the count
+        of its tile at that level, so each tile gets about per_tile.
+        Whatever is left goes to the leaves.
+
+        @return: level, tile x and tile y of each sounding
+        '''
+        ix, iy = self.leaf_cells(lon, lat)
+        u = _hash_uniform(ids)
+        level = np.full(len(lon), self.max_level, dtype=np.int64)
+        todo = np.ones(len(lon), dtype=bool)
+        for lv in range(self.max_level):
+            shift = self.max_level - lv
+            counts = self.counts[lv][iy >> shift, ix >> shift]
+            take = todo & (u * counts < per_tile)
+            level[take] = lv
+            todo &= ~take
+        shift = self.max_level - level
+        return level, ix >> shift, iy >> shift
+
+
+def _placemarks(soundings, entry_ids, depth_bins):
+    'KML text of the placemarks for one tile'
+    lines = []
+    for lat, lon, depth, frame, row, col, entry, style in zip(
+            soundings['lat'].tolist(), soundings['lon'].tolist(), soundings['depth_selected'].tolist(),
+            soundings['frame'].tolist(), soundings['row'].tolist(), soundings['col'].tolist(),
+            entry_ids.tolist(), depth_bins.tolist()):
+        lines.append('<Placemark><styleUrl>#d%d</styleUrl><description>%s %.2f m frame %d row %d col %d</description>'
+                     '<Point><coordinates>%.8f,%.8f</coordinates></Point></Placemark>\n'
+                     % (style, entry, depth, frame, row, col, lon, lat))
+    return ''.join(lines)
+
+
+class KmzExporter:
+    '''Write one survey to a KMZ.
+
+    @ivar per_tile: soundings in each tile
+    @ivar track_points: most points in a run track line
+    @ivar waterfall_width: most columns in a run waterfall image
+    @ivar waterfall_shots: shots of waveforms to gather at a time for a
+        waterfall, so a long run is never all in memory
+    '''
+    def __init__(self, caf_filename, per_tile=500, track_points=2000, chunk_bytes=1<<22,
+                 waterfalls=False, waterfall_width=2048, waterfall_shots=8192):
+        self.cabf = cabf.Cabf(caf_filename)
+        self.caf = self.cabf.caf
+        self.base = self.cabf.base
+        self.per_tile = per_tile
+        self.track_points = track_points
+        self.chunk_bytes = chunk_bytes
+        self.waterfalls = waterfalls
+        self.waterfall_width = waterfall_width
+        self.waterfall_shots = waterfall_shots
+
+    def _chunks(self, names):
+        return self.caf.column_chunks(names=names, chunk_bytes=self.chunk_bytes)
+
+    def survey_extent(self):
+        '''First pass: the lon/lat box, the depth range, the sounding count and the scans in each run'''
+        west, south, east, north = 180., 90., -180., -90.
+        shallow, deep = None, None
+        num_soundings = 0
+        run_scans = np.zeros(0, dtype=np.int64)
+        for soundings, scans, runs in self._chunks(('lat', 'lon', 'depth_selected')):
+            num_soundings += len(soundings['lat'])
+            if len(soundings['lat']):
+                west, east = min(west, soundings['lon'].min()), max(east, soundings['lon'].max())
+                south, north = min(south, soundings['lat'].min()), max(north, soundings['lat'].max())
+                depth = soundings['depth_selected']
+                depth = depth[depth != no_bottom_depth]
+                if len(depth):
+                    shallow = depth.min() if shallow is None else min(shallow, depth.min())
+                    deep = depth.max() if deep is None else max(deep, depth.max())
+            counts = np.bincount(scans['run'][scans['run'] >= 0]) if len(scans['run']) else np.zeros(0, dtype=np.int64)
+            if len(counts) > len(run_scans):
+                run_scans = np.concatenate((run_scans, np.zeros(len(counts) - len(run_scans), dtype=np.int64)))
+            run_scans[:len(counts)] += counts
+        return (west, south, east, north), (shallow, deep), num_soundings, run_scans
+
+    def export(self, path=None):
+        '''@return: the KMZ path and a dict of counts'''
+        if path is None:
+            path = self.base + '.kmz'
+        start = cabf_profile.enabled and cabf_profile.clock()
+        bounds, depth_range, num_soundings, run_scans = self.survey_extent()
+        max_level = 0
+        if num_soundings > self.per_tile:
+            max_level = min(10, int(math.ceil(math.log(float(num_soundings) / self.per_tile, 4))))
+        grid = TileGrid(bounds[0], bounds[1], bounds[2], bounds[3], max_level)
+        for soundings, scans, runs in self._chunks(('lat', 'lon')):
+            grid.add(soundings['lon'], soundings['lat'])
+        grid.sum_levels()
+
+        tmp_dir = tempfile.mkdtemp(prefix='cabf_kml')
+        try:
+            tracks = self._write_tile_text(grid, depth_range, run_scans, tmp_dir)
+            num_tiles = self._write_kmz(path, grid, tracks, tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir)
+        if start:
+            cabf_profile.add('kml.export', start, os.path.getsize(path), num_soundings, num_tiles)
+        return path, {'soundings': num_soundings, 'tiles': num_tiles, 'levels': max_level + 1, 'runs': len(tracks)}
+
+    def _write_tile_text(self, grid, depth_range, run_scans, tmp_dir):
+        '''Third pass: append the placemarks of each chunk to the temporary file of their tile
+
+        @return: list of (RunHeader, coordinate strings, first and last scan epoch) for each run
+        '''
+        shallow, deep = depth_range
+        if shallow is None:
+            shallow, deep = 0., 1.
+        bin_size = max(deep - shallow, 1e-6) / len(depth_colors)
+        strides = np.maximum(1, -(-run_scans // self.track_points))
+        run_headers = []
+        tracks = {}
+        first_id = 0
+        scans_seen = np.zeros(len(run_scans) + 1, dtype=np.int64)
+        for soundings, scans, runs in self._chunks(sounding_columns):
+            run_headers += runs
+            self._add_track_points(scans, strides, scans_seen, tracks)
+
+            n = len(soundings['lat'])
+            if n == 0:
+                continue
+            ids = np.arange(first_id, first_id + n)
+            first_id += n
+            level, tx, ty = grid.assign(soundings['lon'], soundings['lat'], ids, self.per_tile)
+            depth = soundings['depth_selected']
+            bins = np.clip(((depth - shallow) / bin_size).astype(np.int64), 0, len(depth_colors) - 1)
+            bins[depth == no_bottom_depth] = len(depth_colors)
+
+            key = (level << 40) | (tx << 20) | ty
+            order = np.argsort(key, kind='mergesort')
+            cuts = np.flatnonzero(np.diff(key[order])) + 1
+            for group in np.split(order, cuts):
+                first = group[0]
+                name = os.path.join(tmp_dir, '%d_%d_%d' % (level[first], tx[first], ty[first]))
+                part = dict([(column, soundings[column][group]) for column in sounding_columns])
+                out = open(name, 'a')
+                out.write(_placemarks(part, soundings['entry_id'][group], bins[group]))
+                out.close()
+        return [(rh,) + tracks.get(i, ([], None, None)) for i, rh in enumerate(run_headers)]
+
+    def _add_track_points(self, scans, strides, scans_seen, tracks):
+        'Keep every stride-th scan position of each run plus its time span'
+        if not len(scans['run']):
+            return
+        runs = scans['run']
+        epochs = cbf.scan_epochs(scans)
+        for run in np.unique(runs):
+            if run < 0:
+                continue
+            rows = np.flatnonzero(runs == run)
+            number = scans_seen[run] + np.arange(len(rows))
+            scans_seen[run] += len(rows)
+            stride = strides[run] if run < len(strides) else 1
+            keep = rows[(number % stride) == 0]
+            if len(rows) and (number[-1] % stride):
+                keep = np.append(keep, rows[-1])
+            coords, first, last = tracks.get(run, ([], None, None))
+            coords.extend(['%.8f,%.8f' % (lon, lat) for lon, lat in zip(scans['lon'][keep].tolist(), scans['lat'][keep].tolist())])
+            run_epochs = epochs[rows]
+            first = run_epochs.min() if first is None else min(first, run_epochs.min())
+            last = run_epochs.max() if last is None else max(last, run_epochs.max())
+            tracks[run] = (coords, first, last)
+
+    def _tile_link(self, grid, level, tx, ty, href):
+        west, south, east, north = grid.bounds(level, tx, ty)
+        return ('<NetworkLink><name>%d_%d_%d</name>%s<Link><href>%s</href><viewRefreshMode>onRegion</viewRefreshMode></Link></NetworkLink>\n'
+                % (level, tx, ty, _region(west, south, east, north, 0 if level == 0 else 128), href))
+
+    def _write_kmz(self, path, grid, tracks, tmp_dir):
+        '@return: number of tiles written'
+        kmz = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        doc = [kml_header, '<name>%s</name>\n' % escape(self.caf.title or os.path.basename(self.base)),
+               '<Style id="track"><LineStyle><color>ff00ffff</color><width>2</width></LineStyle></Style>\n',
+               '<Folder><name>Tracks</name>\n']
+        for rh, coords, first, last in tracks:
+            run = (rh.run, rh.section, rh.seq, rh.child)
+            description = ''
+            if self.waterfalls:
+                image = self._waterfall(kmz, run)
+                if image:
+                    description = '<description><![CDATA[<img src="%s"/>]]></description>' % image
+            span = ''
+            if first is not None:
+                span = '<TimeSpan><begin>%s</begin><end>%s</end></TimeSpan>' % (_iso(first), _iso(last))
+            doc.append('<Placemark><name>run %d.%d.%d.%d</name>%s%s<styleUrl>#track</styleUrl>'
+                       '<LineString><tessellate>1</tessellate><coordinates>%s</coordinates></LineString></Placemark>\n'
+                       % (run + (description, span, ' '.join(coords))))
+        doc.append('</Folder>\n<Folder><name>Soundings</name>\n')
+        if grid.counts[0][0, 0]:
+            doc.append(self._tile_link(grid, 0, 0, 0, 'tiles/0_0_0.kml'))
+        doc.append('</Folder>\n' + kml_footer)
+        kmz.writestr('doc.kml', ''.join(doc))
+
+        num_tiles = 0
+        styles = _styles()
+        for level in range(grid.max_level + 1):
+            for ty, tx in zip(*np.nonzero(grid.counts[level])):
+                tile = [kml_header, styles]
+                if level < grid.max_level:
+                    for cy in (2 * ty, 2 * ty + 1):
+                        for cx in (2 * tx, 2 * tx + 1):
+                            if grid.counts[level + 1][cy, cx]:
+                                tile.append(self._tile_link(grid, level + 1, cx, cy, '%d_%d_%d.kml' % (level + 1, cx, cy)))
+                name = os.path.join(tmp_dir, '%d_%d_%d' % (level, tx, ty))
+                if os.path.exists(name):
+                    tile.append(open(name).read())
+                    os.remove(name)
+                tile.append(kml_footer)
+                kmz.writestr('tiles/%d_%d_%d.kml' % (level, tx, ty), ''.join(tile))
+                num_tiles += 1
+        kmz.close()
+        return num_tiles
+
+    def _waterfall(self, kmz, run):
+        'Add the waterfall image of a run to the KMZ.  @return: its name or None if there is no CBF'
+        filename = cabf.cbf_filename(self.base, run)
+        if not os.path.exists(filename):
+            return None
+        cbf_file = cbf.Cbf(filename)
+        scans = cbf_file.as_array()
+        decimate = max(1, -(-int(scans['num_shots'].sum()) // self.waterfall_width))
+        # Gather a chunk of whole scans at a time.  The shots past the last
+        # whole column of a chunk are carried into the next so the columns
+        # are the same as decimating the whole run at once.
+        columns = []
+        carry = None
+        for chunk in cbf.scan_chunks(scans, max(self.waterfall_shots, decimate)):
+            records = cbf.gather_waveforms(cbf_file.data, cbf_file.size, chunk)
+            if carry is not None:
+                records = np.concatenate((carry, records))
+            num = len(records) // decimate * decimate
+            if num:
+                columns.append(cbf_waterfall.waterfall(records[:num], decimate=decimate))
+            carry = records[num:]
+        if carry is not None and len(carry):
+            columns.append(cbf_waterfall.waterfall(carry, decimate=decimate))
+        if not columns:
+            return None
+        image_name = 'images/%s.png' % os.path.splitext(os.path.basename(filename))[0]
+        tmp = tempfile.NamedTemporaryFile(suffix='.png')
+        cbf_waterfall.write_png(tmp.name, np.hstack(columns))
+        kmz.write(tmp.name, image_name)
+        tmp.close()
+        return image_name
+
+
+def export_kmz(caf_filename, path=None, **options):
+    '''Write the KMZ of a survey.  See KmzExporter
+
+    @return: the KMZ path and a dict of counts
+    '''
+    return KmzExporter(caf_filename, **options).export(path)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CAF file2.CAF ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='KMZ to write for a single CAF [default: the CAF name with .kmz]')
+    parser.add_option('-n', '--per-tile', dest='per_tile', default=500, type='int',
+                      help='soundings in each tile [default: %default]')
+    parser.add_option('-t', '--track-points', dest='track_points', default=2000, type='int',
+                      help='most points in the track line of a run [default: %default]')
+    parser.add_option('-w', '--waterfalls', dest='waterfalls', default=False, action='store_true',
+                      help='add a waterfall image of the waveforms of each run')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if opts.output is not None and len(args) != 1:
+        parser.error('--output only works with one CAF')
+    if opts.per_tile < 1 or opts.track_points < 2:
+        parser.error('--per-tile must be at least 1 and --track-points at least 2')
+
+    for filename in args:
+        path, counts = export_kmz(filename, opts.output, per_tile=opts.per_tile,
+                                  track_points=opts.track_points, waterfalls=opts.waterfalls)
+        print '%s: %s soundings(%d) runs(%d) tiles(%d) levels(%d)' % (
+            filename, path, counts['soundings'], counts['runs'], counts['tiles'], counts['levels'])
+
+
+if __name__ == '__main__':
+    main()
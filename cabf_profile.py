@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Counters for each stage of the CAF and CBF readers: wall time, bytes
+read, records decoded and Python objects made.
+
+The readers only count when enabled is True.  When it is off, the
+cost is a single module attribute test at each stage.  The times of
+stages are inclusive, so a stage can contain others.  For example,
+caf.columns includes the caf.run_header lines of its chunk.  Stages are
+counted per scan or chunk, not per sounding, so that counting costs
+little even when it is on.
+
+Use it from a program like this::
+
+  import cabf_profile
+  cabf_profile.enable()
+  cabf_profile.add_hook(my_metrics.send)  # called with snapshot()
+  ...
+  cabf_profile.publish()
+
+The command line tools take --stats to print the table on exit.
+
+@requires: U{Python<http://python.org/>} >= 2.5
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import sys
+import time
+import atexit
+
+enabled = False
+'Set by enable.  The readers test this before doing any counting'
+
+clock = time.time
+'Wall clock used for the stage times'
+
+_stages = {}
+'stage name to [seconds, bytes, records, objects, calls]'
+
+_hooks = []
+
+fields = ('seconds', 'bytes', 'records', 'objects', 'calls')
+
+
+def enable(on=True):
+    'Turn counting on or off.  The counts so far are kept'
+    global enabled
+    enabled = on
+
+
+def reset():
+    'Forget all the counts'
+    _stages.clear()
+
+
+def add(stage, start=None, nbytes=0, records=0, objects=0):
+    '''Count one pass through a stage.
+
+    @param start: clock() when the stage began.  None to count no time
+    @param nbytes: bytes read from the file
+    @param records: records decoded
+    @param objects: Python objects made for the caller
+    '''
+    counts = _stages.get(stage)
+    if counts is None:
+        counts = _stages[stage] = [0., 0, 0, 0, 0]
+    if start is not None:
+        counts[0] += clock() - start
+    counts[1] += nbytes
+    counts[2] += records
+    counts[3] += objects
+    counts[4] += 1
+
+
+def snapshot():
+    '@return: dict of stage name to a dict of fields'
+    return dict([(stage, dict(zip(fields, counts))) for stage, counts in _stages.items()])
+
+
+def merge(other):
+    'Add the counts from the snapshot of another process'
+    for stage, counts in other.items():
+        mine = _stages.setdefault(stage, [0., 0, 0, 0, 0])
+        for i, field in enumerate(fields):
+            mine[i] += counts[field]
+
+
+def add_hook(func):
+    'func will be called with snapshot() on each publish'
+    _hooks.append(func)
+
+
+def remove_hook(func):
+    _hooks.remove(func)
+
+
+def publish():
+    'Hand the current counts to every hook'
+    counts = snapshot()
+    for hook in _hooks:
+        hook(counts)
+    return counts
+
+
+def format_stats(counts=None):
+    '@return: a table of the stages sorted by time'
+    if counts is None:
+        counts = snapshot()
+    lines = ['%-22s %10s %12s %10s %10s %10s' % (('stage',) + fields)]
+    for stage in sorted(counts, key=lambda stage: -counts[stage]['seconds']):
+        lines.append('%-22s %10.3f %12d %10d %10d %10d' % ((stage,) + tuple([counts[stage][field] for field in fields])))
+    return '\n'.join(lines)
+
+
+def report(out=sys.stderr):
+    'Print the table to out and publish it to the hooks'
+    out.write(format_stats(publish()) + '\n')
+
+
+def report_at_exit(out=sys.stderr):
+    '''Turn counting on and report when the program ends, even by
+    sys.exit.  This is what --stats does in the command line tools'''
+    enable()
+    atexit.register(report, out)
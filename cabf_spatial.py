@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Spatial index over the soundings of a LADS lidar survey for bounding
+box and nearest shot queries.
+
+The index is a regular lon/lat grid sized so that each cell holds a few
+dozen soundings on average.  The soundings are sorted by cell so each
+row of cells in a query is one contiguous slice.  Everything is saved
+as .npy files in a directory next to the CAF (base.spatial) and loaded
+with memory mapping, so opening even a very large index is instant and
+a query only touches the pages it needs.  The index records the size
+and mtime of the CAF it was built from and is rebuilt when they change.
+
+Sounding ids are the sounding numbers in CAF order, the same as the
+rows of a cabf_export dataset and the num column of cabf_db.
+
+@requires: U{Python<http://python.org/>} >= 2.6
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import json
+import math
+
+import numpy as np
+
+import caf
+import cabf
+import cabf_profile
+
+index_suffix = '.spatial'
+'Added to the CAF name without .CAF to get the index directory'
+
+meters_per_degree = 111195.
+'Along a great circle on a sphere of radius 6371 km'
+
+point_columns = ('lon', 'lat', 'id', 'cbf_file', 'cbf_offset')
+
+
+def _file_stats(path, filenames):
+    '''@return: [size, mtime] of each file in the directory path, or None
+        for one that does not exist'''
+    stats = []
+    for filename in filenames:
+        filename = os.path.join(path, filename)
+        if os.path.exists(filename):
+            stats.append([os.path.getsize(filename), os.path.getmtime(filename)])
+        else:
+            stats.append(None)
+    return stats
+
+
+class SpatialIndex:
+    '''Soundings bucketed into a regular lon/lat grid.
+
+    @ivar cell_start: soundings of cell i (row major, iy * nx + ix) are
+        cell_start[i]:cell_start[i+1] of the point arrays
+    @ivar cbf_filenames: cbf_file of a sounding indexes this list.  -1 is no waveform
+    @ivar caf_size: size of the CAF the index was built from, or None
+    @ivar caf_mtime: mtime of that CAF, or None
+    @ivar cbf_stats: [size, mtime] of each of cbf_filenames when the index
+        was built, None for one that did not exist
+    @ivar contender: True if the contender positions were indexed
+    '''
+    def __init__(self, bounds, nx, ny, cell_start, points, cbf_filenames):
+        '''
+        @param bounds: (lon_min, lat_min, lon_max, lat_max) of the grid
+        @param points: dict of point_columns sorted by cell
+        '''
+        self.bounds = tuple(bounds)
+        self.nx = nx
+        self.ny = ny
+        self.cell_start = cell_start
+        self.points = points
+        self.cbf_filenames = list(cbf_filenames)
+        lon_min, lat_min, lon_max, lat_max = self.bounds
+        self.cell_width = (lon_max - lon_min) / nx
+        self.cell_height = (lat_max - lat_min) / ny
+        self.cos_lat = math.cos(math.radians((lat_min + lat_max) / 2.))
+        self.caf_size = None
+        self.caf_mtime = None
+        self.cbf_stats = None
+        self.contender = False
+
+    @classmethod
+    def build(cls, lon, lat, ids, cbf_file, cbf_offset, cbf_filenames, per_cell=32):
+        '''Sort the soundings into a grid with about per_cell soundings per cell'''
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        if len(lon):
+            bounds = [lon.min(), lat.min(), lon.max(), lat.max()]
+        else:
+            bounds = [0., 0., 1., 1.]
+        # Pad so the max edge is inside the last cell and a single point has some size
+        pad = 1e-9 + 1e-9 * max(abs(b) for b in bounds)
+        bounds = [bounds[0] - pad, bounds[1] - pad, bounds[2] + pad, bounds[3] + pad]
+        cos_lat = math.cos(math.radians((bounds[1] + bounds[3]) / 2.))
+        width = (bounds[2] - bounds[0]) * cos_lat
+        height = bounds[3] - bounds[1]
+        num_cells = max(1, len(lon) // per_cell)
+        nx = int(max(1, min(num_cells, round(math.sqrt(num_cells * width / height)))))
+        ny = int(max(1, num_cells // nx))
+
+        ix = np.clip(((lon - bounds[0]) / (bounds[2] - bounds[0]) * nx).astype(np.int64), 0, nx - 1)
+        iy = np.clip(((lat - bounds[1]) / (bounds[3] - bounds[1]) * ny).astype(np.int64), 0, ny - 1)
+        cell = iy * nx + ix
+        order = np.argsort(cell, kind='mergesort')
+        cell_start = np.zeros(nx * ny + 1, dtype=np.int64)
+        cell_start[1:] = np.cumsum(np.bincount(cell, minlength=nx * ny))
+        points = {'lon': lon[order], 'lat': lat[order],
+                  'id': np.asarray(ids, dtype=np.int64)[order],
+                  'cbf_file': np.asarray(cbf_file, dtype=np.int32)[order],
+                  'cbf_offset': np.asarray(cbf_offset, dtype=np.int64)[order]}
+        return cls(bounds, nx, ny, cell_start, points, cbf_filenames)
+
+    @classmethod
+    def build_from_caf(cls, caf_filename, contender=False, chunk_bytes=1<<22, per_cell=32):
+        '''Read the CAF a chunk at a time and join it to the CBFs
+
+        @param contender: index the contender positions instead of the selected ones
+        '''
+        lon_name, lat_name = 'lon', 'lat'
+        if contender:
+            lon_name, lat_name = 'lon_contender_depth', 'lat_contender_depth'
+        base = caf_filename[:-4]
+        caf_file = caf.Caf(caf_filename)
+        joiner = cabf.ShotJoiner(base)
+        names = (lon_name, lat_name, 'frame', 'row', 'col')
+        columns = dict([(name, []) for name in point_columns])
+        run_headers = []
+        run_files = []
+        cbf_filenames = []
+        for soundings, scans, chunk_runs in caf_file.column_chunks(names=names, chunk_bytes=chunk_bytes):
+            for rh in chunk_runs:
+                filename = os.path.basename(cabf.cbf_filename(base, (rh.run, rh.section, rh.seq, rh.child)))
+                if filename not in cbf_filenames:
+                    cbf_filenames.append(filename)
+                run_files.append(cbf_filenames.index(filename))
+            run_headers += chunk_runs
+            soundings['runs'] = run_headers
+            joined, report = joiner.join(soundings)
+            first = sum([len(ids) for ids in columns['id']])
+            columns['lon'].append(joined[lon_name])
+            columns['lat'].append(joined[lat_name])
+            columns['id'].append(np.arange(first, first + len(joined['run'])))
+            files = np.array(run_files + [-1], dtype=np.int32)[joined['run']]
+            columns['cbf_file'].append(np.where(joined['cbf_offset'] >= 0, files, -1))
+            columns['cbf_offset'].append(joined['cbf_offset'])
+        for name in point_columns:
+            columns[name] = np.concatenate(columns[name]) if columns[name] else np.zeros(0)
+        index = cls.build(columns['lon'], columns['lat'], columns['id'], columns['cbf_file'],
+                          columns['cbf_offset'], cbf_filenames, per_cell)
+        index.caf_size = os.path.getsize(caf_filename)
+        index.caf_mtime = os.path.getmtime(caf_filename)
+        index.cbf_stats = _file_stats(os.path.dirname(caf_filename), cbf_filenames)
+        index.contender = contender
+        return index
+
+    def save(self, path):
+        '''Write the .npy files and an index.json into the directory path'''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'cell_start.npy'), self.cell_start)
+        for name in point_columns:
+            np.save(os.path.join(path, name + '.npy'), self.points[name])
+        out = open(os.path.join(path, 'index.json'), 'w')
+        json.dump({'bounds': self.bounds, 'nx': self.nx, 'ny': self.ny,
+                   'cbf_filenames': self.cbf_filenames, 'caf_size': self.caf_size,
+                   'caf_mtime': self.caf_mtime, 'cbf_stats': self.cbf_stats,
+                   'contender': self.contender}, out, indent=1)
+        out.close()
+
+    @classmethod
+    def load(cls, path):
+        '''Memory map an index written by save'''
+        meta = json.load(open(os.path.join(path, 'index.json')))
+        cell_start = np.load(os.path.join(path, 'cell_start.npy'), mmap_mode='r')
+        points = dict([(name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+                       for name in point_columns])
+        index = cls(meta['bounds'], meta['nx'], meta['ny'], cell_start, points,
+                    [str(filename) for filename in meta['cbf_filenames']])
+        index.caf_size = meta.get('caf_size')
+        index.caf_mtime = meta.get('caf_mtime')
+        index.cbf_stats = meta.get('cbf_stats')
+        index.contender = meta.get('contender', False)
+        return index
+
+    def is_current(self, caf_filename, contender=False):
+        '''@return: True if built from this CAF and its CBFs as they are now,
+            with the same positions'''
+        return (self.caf_size == os.path.getsize(caf_filename)
+                and self.caf_mtime == os.path.getmtime(caf_filename)
+                and self.cbf_stats == _file_stats(os.path.dirname(caf_filename), self.cbf_filenames)
+                and self.contender == contender)
+
+    def __len__(self):
+        return len(self.points['id'])
+
+    def _cell_x(self, lon):
+        return int(math.floor((lon - self.bounds[0]) / self.cell_width))
+
+    def _cell_y(self, lat):
+        return int(math.floor((lat - self.bounds[1]) / self.cell_height))
+
+    def _gather(self, rows):
+        '''Points in runs of cells.  rows is a list of (first cell, last cell + 1)'''
+        slices = [(self.cell_start[a], self.cell_start[b]) for a, b in rows if b > a]
+        result = {}
+        for name in point_columns:
+            column = self.points[name]
+            if slices:
+                result[name] = np.concatenate([column[start:end] for start, end in slices])
+            else:
+                result[name] = np.zeros(0, dtype=column.dtype)
+        return result
+
+    def query_bbox(self, lon_min, lat_min, lon_max, lat_max):
+        '''Soundings inside a lon/lat box, edges included.
+
+        @return: dict of numpy arrays: id (sounding number), cbf_file
+            (index into cbf_filenames or -1), cbf_offset (byte offset of the
+            WF record or -1), lon and lat
+        '''
+        x0 = max(0, self._cell_x(lon_min))
+        x1 = min(self.nx - 1, self._cell_x(lon_max))
+        y0 = max(0, self._cell_y(lat_min))
+        y1 = min(self.ny - 1, self._cell_y(lat_max))
+        rows = [(y * self.nx + x0, y * self.nx + x1 + 1) for y in range(y0, y1 + 1)] if x0 <= x1 else []
+        found = self._gather(rows)
+        inside = ((found['lon'] >= lon_min) & (found['lon'] <= lon_max)
+                  & (found['lat'] >= lat_min) & (found['lat'] <= lat_max))
+        return dict([(name, found[name][inside]) for name in found])
+
+    def _ring(self, cx, cy, r):
+        'Runs of cells at Chebyshev distance r from cell (cx, cy) clipped to the grid'
+        rows = []
+        x0, x1 = max(0, cx - r), min(self.nx - 1, cx + r)
+        if x0 > x1:
+            return rows
+        for y in range(max(0, cy - r), min(self.ny - 1, cy + r) + 1):
+            if r == 0 or abs(y - cy) == r:
+                rows.append((y * self.nx + x0, y * self.nx + x1 + 1))
+            else:
+                for x in (cx - r, cx + r):
+                    if 0 <= x < self.nx:
+                        rows.append((y * self.nx + x, y * self.nx + x + 1))
+        return rows
+
+    def nearest(self, lon, lat, k=1):
+        '''The k soundings closest to a point.  Distances use a flat earth
+        scaled by the cosine of the grid's middle latitude, which is plenty
+        for the size of a lidar survey.
+
+        @return: dict like query_bbox plus distance in meters, closest first
+        '''
+        cx = min(max(self._cell_x(lon), 0), self.nx - 1)
+        cy = min(max(self._cell_y(lat), 0), self.ny - 1)
+        # How far the query point is outside the starting cell
+        lon0 = self.bounds[0] + cx * self.cell_width
+        lat0 = self.bounds[1] + cy * self.cell_height
+        dx = max(lon0 - lon, 0, lon - (lon0 + self.cell_width)) * self.cos_lat
+        dy = max(lat0 - lat, 0, lat - (lat0 + self.cell_height))
+        outside = math.hypot(dx, dy)
+        step = min(self.cell_width * self.cos_lat, self.cell_height)
+        max_r = max(cx, self.nx - 1 - cx, cy, self.ny - 1 - cy)
+
+        found = []
+        num_found = 0
+        r = 0
+        while r <= max_r:
+            ring = self._gather(self._ring(cx, cy, r))
+            if len(ring['id']):
+                found.append(ring)
+                num_found += len(ring['id'])
+            if num_found >= k:
+                # Everything outside rings 0..r is at least this far away
+                covered = r * step - outside
+                lons = np.concatenate([f['lon'] for f in found])
+                lats = np.concatenate([f['lat'] for f in found])
+                dist = np.hypot((lons - lon) * self.cos_lat, lats - lat)
+                if np.partition(dist, k - 1)[k - 1] <= covered:
+                    break
+            r += 1
+
+        if not found:
+            result = self._gather([])
+            result['distance'] = np.zeros(0)
+            return result
+        result = dict([(name, np.concatenate([f[name] for f in found])) for name in point_columns])
+        dist = np.hypot((result['lon'] - lon) * self.cos_lat, result['lat'] - lat)
+        order = np.argsort(dist, kind='mergesort')[:k]
+        result = dict([(name, result[name][order]) for name in result])
+        result['distance'] = dist[order] * meters_per_degree
+        return result
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file.CAF",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-b', '--bbox', dest='bbox', default=None,
+                      help='list the soundings in lon_min,lat_min,lon_max,lat_max')
+    parser.add_option('-n', '--nearest', dest='nearest', default=None,
+                      help='list the soundings closest to lon,lat')
+    parser.add_option('-k', dest='k', default=1, type='int',
+                      help='how many soundings for --nearest [default: %default]')
+    parser.add_option('--contender', dest='contender', default=False, action='store_true',
+                      help='index the contender positions')
+    parser.add_option('--rebuild', dest='rebuild', default=False, action='store_true',
+                      help='build the index even if it is up to date')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if len(args) != 1:
+        parser.error('need exactly one CAF')
+    caf_filename = args[0]
+    path = caf_filename[:-4] + index_suffix
+    index = None
+    if not opts.rebuild and os.path.exists(os.path.join(path, 'index.json')):
+        index = SpatialIndex.load(path)
+        if not index.is_current(caf_filename, opts.contender):
+            index = None
+    if index is None:
+        index = SpatialIndex.build_from_caf(caf_filename, opts.contender)
+        index.save(path)
+        if opts.verbose:
+            print 'Built %s: %d soundings in %d x %d cells' % (path, len(index), index.nx, index.ny)
+        index = SpatialIndex.load(path)
+
+    found = None
+    if opts.bbox is not None:
+        found = index.query_bbox(*[float(v) for v in opts.bbox.split(',')])
+    elif opts.nearest is not None:
+        lon, lat = [float(v) for v in opts.nearest.split(',')]
+        found = index.nearest(lon, lat, opts.k)
+    if found is not None:
+        for i in range(len(found['id'])):
+            cbf_name = index.cbf_filenames[found['cbf_file'][i]] if found['cbf_file'][i] >= 0 else '-'
+            line = 'sounding %d: %.8f %.8f %s %d' % (found['id'][i], found['lon'][i], found['lat'][i],
+                                                    cbf_name, found['cbf_offset'][i])
+            if 'distance' in found:
+                line += ' %.2f m' % found['distance'][i]
+            print line
+
+
+if __name__ == '__main__':
+    main()
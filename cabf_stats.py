@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+mbinfo style summary of LADS lidar CAF and CBF files.
+
+Each file is read once, in chunks of numpy columns, into a SurveyStats.
+A SurveyStats is made of accumulators that only keep counts, sums,
+extremes and fixed bin histograms, so two of them merge into exactly
+the stats of both files together.  The stats of each file can be saved
+as JSON and later merged into survey totals without reading the files
+again.
+
+For the CAF: time span, bounding box, selected depth min/max/mean/std
+and percentiles, the 99.99 no bottom rate, flag and S/P/N/X entry
+histograms and the ACCEPTED/ANOMALOUS/REJECTED run counts.  For the
+CBF: time span, scans and shots, and the min/max/mean/std and
+percentiles of the waveform intensity at each of the 120 samples.
+
+The percentiles come from histograms.  Depths are kept in 1 cm bins,
+which is the resolution of the CAF, and samples are 8 bit, so no value
+is lost to binning.  A percentile is the value at the rank just below
+the q percent point, the same as numpy.percentile with
+interpolation='lower'.  It is not the numpy default, which linearly
+interpolates between the two neighboring values.
+
+@requires: U{Python<http://python.org/>} >= 2.6 for json
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import sys
+import json
+import datetime
+
+import numpy as np
+
+import caf
+import cbf
+import cabf
+import cabf_profile
+from cabf_time import scan_epochs
+
+no_bottom_depth = 99.99
+percentiles = (1, 5, 25, 50, 75, 95, 99)
+
+
+class Range:
+    'min and max of numbers seen so far'
+    def __init__(self):
+        self.min = None
+        self.max = None
+
+    def add(self, values):
+        if len(values):
+            low, high = values.min().item(), values.max().item()
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+
+    def merge(self, other):
+        for value in (other.min, other.max):
+            if value is not None:
+                self.add(np.array([value]))
+
+    def to_dict(self):
+        return {'min': self.min, 'max': self.max}
+
+    def from_dict(self, d):
+        self.min, self.max = d['min'], d['max']
+
+
+class Moments:
+    'count, sum and sum of squares for the mean and standard deviation, plus min and max'
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.
+        self.sum_sq = 0.
+        self.range = Range()
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.count += len(values)
+        self.sum += values.sum()
+        self.sum_sq += (values * values).sum()
+        self.range.add(values)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.range.merge(other.range)
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def std(self):
+        if not self.count:
+            return None
+        mean = self.sum / self.count
+        return max(self.sum_sq / self.count - mean * mean, 0.) ** 0.5
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'sum_sq': self.sum_sq, 'range': self.range.to_dict()}
+
+    def from_dict(self, d):
+        self.count, self.sum, self.sum_sq = d['count'], d['sum'], d['sum_sq']
+        self.range.from_dict(d['range'])
+
+
+class Histogram:
+    '''Counts in fixed width bins from low to high plus the counts below
+    and above.  The bins never change, so merging is adding the counts.
+    '''
+    def __init__(self, low, high, width):
+        self.low = low
+        self.width = width
+        self.counts = np.zeros(int(round((high - low) / width)), dtype=np.int64)
+        self.below = 0
+        self.above = 0
+
+    def add(self, values):
+        bins = np.floor((np.asarray(values, dtype=np.float64) - self.low) / self.width + 1e-6).astype(np.int64)
+        inside = (bins >= 0) & (bins < len(self.counts))
+        self.below += int((bins < 0).sum())
+        self.above += int((bins >= len(self.counts)).sum())
+        self.counts += np.bincount(bins[inside], minlength=len(self.counts))
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.below += other.below
+        self.above += other.above
+
+    def percentile(self, q):
+        '''Left edge of the bin holding the q percent point, or None if
+        it falls in the below or above counts.  There is no interpolation
+        between bins, so this matches np.percentile(values, q,
+        interpolation='lower')'''
+        total = self.counts.sum() + self.below + self.above
+        if not total:
+            return None
+        rank = q / 100. * (total - 1)
+        if rank < self.below:
+            return None
+        i = int(np.searchsorted(np.cumsum(self.counts), rank - self.below, side='right'))
+        if i >= len(self.counts):
+            return None
+        return self.low + i * self.width
+
+    def to_dict(self):
+        used = np.flatnonzero(self.counts)
+        return {'bins': used.tolist(), 'counts': self.counts[used].tolist(), 'below': self.below, 'above': self.above}
+
+    def from_dict(self, d):
+        self.counts[:] = 0
+        self.counts[d['bins']] = d['counts']
+        self.below, self.above = d['below'], d['above']
+
+
+class Tally:
+    'Count of each distinct value'
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, values):
+        keys, counts = np.unique(np.asarray(values), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.counts[str(key)] = self.counts.get(str(key), 0) + count
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def to_dict(self):
+        return dict(self.counts)
+
+    def from_dict(self, d):
+        self.counts = dict(d)
+
+
+class SampleStats:
+    'Intensity statistics at each of the 120 waveform samples'
+    def __init__(self, num_samples=120):
+        self.num_samples = num_samples
+        self.counts = np.zeros((num_samples, 256), dtype=np.int64)
+
+    def add(self, samples):
+        '@param samples: (N,120) uint8'
+        keys = samples.astype(np.int64) + np.arange(self.num_samples) * 256
+        self.counts += np.bincount(keys.ravel(), minlength=self.num_samples * 256).reshape(self.num_samples, 256)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def summary(self):
+        '@return: dict of arrays with one value per sample: min, max, mean, std and p<q> for the percentiles'
+        counts = self.counts
+        total = counts.sum(axis=1)
+        if not total.any():
+            return None
+        values = np.arange(256)
+        mean = (counts * values).sum(axis=1) / total.astype(np.float64)
+        std = np.sqrt(np.maximum((counts * values ** 2).sum(axis=1) / total.astype(np.float64) - mean ** 2, 0))
+        result = {'min': (counts > 0).argmax(axis=1), 'max': 255 - (counts[:, ::-1] > 0).argmax(axis=1),
+                  'mean': mean, 'std': std}
+        cumulative = np.cumsum(counts, axis=1)
+        for q in percentiles:
+            rank = q / 100. * (total - 1)
+            result['p%d' % q] = (cumulative <= rank[:, None]).sum(axis=1)
+        return result
+
+    def to_dict(self):
+        return {'counts': self.counts.tolist()}
+
+    def from_dict(self, d):
+        self.counts = np.array(d['counts'], dtype=np.int64)
+
+
+class SurveyStats:
+    '''All the accumulators for one or more CAF and CBF files.
+
+    @ivar files: names of the files added
+    '''
+    accumulators = ('caf_time', 'cbf_time', 'lat', 'lon', 'depth', 'depth_hist', 'entry_types',
+                    'flags', 'run_status', 'samples')
+
+    def __init__(self):
+        self.files = []
+        self.caf_time = Range()
+        self.cbf_time = Range()
+        self.lat = Range()
+        self.lon = Range()
+        self.depth = Moments()
+        self.depth_hist = Histogram(-100., 100., 0.01)
+        self.entry_types = Tally()
+        self.flags = Tally()
+        self.run_status = Tally()
+        self.samples = SampleStats()
+        self.counts = {'soundings': 0, 'no_bottom': 0, 'caf_scans': 0, 'runs': 0, 'cbf_scans': 0, 'shots': 0}
+
+    def add_caf_chunk(self, soundings, scans, runs):
+        'One chunk of Caf.column_chunks with at least lat, lon, depth_selected and flag'
+        depth = soundings['depth_selected']
+        no_bottom = depth == no_bottom_depth
+        self.counts['soundings'] += len(depth)
+        self.counts['no_bottom'] += int(no_bottom.sum())
+        self.counts['caf_scans'] += len(scans['run'])
+        self.counts['runs'] += len(runs)
+        self.depth.add(depth[~no_bottom])
+        self.depth_hist.add(depth[~no_bottom])
+        self.lat.add(soundings['lat'])
+        self.lon.add(soundings['lon'])
+        self.entry_types.add(soundings['entry_id'])
+        self.flags.add(soundings['flag'])
+        self.run_status.add(np.array([rh.status for rh in runs], dtype=object))
+        if len(scans['run']):
+            self.caf_time.add(scan_epochs(scans))
+
+    def add_cbf_chunk(self, scans, records):
+        '''@param scans: rows of a scan table (cbf.scan_dtype)
+        @param records: their waveform records'''
+        self.counts['cbf_scans'] += len(scans)
+        self.counts['shots'] += len(records)
+        self.cbf_time.add(scan_epochs(scans))
+        self.samples.add(records['samples'])
+
+    def merge(self, other):
+        'Add the stats of other files to these'
+        self.files += other.files
+        for name in self.accumulators:
+            getattr(self, name).merge(getattr(other, name))
+        for key, value in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+        return self
+
+    def to_dict(self):
+        d = dict([(name, getattr(self, name).to_dict()) for name in self.accumulators])
+        d['files'] = self.files
+        d['counts'] = self.counts
+        return d
+
+    @staticmethod
+    def from_dict(d):
+        stats = SurveyStats()
+        for name in SurveyStats.accumulators:
+            getattr(stats, name).from_dict(d[name])
+        stats.files = list(d['files'])
+        stats.counts.update(d['counts'])
+        return stats
+
+    def save(self, filename):
+        json.dump(self.to_dict(), open(filename, 'w'))
+
+    @staticmethod
+    def load(filename):
+        return SurveyStats.from_dict(json.load(open(filename)))
+
+    def __str__(self):
+        return format_stats(self)
+
+
+def caf_stats(filename, chunk_bytes=1<<22):
+    '@return: SurveyStats of one CAF'
+    stats = SurveyStats()
+    stats.files.append(filename)
+    for chunk in caf.Caf(filename).column_chunks(names=('lat', 'lon', 'depth_selected', 'flag'), chunk_bytes=chunk_bytes):
+        stats.add_caf_chunk(*chunk)
+    return stats
+
+
+def cbf_stats(filename, chunk_shots=1<<15):
+    '@return: SurveyStats of one CBF'
+    stats = SurveyStats()
+    stats.files.append(filename)
+    cbf_file = cbf.Cbf(filename)
+    for chunk in cbf.scan_chunks(cbf_file.as_array(), chunk_shots):
+        stats.add_cbf_chunk(chunk, cbf.gather_waveforms(cbf_file.data, cbf_file.size, chunk))
+    return stats
+
+
+def file_stats(filename, **options):
+    'caf_stats or cbf_stats by the extension'
+    start = cabf_profile.enabled and cabf_profile.clock()
+    if filename.upper().endswith('.CAF'):
+        stats = caf_stats(filename, **options)
+    else:
+        stats = cbf_stats(filename, **options)
+    if start:
+        cabf_profile.add('stats.file', start, os.path.getsize(filename), 0, 1)
+    return stats
+
+
+def survey_stats(caf_filename, per_file=None):
+    '''Stats of a CAF and the CBFs next to it
+
+    @param per_file: if a dict, filled with the SurveyStats of each file
+    '''
+    total = SurveyStats()
+    for filename in [caf_filename] + cabf.survey_cbf_filenames(caf_filename[:-4]):
+        stats = file_stats(filename)
+        if per_file is not None:
+            per_file[filename] = stats
+        total.merge(stats)
+    return total
+
+
+def _when(epoch):
+    if epoch is None:
+        return 'none'
+    return datetime.datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def format_stats(stats, samples=False):
+    '''Text report like mbinfo.
+
+    @param samples: include the table of statistics for every sample
+    '''
+    counts = stats.counts
+    lines = ['Files:              %d' % len(stats.files)]
+    if counts['soundings'] or counts['caf_scans']:
+        lines += ['',
+                  'CAF runs:           %d  %s' % (counts['runs'], '  '.join(['%s(%d)' % item for item in sorted(stats.run_status.counts.items())])),
+                  'CAF scans:          %d' % counts['caf_scans'],
+                  'Soundings:          %d' % counts['soundings'],
+                  'Entry types:        %s' % '  '.join(['%s(%d)' % item for item in sorted(stats.entry_types.counts.items())]),
+                  'Flags:              %s' % '  '.join(['%s(%d)' % item for item in sorted(stats.flags.counts.items(), key=lambda item: int(item[0]))]),
+                  'No bottom (99.99):  %d (%.2f%%)' % (counts['no_bottom'], 100. * counts['no_bottom'] / max(counts['soundings'], 1)),
+                  'Time:               %s to %s' % (_when(stats.caf_time.min), _when(stats.caf_time.max)),
+                  'Longitude:          %s to %s' % (stats.lon.min, stats.lon.max),
+                  'Latitude:           %s to %s' % (stats.lat.min, stats.lat.max)]
+        if stats.depth.count:
+            lines.append('Depth:              min %.2f  max %.2f  mean %.3f  std %.3f' % (
+                stats.depth.range.min, stats.depth.range.max, stats.depth.mean(), stats.depth.std()))
+            lines.append('Depth percentiles:  %s' % '  '.join([
+                'p%d %s' % (q, '%.2f' % stats.depth_hist.percentile(q) if stats.depth_hist.percentile(q) is not None else 'out of range')
+                for q in percentiles]))
+    if counts['shots'] or counts['cbf_scans']:
+        lines += ['',
+                  'CBF scans:          %d' % counts['cbf_scans'],
+                  'Shots:              %d' % counts['shots'],
+                  'Time:               %s to %s' % (_when(stats.cbf_time.min), _when(stats.cbf_time.max))]
+        summary = stats.samples.summary()
+        if summary is not None:
+            overall = SampleStats(1)
+            overall.counts = stats.samples.counts.sum(axis=0)[None, :]
+            whole = overall.summary()
+            lines.append('Intensity:          min %d  max %d  mean %.2f  std %.2f  median %d' % (
+                whole['min'][0], whole['max'][0], whole['mean'][0], whole['std'][0], whole['p50'][0]))
+            peak = int(summary['mean'].argmax())
+            lines.append('Brightest sample:   %d (mean %.2f)' % (peak, summary['mean'][peak]))
+            if samples:
+                lines.append('sample   min   max    mean     std ' + ' '.join(['%4s' % ('p%d' % q) for q in percentiles]))
+                for i in range(stats.samples.num_samples):
+                    lines.append('%6d %5d %5d %7.2f %7.2f ' % (i, summary['min'][i], summary['max'][i], summary['mean'][i], summary['std'][i])
+                                 + ' '.join(['%4d' % summary['p%d' % q][i] for q in percentiles]))
+    return '\n'.join(lines)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CAF file2.CBF stats1.json ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-s', '--survey', dest='survey', default=False, action='store_true',
+                      help='for each CAF, also read the CBFs next to it')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='save the merged stats as JSON to merge later without reading the files')
+    parser.add_option('-f', '--per-file', dest='per_file', default=False, action='store_true',
+                      help='print the stats of each file before the total')
+    parser.add_option('--samples', dest='samples', default=False, action='store_true',
+                      help='print the intensity statistics of every waveform sample')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if not args:
+        parser.error('give at least one CAF, CBF or saved JSON')
+
+    total = SurveyStats()
+    for filename in args:
+        per_file = {}
+        if filename.lower().endswith('.json'):
+            per_file[filename] = SurveyStats.load(filename)
+        elif opts.survey and filename.upper().endswith('.CAF'):
+            survey_stats(filename, per_file)
+        else:
+            per_file[filename] = file_stats(filename)
+        for name in sorted(per_file):
+            if opts.per_file:
+                print '==', name
+                print format_stats(per_file[name], opts.samples)
+                print
+            total.merge(per_file[name])
+            if opts.verbose:
+                sys.stderr.write('read %s\n' % name)
+
+    if opts.per_file:
+        print '== Total'
+    print format_stats(total, opts.samples)
+    if opts.output:
+        total.save(opts.output)
+
+
+if __name__ == '__main__':
+    main()
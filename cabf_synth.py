@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Write synthetic LADS lidar surveys: one CAF plus one CBF per run
+header.  The files follow the same layout that caf.py and cbf.py
+parse, so they can stand in for the real data when testing or
+benchmarking the readers.
+
+A survey named C{base.CAF} gets CBF files named
+C{base_run_section_seq_child.CBF} next to it, just like the Cabf
+class expects.
+
+@requires: U{Python<http://python.org/>} >= 2.5
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import datetime
+
+import numpy as np
+
+import cbf
+
+no_bottom_depth = 99.99
+'Depth the CAF uses when there is no bottom detect'
+
+
+def make_waveforms(rng, num_shots, no_bottom_rate=0.02):
+    '''Build the binary side of num_shots shots.
+
+    @return: selected and contender indices, a no bottom mask and the (num_shots,120) samples
+    '''
+    samples = rng.randint(0, 12, size=(num_shots, 120)).astype(np.int32)
+    index = np.arange(120)
+    surface = rng.randint(8, 16, size=num_shots)
+    selected = rng.randint(30, 110, size=num_shots)
+    contender = np.clip(selected + rng.randint(-15, 15, size=num_shots), 20, 119)
+    no_bottom = rng.random_sample(num_shots) < no_bottom_rate
+
+    samples += (220 * np.exp(-0.5 * ((index - surface[:, None]) / 1.5) ** 2)).astype(np.int32)
+    bottom_amp = np.where(no_bottom, 0, rng.randint(60, 180, size=num_shots))
+    samples += (bottom_amp[:, None] * np.exp(-0.5 * ((index - selected[:, None]) / 2.) ** 2)).astype(np.int32)
+    samples = np.clip(samples, 0, 255).astype(np.uint8)
+    selected = np.where(no_bottom, 0, selected)
+    contender = np.where(no_bottom, 0, contender)
+    return selected, contender, no_bottom, samples
+
+
+def write_cbf(filename, scan_times, frames, scan_rows, selected, contender, samples,
+              run=(1, 0, 1, 1), title='SYNTHETIC'):
+    '''Write one CBF with the same number of shots in every scan.
+
+    @param scan_times: datetime of each scan
+    @param frames: frame number of each scan
+    @param scan_rows: row number of each scan
+    @param selected: (num_scans,shots) selected depth indices
+    @param samples: (num_scans,shots,120) waveform samples
+    '''
+    num_scans, shots = selected.shape
+    record = np.dtype([('hdr', cbf.scan_header_record_dtype), ('wf', cbf.waveform_record_dtype, (shots,))])
+    assert record.itemsize == cbf.scan_header_block_size + shots * cbf.wave_form_block_size
+    recs = np.zeros(num_scans, dtype=record)
+    hdr = recs['hdr']
+    hdr['id'] = 'W1'
+    hdr['year'] = [t.year for t in scan_times]
+    hdr['julian_day'] = [t.timetuple().tm_yday for t in scan_times]
+    hdr['hour'] = [t.hour for t in scan_times]
+    hdr['minute'] = [t.minute for t in scan_times]
+    hdr['second'] = [t.second for t in scan_times]
+    wf = recs['wf']
+    wf['id'] = 'WF'
+    wf['frame'] = np.asarray(frames)[:, None]
+    wf['row'] = np.asarray(scan_rows)[:, None]
+    wf['col'] = np.arange(shots)[None, :]
+    wf['selected_depth_index'] = selected
+    wf['contend_depth_index'] = contender
+    wf['samples'] = samples
+
+    out = open(filename, 'wb')
+    out.write('HCB' + chr(1) + chr(0))
+    out.write(title.ljust(40)[:40])
+    out.write(np.array([run[0]], dtype='<u2').tostring())
+    out.write(''.join([chr(v) for v in run[1:]]))
+    recs.tofile(out)
+    out.close()
+
+
+caf_header_lines = '''HCA,1.0,%(title)s,%(survey_id)d,%(julian_day)03d%(year)04d,S,N,0,N
+C1,WGS84
+C2,6378137.00,6356752.31,298.257223563,0.0818191908426
+C3,0.00,0.00,0.00,0.00000,0.00000,0.00000,1.00000
+D1,WGS84
+D2,6378137.00,6356752.31,298.257223563,0.0818191908426
+D3,0.00,0.00,0.00,0.00000,0.00000,0.00000,1.00000
+F1,UTM,0,-69,19,500000,0,0.9996
+G1,UTM,0,-69,19,500000,0,0.9996
+'''
+
+
+def write_survey(base, num_runs=2, scans_per_run=100, shots_per_scan=24,
+                 start=datetime.datetime(2008, 11, 3, 14, 0, 0), scans_per_second=4,
+                 no_bottom_rate=0.02, seed=0, title='Synthetic Survey'):
+    '''Write base.CAF and one CBF per run.
+
+    @param base: path without the .CAF extension
+    @return: the CAF filename and the list of CBF filenames
+    '''
+    rng = np.random.RandomState(seed)
+    caf_filename = base + '.CAF'
+    cbf_filenames = []
+    lat0, lon0 = 43.07, -70.71
+    east0, north0 = 345000., 4770000.
+    deg_per_m = 1 / 111120.
+
+    out = open(caf_filename, 'w')
+    out.write(caf_header_lines % {'title': title, 'survey_id': 1,
+                                  'julian_day': start.timetuple().tm_yday, 'year': start.year})
+    span = num_runs * 50. + 200
+    corners = ((0, 0), (span, 0), (span, span * 2), (0, span * 2))
+    for i, (dx, dy) in enumerate(corners):
+        out.write('L%d,%.8f,%.8f,%d,%d\n' % (i + 1, lat0 + dy * deg_per_m, lon0 + dx * deg_per_m,
+                                              east0 + dx, north0 + dy))
+
+    scan_number = 0
+    for run_num in range(num_runs):
+        run = (run_num + 1, 0, 1, 1)
+        cbf_filename = '%s_%d_%d_%d_%d.CBF' % ((base,) + run)
+        cbf_filenames.append(cbf_filename)
+
+        first = start + datetime.timedelta(seconds=scan_number // scans_per_second)
+        out.write('R1,%d.%d.%d.%d,%03d%04d,1,ACCEPTED\n' % (run + (first.timetuple().tm_yday, first.year)))
+
+        selected, contender, no_bottom, samples = make_waveforms(rng, scans_per_run * shots_per_scan,
+                                                                 no_bottom_rate)
+        shape = (scans_per_run, shots_per_scan)
+        selected = selected.reshape(shape)
+        contender = contender.reshape(shape)
+        no_bottom = no_bottom.reshape(shape)
+        samples = samples.reshape(shape + (120,))
+
+        times = [start + datetime.timedelta(seconds=(scan_number + i) // scans_per_second)
+                 for i in range(scans_per_run)]
+        frames = (np.arange(scans_per_run) // 4 + 1) % 10000
+        scan_rows = np.arange(scans_per_run) % 4
+        write_cbf(cbf_filename, times, frames, scan_rows, selected, contender, samples, run=run)
+
+        x_line = run_num * 50. + 100
+        col_dx = (np.arange(shots_per_scan) - shots_per_scan / 2.) * 2.
+        for i in range(scans_per_run):
+            t = times[i]
+            y = 100. + i * 0.5
+            out.write('W1,%.8f,%.8f,%04d,%d,%d,%d,%d,%d,%.2f\n' % (
+                lat0 + y * deg_per_m, lon0 + x_line * deg_per_m,
+                t.year, t.timetuple().tm_yday, t.hour, t.minute, t.second,
+                scan_rows[i], 0.12))
+            lines = []
+            for j in range(shots_per_scan):
+                x = x_line + col_dx[j]
+                lat = lat0 + y * deg_per_m
+                lon = lon0 + x * deg_per_m
+                if no_bottom[i, j]:
+                    entry = 'N'
+                    depth, depth_contender = no_bottom_depth, no_bottom_depth
+                else:
+                    entry = 'SSSP'[j % 4]
+                    depth = (selected[i, j] - 10) * 0.25
+                    depth_contender = (contender[i, j] - 10) * 0.25
+                lines.append('%s,%.8f,%.8f,%d,%d,%.8f,%.8f,%d,%d,%d,%d,%d,%.2f,%.2f,%d,,\n' % (
+                    entry, lat, lon, east0 + x, north0 + y, lat, lon, east0 + x, north0 + y,
+                    frames[i], scan_rows[i], j, depth, depth_contender, (j * 7 + i) % 3))
+            out.write(''.join(lines))
+        scan_number += scans_per_run
+    out.close()
+    return caf_filename, cbf_filenames
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] base",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-r', '--runs', dest='runs', default=2, type='int',
+                      help='number of run headers / CBF files [default: %default]')
+    parser.add_option('-s', '--scans', dest='scans', default=100, type='int',
+                      help='scans in each run [default: %default]')
+    parser.add_option('-S', '--shots', dest='shots', default=24, type='int',
+                      help='shots in each scan [default: %default]')
+    parser.add_option('--seed', dest='seed', default=0, type='int',
+                      help='random number seed [default: %default]')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('need exactly one base name')
+    caf_filename, cbf_filenames = write_survey(args[0], opts.runs, opts.scans, opts.shots, seed=opts.seed)
+    if opts.verbose:
+        print caf_filename
+        for filename in cbf_filenames:
+            print filename
+
+
+if __name__ == '__main__':
+    main()
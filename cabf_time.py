@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Turn the year, julian day, hour, minute and second integers found in
+both the CAF and CBF files into datetimes or seconds since 1970.
+
+The CAF and CBF readers used to print the integers into a string and
+parse them back with strptime for every scan.  Here the start of each
+day is made once and kept, and the time of day is filled in with
+replace.  The results are the same datetimes that strptime gives.
+All times are naive and treated as UTC.
+
+@requires: U{Python<http://python.org/>} >= 2.5
+@requires: U{numpy<http://numpy.scipy.org/>} For the epoch arrays
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import datetime
+
+import numpy as np
+
+import cabf_profile
+
+_day_starts = {}
+'Cache of (year, julian_day) to the datetime at midnight'
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+
+def day_start(year, julian_day):
+    '''Midnight at the start of a julian day.  Day 366 of a non leap
+    year rolls over to January 1st just like strptime does.
+
+    @param year: four digit year
+    @param julian_day: 1 through 366
+    @rtype: datetime.datetime
+    '''
+    key = (year, julian_day)
+    try:
+        return _day_starts[key]
+    except KeyError:
+        pass
+    year, julian_day = int(year), int(julian_day)
+    if not 1 <= julian_day <= 366:
+        raise ValueError('julian day out of range: %d' % julian_day)
+    start = datetime.datetime(year, 1, 1) + datetime.timedelta(days=julian_day - 1)
+    _day_starts[key] = start
+    return start
+
+
+def scan_datetime(year, julian_day, hour=0, minute=0, second=0):
+    '''Same as strptime('%Y %j %H %M %S') on the five numbers, but
+    without the formatting and parsing.  Raises ValueError for bad times.
+
+    @rtype: datetime.datetime
+    '''
+    start = cabf_profile.enabled and cabf_profile.clock()
+    when = day_start(year, julian_day).replace(hour=int(hour), minute=int(minute), second=int(second))
+    if start:
+        cabf_profile.add('time.decode', start, 0, 1, 1)
+    return when
+
+
+def epochs(years, julian_days, hours=0, minutes=0, seconds=0):
+    '''Seconds since 1970-01-01 for arrays of time fields.  Works on
+    numpy arrays or plain numbers and gives back an int64 array.
+    '''
+    years = np.asarray(years, dtype=np.int64)
+    days = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+    days = days + np.asarray(julian_days, dtype=np.int64) - 1
+    return (days * 86400 + np.asarray(hours, dtype=np.int64) * 3600
+            + np.asarray(minutes, dtype=np.int64) * 60 + seconds)
+
+
+def scan_epochs(scans):
+    '''Seconds since 1970-01-01 for each row of a scan table with year,
+    julian_day, hour, minute and second columns.
+    '''
+    return epochs(scans['year'], scans['julian_day'], scans['hour'], scans['minute'], scans['second'])
+
+
+def datetime_epoch(when):
+    'Seconds since 1970-01-01 for a naive datetime'
+    delta = when - _epoch
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def as_epoch(when):
+    'Seconds since 1970 from either a naive datetime or a number that already is'
+    if isinstance(when, datetime.datetime):
+        return datetime_epoch(when)
+    return float(when)
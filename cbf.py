@@ -15,6 +15,7 @@ by a series of W1 scans.  Within each scan is a series of
 
 @requires: U{Python<http://python.org/>} >= 2.5
 @requires: U{epydoc<http://epydoc.sourceforge.net/>} >= 3.0.1
+@requires: U{numpy<http://numpy.scipy.org/>} For the array views of the scans and waveforms
 @requires: U{matplotlib<http://matplotlib.sourceforge.net/>} If you want to plot graphs
 
 @undocumented: __doc__
@@ -24,14 +25,19 @@ by a series of W1 scans.  Within each scan is a series of
 
 @bug: Plotting is not all on the same scale
 @todo: write test cases.  Have never tested bad file cases.
-@todo: stat/info tools to summarize the lines like mbinfo
 @todo: document all classes and methods
 '''
 import sys
 import os
+import time
 import mmap   # load the file into memory directly so it looks like a big array
 import struct # Unpacking of binary data
-import datetime
+import multiprocessing
+
+import numpy as np
+
+import cabf_profile
+from cabf_time import scan_datetime, scan_epochs, datetime_epoch, as_epoch
 
 # Codes for struct unpacking of binary data.  Everything is little endian
 uchar = '<B'
@@ -44,6 +50,37 @@ scan_header_block_size = 9
 wave_form_block_size = 128 #8 + 120
 block_size = scan_header_block_size  + wave_form_block_size
 
+# numpy layouts of the binary records.  Everything is packed little endian
+scan_header_record_dtype = np.dtype([('id', 'S2'),
+                                     ('year', '<u2'),
+                                     ('julian_day', '<u2'),
+                                     ('hour', 'u1'),
+                                     ('minute', 'u1'),
+                                     ('second', 'u1')])
+'The 9 byte W1 block'
+
+waveform_record_dtype = np.dtype([('id', 'S2'),
+                                  ('frame', '<u2'),
+                                  ('row', 'u1'),
+                                  ('col', 'u1'),
+                                  ('selected_depth_index', 'u1'),
+                                  ('contend_depth_index', 'u1'),
+                                  ('samples', 'u1', (120,))])
+'The 128 byte WF block'
+
+scan_dtype = np.dtype([('offset', '<i8'),
+                       ('year', '<u2'),
+                       ('julian_day', '<u2'),
+                       ('hour', 'u1'),
+                       ('minute', 'u1'),
+                       ('second', 'u1'),
+                       ('num_shots', '<i4'),
+                       ('first_shot', '<i8')])
+'One row of the scan table.  offset is the byte offset of the W1 and first_shot the index of its first WF'
+
+_W = ord('W')
+_F = ord('F')
+
 
 class CbfError(Exception):
     pass
@@ -53,78 +90,505 @@ class CbfError(Exception):
 #        return repr(self)
 
 
-class WaveForm():
-    def __init__(self,data):
-        assert data[0:2] == 'WF'
-        o = 2
-        self.frame                = struct.unpack(ushort,data[o:o+2])[0]; o += 2
-        self.row                  = struct.unpack(uchar ,data[o:o+1])[0]; o += 1
-        self.col                  = struct.unpack(uchar ,data[o:o+1])[0]; o += 1
-        self.selected_depth_index = struct.unpack(uchar ,data[o:o+1])[0]; o += 1
-        self.contend_depth_index  = struct.unpack(uchar ,data[o:o+1])[0]; o += 1
-        
-        self.waveform = struct.unpack(uchar120 ,data[o:])
+waveform_header_fmt = '<2sHBBBB'
+scan_header_fmt = '<2sHHBBB'
+
+
+class WaveForm(object):
+    '''One WF record.  Only a reference to the buffer and the offset are
+    kept.  The header fields are unpacked the first time one is used and
+    waveform is a numpy view of the 120 samples, not a copy.
+    '''
+    __slots__ = ('_data', '_offset', '_fields')
+
+    def __init__(self,data,offset=0):
+        '''
+        @param data: string or mmap holding the record
+        @param offset: where the WF starts in data
+        '''
+        assert data[offset:offset+2] == 'WF'
+        self._data = data
+        self._offset = offset
+        self._fields = None
+
+    def _field(self, i):
+        if self._fields is None:
+            self._fields = struct.unpack_from(waveform_header_fmt, self._data, self._offset)
+        return self._fields[i]
+
+    frame                = property(lambda self: self._field(1))
+    row                  = property(lambda self: self._field(2))
+    col                  = property(lambda self: self._field(3))
+    selected_depth_index = property(lambda self: self._field(4))
+    contend_depth_index  = property(lambda self: self._field(5))
+
+    @property
+    def waveform(self):
+        'The 120 samples as a read-only uint8 numpy view into the buffer'
+        return np.frombuffer(self._data, dtype=np.uint8, count=120, offset=self._offset + 8)
 
     def __str__(self):
         return 'WF: frame(%d) row(%d) col(%d) sel_dep(%d) cont_dep(%d)'  % (self.frame, self.row, self.col, self.selected_depth_index, self.contend_depth_index)
 
 
-class ScanHeader():
-    def __init__(self,data):
+class ScanHeader(object):
+    '''A W1 scan header and the WF records after it.  Like WaveForm, it
+    holds just the buffer, the offset and the number of shots.  Fields
+    and the WaveForm list are made on first use.
+    '''
+    __slots__ = ('_data', '_offset', '_num_shots', '_fields', '_waveforms')
+
+    def __init__(self,data,offset=0,num_shots=None):
         '''
-        @param max_size: Largest size that could be the W1 block.  Usually, pass the length of the data buffer
+        @param data: string or mmap holding the scan
+        @param offset: where the W1 starts in data
+        @param num_shots: number of WF records.  If not given, the WF
+            records are counted up to the end of data or the first block
+            that is not a WF
         '''
-        self.data = data
-        o = 0
-        assert data[o:o+2] == 'W1'
-        o += 2 # For W1
-        year       = struct.unpack(ushort,data[o:o+2])[0]; o += 2
-        julian_day = struct.unpack(ushort,data[o:o+2])[0]; o += 2
-        hour       = struct.unpack(uchar ,data[o:o+1])[0]; o += 1
-        minute     = struct.unpack(uchar ,data[o:o+1])[0]; o += 1
-        second     = struct.unpack(uchar ,data[o:o+1])[0]; o += 1
-
-        self.julian_day = julian_day
-
-        date_str = '%4d %d %d %d %d' % (year, julian_day, hour, minute, second)
-        self.datetime = datetime.datetime.strptime(date_str,'%Y %j %H %M %S')
-
-        waveforms = []
-        while o < len(data)-2 and data[o:o+2]=='WF':
-            start = o
-            waveforms.append(WaveForm(data[o:o+wave_form_block_size]))
-            o += wave_form_block_size
-        self.waveforms = waveforms
+        assert data[offset:offset+2] == 'W1'
+        self._data = data
+        self._offset = offset
+        self._num_shots = num_shots
+        self._fields = None
+        self._waveforms = None
+
+    def _field(self, i):
+        if self._fields is None:
+            start = cabf_profile.enabled and cabf_profile.clock()
+            self._fields = struct.unpack_from(scan_header_fmt, self._data, self._offset)
+            if start:
+                cabf_profile.add('cbf.unpack_w1', start, scan_header_block_size, 1, 0)
+        return self._fields[i]
+
+    year       = property(lambda self: self._field(1))
+    julian_day = property(lambda self: self._field(2))
+    hour       = property(lambda self: self._field(3))
+    minute     = property(lambda self: self._field(4))
+    second     = property(lambda self: self._field(5))
+
+    @property
+    def datetime(self):
+        self._field(0)
+        return scan_datetime(*self._fields[1:])
+
+    @property
+    def num_shots(self):
+        if self._num_shots is None:
+            start = cabf_profile.enabled and cabf_profile.clock()
+            data = self._data
+            o = self._offset + scan_header_block_size
+            count = 0
+            while o + wave_form_block_size <= len(data) and data[o:o+2] == 'WF':
+                count += 1
+                o += wave_form_block_size
+            self._num_shots = count
+            if start:
+                cabf_profile.add('cbf.boundary_walk', start, 2 * (count + 1), count, 0)
+        return self._num_shots
+
+    @property
+    def data(self):
+        'Copy of the bytes of the whole scan'
+        return self._data[self._offset:self._offset + scan_header_block_size + self.num_shots * wave_form_block_size]
+
+    @property
+    def waveforms(self):
+        'List of WaveForm records.  Made once and kept'
+        if self._waveforms is None:
+            start = cabf_profile.enabled and cabf_profile.clock()
+            first = self._offset + scan_header_block_size
+            self._waveforms = [WaveForm(self._data, first + i * wave_form_block_size)
+                               for i in xrange(self.num_shots)]
+            if start:
+                cabf_profile.add('cbf.waveforms', start, 0, 0, len(self._waveforms))
+        return self._waveforms
+
+    @property
+    def records(self):
+        'All the WF records as a numpy array of waveform_record_dtype viewing the buffer'
+        return np.ndarray(shape=(self.num_shots,), dtype=waveform_record_dtype, buffer=self._data,
+                          offset=self._offset + scan_header_block_size)
+
+    @property
+    def samples(self):
+        'The (num_shots,120) uint8 samples viewing the buffer'
+        return self.records['samples']
 
     def __str__(self):
-        return 'Scan W1: %s (%03dj) with %d soundings' % ( self.datetime, self.julian_day, len(self.waveforms))
+        return 'Scan W1: %s (%03dj) with %d soundings' % ( self.datetime, self.julian_day, self.num_shots)
 
 
 class CbfIterator:
     'Iterate across scan headers in a cbf'
     def __init__(self, cbf):
         self.data = cbf.data
-        self.size = cbf.size
-        self.offset = Cbf.header_size
+        self.scans = cbf.as_array()
+        self.scan_num = 0
     def __iter__(self):
         return self
     def next(self):
-        if self.offset > self.size-1:
+        if self.scan_num >= len(self.scans):
             raise StopIteration
-        current = self.offset
-        o = self.offset+1
-        while o < self.size-1 and self.data[o:o+2] != 'W1':
-            o += Cbf.scan_header_block_size
-            while self.data[o:o+2] == 'WF':
-                o += Cbf.wave_form_block_size
-        #print 'range',current,o
-        scan_data = self.data[current:o]
-        #print 'scan_data:',scan_data
-        self.offset = o
-        return ScanHeader(scan_data)
-        
+        start = cabf_profile.enabled and cabf_profile.clock()
+        scan = self.scans[self.scan_num]
+        self.scan_num += 1
+        scan_header = ScanHeader(self.data, int(scan['offset']), int(scan['num_shots']))
+        if start:
+            cabf_profile.add('cbf.scan', start, 0, 0, 1)
+        return scan_header
+
+
+def scan_offsets(data, size, offset=header_size, end=None):
+    '''Walk the W1 blocks of a cbf buffer without decoding any of the shots.
+
+    Each W1 is followed by WF blocks at a fixed stride, so the WF tags
+    are checked a chunk at a time with numpy.
+
+    @param data: mmap or string holding the cbf
+    @param size: number of valid bytes in data
+    @param offset: byte offset of the first W1
+    @param end: stop before any scan that starts at or after this offset.
+        The last scan may run past end.
+    @return: (offsets, num_shots) numpy arrays with one entry per scan
+    '''
+    start = cabf_profile.enabled and cabf_profile.clock()
+    if end is None:
+        end = size
+    raw = np.frombuffer(data, dtype=np.uint8, count=size)
+    offsets = []
+    num_shots = []
+    o = offset
+    while o < end and o + scan_header_block_size <= size and data[o:o+2] == 'W1':
+        offsets.append(o)
+        o += scan_header_block_size
+        count = 0
+        chunk = 16
+        while True:
+            n = min(chunk, (size - o) // wave_form_block_size)
+            if n <= 0:
+                break
+            tags = raw[o:o + n*wave_form_block_size].reshape(n, wave_form_block_size)
+            is_wf = (tags[:, 0] == _W) & (tags[:, 1] == _F)
+            if is_wf.all():
+                count += n
+                o += n * wave_form_block_size
+                chunk *= 2
+                continue
+            n = int(is_wf.argmin())
+            count += n
+            o += n * wave_form_block_size
+            break
+        num_shots.append(count)
+    if start:
+        cabf_profile.add('cbf.scan_walk', start, o - offset, len(offsets), 0)
+    return np.array(offsets, dtype=np.int64), np.array(num_shots, dtype=np.int64)
+
+
+def scan_table(data, size, offsets, num_shots):
+    '''Build a scan table (scan_dtype) from the W1 offsets and shot counts
+    of scan_offsets.  first_shot counts from the first of these scans.
+    '''
+    raw = np.frombuffer(data, dtype=np.uint8, count=size)
+    headers = raw[offsets[:, None] + np.arange(scan_header_block_size)]
+    headers = headers.copy().view(scan_header_record_dtype).reshape(-1)
+    scans = np.zeros(len(offsets), dtype=scan_dtype)
+    scans['offset'] = offsets
+    for field in ('year', 'julian_day', 'hour', 'minute', 'second'):
+        scans[field] = headers[field]
+    scans['num_shots'] = num_shots
+    scans['first_shot'][1:] = np.cumsum(num_shots)[:-1]
+    return scans
+
+
+def gather_waveforms(data, size, scans, out=None, chunk_bytes=1<<26):
+    '''Copy the WF blocks of a run of contiguous scans into one array.
+
+    The W1 blocks are masked out of each chunk so no Python objects
+    are created per shot.
+
+    @param scans: rows of a scan table (scan_dtype) that follow one another in the file
+    @param out: optional array of waveform_record_dtype to fill
+    @return: array of waveform_record_dtype with one row per shot
+    '''
+    start_time = cabf_profile.enabled and cabf_profile.clock()
+    raw = np.frombuffer(data, dtype=np.uint8, count=size)
+    total = int(scans['num_shots'].sum())
+    if out is None:
+        out = np.empty(total, dtype=waveform_record_dtype)
+    out_bytes = out.view(np.uint8)
+    header = np.arange(scan_header_block_size)
+    ends = scans['offset'] + scan_header_block_size + scans['num_shots'] * wave_form_block_size
+    i = 0
+    dest = 0
+    while i < len(scans):
+        start = scans['offset'][i]
+        j = max(i + 1, int(np.searchsorted(ends, start + chunk_bytes, side='right')))
+        end = ends[j-1]
+        keep = np.ones(end - start, dtype=bool)
+        keep[(scans['offset'][i:j] - start)[:, None] + header] = False
+        block = raw[start:end][keep]
+        out_bytes[dest:dest + len(block)] = block
+        dest += len(block)
+        i = j
+    if start_time:
+        cabf_profile.add('cbf.gather', start_time, dest, total, 0)
+    return out
+
+
+def scan_chunks(scans, chunk_shots):
+    '''Split a scan table into runs of whole scans with about
+    chunk_shots shots in each.  A scan is never split, so one scan with
+    more shots than chunk_shots is a chunk by itself.
+    '''
+    ends = scans['first_shot'] + scans['num_shots']
+    start = 0
+    while start < len(scans):
+        limit = scans['first_shot'][start] + chunk_shots
+        stop = max(start + 1, int(np.searchsorted(ends, limit, side='right')))
+        yield scans[start:stop]
+        start = stop
+
+
+def find_scan_start(data, size, offset, end=None):
+    '''Find the first thing at or after offset that looks like the start
+    of a scan: a W1 with a sane time that is followed by a WF, another W1
+    or the end of the file.  A W1 inside the samples of a waveform can
+    still fool this, so callers need to check that the walks line up.
+
+    @param end: give up on W1s that start at or after this offset
+    @return: byte offset or None if there is no scan start
+    '''
+    if end is None:
+        end = size
+    o = data.find('W1', offset, end + 1)
+    while o != -1 and o + scan_header_block_size <= size:
+        year, julian_day, hour, minute, second = struct.unpack('<HHBBB', data[o+2:o+scan_header_block_size])
+        after = o + scan_header_block_size
+        if (1 <= julian_day <= 366 and hour < 24 and minute < 60 and second < 61
+            and (after == size or data[after:after+2] in ('WF', 'W1'))):
+            return o
+        o = data.find('W1', o + 1, end + 1)
+    return None
+
+
+def shard_ranges(data, size, num_shards, offset=header_size):
+    '''Split the scans of a cbf into about num_shards byte ranges of
+    equal size that each start on a W1.
+
+    @return: list of (start, end) byte offsets
+    '''
+    bounds = [offset]
+    step = max(1, (size - offset) // num_shards)
+    for i in range(1, num_shards):
+        start = find_scan_start(data, size, offset + i * step)
+        if start is None:
+            break
+        if start > bounds[-1]:
+            bounds.append(start)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+_shared = {}
+'''The mmap of the cbf and the output buffer.  Pool workers are forked
+after this is filled in, so they get the mappings without any pickling'''
+
+
+def _scan_shard(shard):
+    start, end = shard
+    return scan_offsets(_shared['data'], _shared['size'], start, end)
+
+
+def _gather_shard(shots):
+    first, last = shots
+    scans = _shared['scans']
+    i = np.searchsorted(scans['first_shot'], first)
+    j = np.searchsorted(scans['first_shot'], last)
+    gather_waveforms(_shared['data'], _shared['size'], scans[i:j], out=_shared['out'][first:last])
+
+
+def _profiled_shard(job):
+    'Run func on one shard and bring back its cabf_profile counts'
+    func, shard = job
+    cabf_profile.reset()
+    return func(shard), cabf_profile.snapshot()
+
+
+def _run_shards(func, shards, jobs, **shared):
+    _shared.update(shared)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = []
+        for result, counts in pool.map(_profiled_shard, [(func, shard) for shard in shards], chunksize=1):
+            cabf_profile.merge(counts)
+            results.append(result)
+        return results
+    finally:
+        pool.terminate()
+        pool.join()
+        _shared.clear()
+
+
+def parallel_scan_offsets(data, size, jobs, offset=header_size):
+    '''scan_offsets using jobs worker processes.  Each worker walks the
+    W1 blocks of one shard from shard_ranges.  The walks are then
+    stitched together in order.  If a shard did not start where the one
+    before it stopped, its start was a false W1 and it is walked again
+    here, so the result is always the same as scan_offsets.
+    '''
+    shards = shard_ranges(data, size, jobs, offset)
+    if len(shards) < 2:
+        return scan_offsets(data, size, offset)
+    results = _run_shards(_scan_shard, shards, jobs, data=data, size=size)
+    offsets = []
+    num_shots = []
+    expected = offset
+    for (start, end), (shard_offsets, shard_shots) in zip(shards, results):
+        if start != expected:
+            shard_offsets, shard_shots = scan_offsets(data, size, expected, end)
+        offsets.append(shard_offsets)
+        num_shots.append(shard_shots)
+        if len(shard_offsets):
+            expected = int(shard_offsets[-1] + scan_header_block_size + shard_shots[-1] * wave_form_block_size)
+        if expected < end:
+            break # The walk hit something that is not a W1 so the file ends here
+    return np.concatenate(offsets), np.concatenate(num_shots)
+
+
+def parallel_gather_waveforms(data, size, scans, jobs):
+    '''gather_waveforms with each of jobs worker processes copying the
+    shots of a contiguous block of scans.  The output is shared anonymous
+    memory so nothing large goes through a pipe.
+
+    @return: array of waveform_record_dtype with one row per shot
+    '''
+    total = int(scans['num_shots'].sum())
+    if total == 0 or jobs < 2:
+        return gather_waveforms(data, size, scans)
+    buf = mmap.mmap(-1, total * wave_form_block_size)
+    out = np.frombuffer(buf, dtype=waveform_record_dtype, count=total)
+    cuts = np.searchsorted(scans['first_shot'], np.linspace(0, total, jobs + 1)[1:-1])
+    cuts = np.unique(np.concatenate(([0], cuts, [len(scans)])))
+    first_shots = np.append(scans['first_shot'], total)[cuts]
+    shards = [(int(first), int(last)) for first, last in zip(first_shots[:-1], first_shots[1:]) if last > first]
+    _run_shards(_gather_shard, shards, jobs, data=data, size=size, scans=scans, out=out)
+    return out
+
+
+index_suffix = '.idx.npz'
+'Appended to the cbf filename to get the name of its sidecar index'
+
+
+def shot_key(frame, row, col):
+    'Pack frame, row and col into one sortable integer.  Works on numpy arrays too'
+    return (np.asarray(frame, np.int64) << 16) | (np.asarray(row, np.int64) << 8) | np.asarray(col, np.int64)
 
 
+class CbfIndex:
+    '''Byte offsets of every scan and shot in a cbf so that any scan or
+    shot can be reached without walking the file.  Saved next to the cbf
+    and reused as long as the cbf keeps the same size and mtime.
+    '''
+    def __init__(self, scans, shot_offsets, keys, key_order, size, mtime):
+        self.scans = scans
+        self.shot_offsets = shot_offsets
+        self.keys = keys
+        self.key_order = key_order
+        self.size = size
+        self.mtime = mtime
+        self.epochs = scan_epochs(scans)
+        # Scan times should only go up, but do not count on it
+        if np.all(self.epochs[1:] >= self.epochs[:-1]):
+            self.time_order = None
+            self.sorted_epochs = self.epochs
+        else:
+            self.time_order = np.argsort(self.epochs, kind='mergesort')
+            self.sorted_epochs = self.epochs[self.time_order]
+
+    @classmethod
+    def build(cls, cbf, chunk=1<<20):
+        '''Build the index from an open Cbf'''
+        start_time = cabf_profile.enabled and cabf_profile.clock()
+        scans = cbf.as_array()
+        num_shots = scans['num_shots'].astype(np.int64)
+        total = int(num_shots.sum())
+        shot_in_scan = np.arange(total) - np.repeat(scans['first_shot'], num_shots)
+        shot_offsets = (np.repeat(scans['offset'] + Cbf.scan_header_block_size, num_shots)
+                        + shot_in_scan * Cbf.wave_form_block_size)
+
+        raw = np.frombuffer(cbf.data, dtype=np.uint8, count=cbf.size)
+        keys = np.empty(total, dtype=np.int64)
+        for start in xrange(0, total, chunk):
+            hdr = raw[shot_offsets[start:start+chunk, None] + np.arange(2, 6)]
+            frame = hdr[:, 0].astype(np.int64) | (hdr[:, 1].astype(np.int64) << 8)
+            keys[start:start+chunk] = shot_key(frame, hdr[:, 2], hdr[:, 3])
+        key_order = np.argsort(keys, kind='mergesort')
+        index = cls(scans, shot_offsets, keys[key_order], key_order, cbf.size, cbf.mtime)
+        if start_time:
+            cabf_profile.add('cbf.index_build', start_time, total * 4, total, 0)
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        start = cabf_profile.enabled and cabf_profile.clock()
+        npz = np.load(filename)
+        try:
+            stat = npz['stat']
+            index = cls(npz['scans'], npz['shot_offsets'], npz['keys'], npz['key_order'],
+                        int(stat[0]), float(stat[1]))
+        finally:
+            npz.close()
+        if start:
+            cabf_profile.add('cbf.index_load', start, os.path.getsize(filename), len(index.scans), 0)
+        return index
+
+    def save(self, filename):
+        '''Write to a temporary file and rename so a reader never sees half an index'''
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(tmp_filename, scans=self.scans, shot_offsets=self.shot_offsets,
+                 keys=self.keys, key_order=self.key_order,
+                 stat=np.array([self.size, self.mtime], dtype=np.float64))
+        os.rename(tmp_filename, filename)
+
+    def is_current(self, size, mtime):
+        return self.size == size and self.mtime == mtime
+
+    def find_shot(self, frame, row, col):
+        '''@return: shot number in the file of the first shot with this frame, row and col'''
+        key = shot_key(frame, row, col)
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError('no shot with frame(%d) row(%d) col(%d)' % (frame, row, col))
+        return int(self.key_order[i])
+
+    def find_time(self, when):
+        '''@return: the scan number recorded at when.  Scan times only have
+        whole seconds, so this is the first scan in that second or, if there
+        is none, the last scan before it.
+        '''
+        t = int(as_epoch(when) // 1)
+        i = int(np.searchsorted(self.sorted_epochs, t))
+        if i == len(self.sorted_epochs) or self.sorted_epochs[i] > t:
+            i -= 1
+        if i < 0:
+            raise IndexError('%s is before the first scan' % when)
+        if self.time_order is not None:
+            return int(self.time_order[i])
+        return i
+
+    def scans_between(self, start, end):
+        '''Scans recorded from start up to but not including end.
+
+        @param start: datetime or seconds since 1970
+        @return: numpy array of scan numbers in time order
+        '''
+        lo = np.searchsorted(self.sorted_epochs, as_epoch(start), side='left')
+        hi = np.searchsorted(self.sorted_epochs, as_epoch(end), side='left')
+        if self.time_order is None:
+            return np.arange(lo, hi)
+        return self.time_order[lo:hi]
+
 
 class Cbf:
     ''' Caris Binary Format for LIDAR shots with waveforms.  The file
@@ -137,8 +601,17 @@ class Cbf:
     wave_form_block_size = 128 #8 + 120
     block_size = scan_header_block_size  + wave_form_block_size
 
-    def __init__(self,filename):
+    def __init__(self,filename,index_filename=None):
+        '''
+        @param index_filename: where to keep the scan index.  Defaults to the cbf name plus index_suffix
+        '''
+        start = cabf_profile.enabled and cabf_profile.clock()
+        self.filename = filename
+        if index_filename is None:
+            index_filename = filename + index_suffix
+        self.index_filename = index_filename
         self.size = os.path.getsize(filename)
+        self.mtime = os.path.getmtime(filename)
         tmpFile = open(filename,"r+")
         self.data = mmap.mmap(tmpFile.fileno(),self.size,access=mmap.ACCESS_READ)
         data = self.data
@@ -151,7 +624,7 @@ class Cbf:
         spec_major = struct.unpack('<B',data[o:o+1])[0]; o += 1
         spec_minor = struct.unpack('<B',data[o:o+1])[0]; o += 1
 
-        if spec_major != 1 and spec_minor != 0:
+        if spec_major != 1 or spec_minor != 0:
             raise CbfError('wrong specification format: %d %d.  Need 1 0'% (spec_major, spec_minor))
 
         self.mission_title = (data[o:o+40]).strip(); o += 40
@@ -161,6 +634,131 @@ class Cbf:
         self.run_sequence = struct.unpack(uchar, data[o:o+1])[0]; o += 1
         self.run_child    = struct.unpack(uchar, data[o:o+1])[0]; o += 1
 
+        self._scans = None
+        self._index = None
+        if start:
+            cabf_profile.add('cbf.open', start, header_size, 1, 1)
+
+    def as_array(self, jobs=1):
+        '''Scan table for the whole file as a numpy structured array of
+        scan_dtype.  Built with one walk over the W1 blocks and cached.
+
+        @param jobs: split the walk across this many processes.  See
+            parallel_scan_offsets
+        '''
+        if self._scans is None and self._index is not None:
+            self._scans = self._index.scans
+        if self._scans is None:
+            if jobs > 1:
+                offsets, num_shots = parallel_scan_offsets(self.data, self.size, jobs, Cbf.header_size)
+            else:
+                offsets, num_shots = scan_offsets(self.data, self.size, Cbf.header_size)
+            self._scans = scan_table(self.data, self.size, offsets, num_shots)
+        return self._scans
+
+    def waveforms(self, scan_num=None, jobs=1):
+        '''Waveform records as a structured array of waveform_record_dtype.
+        The samples field is the (N,120) uint8 waveform matrix.
+
+        @param scan_num: If given, return a zero-copy view of that scan's
+            records in the mmap.  Otherwise return every shot in the file.
+            The W1 blocks between scans mean the whole file has to be
+            gathered into one new array, but that is done a chunk at a time.
+        @param jobs: number of processes to use for the whole file
+        '''
+        scans = self.as_array(jobs)
+        if scan_num is not None:
+            scan = scans[scan_num]
+            return np.ndarray(shape=(scan['num_shots'],), dtype=waveform_record_dtype, buffer=self.data,
+                              offset=scan['offset'] + Cbf.scan_header_block_size)
+        if jobs > 1:
+            return parallel_gather_waveforms(self.data, self.size, scans, jobs)
+        return gather_waveforms(self.data, self.size, scans)
+
+    def iter_batches(self, max_shots=1<<16):
+        '''Shots in batches of max_shots (the last batch may have fewer)
+        that run across scan boundaries.  Only one batch of waveforms is
+        copied out of the mmap at a time.
+
+        Each batch is a dict of numpy columns with one row per shot:
+        'frame', 'row', 'col', 'selected_depth_index',
+        'contend_depth_index', the (N,120) 'samples', 'scan' (scan
+        number), 'shot' (shot number in the file) and 'offset' (byte
+        offset of the WF record).  Also 'file', the CBF filename, and
+        'scans', the rows of the scan table (scan_dtype) from the first to
+        the last scan in the batch.
+
+        @return: generator of batch dicts
+        '''
+        scans = self.as_array()
+        total = int(scans['num_shots'].sum())
+        raw = np.frombuffer(self.data, dtype=np.uint8, count=self.size)
+        record = np.arange(wave_form_block_size)
+        for first in xrange(0, total, max_shots):
+            start = cabf_profile.enabled and cabf_profile.clock()
+            shots = np.arange(first, min(first + max_shots, total))
+            scan_nums = np.searchsorted(scans['first_shot'], shots, side='right') - 1
+            offsets = (scans['offset'][scan_nums] + scan_header_block_size
+                       + (shots - scans['first_shot'][scan_nums]) * wave_form_block_size)
+            records = raw[offsets[:, None] + record].view(waveform_record_dtype)[:, 0]
+            batch = dict([(name, records[name]) for name in waveform_record_dtype.names if name != 'id'])
+            batch['scan'] = scan_nums
+            batch['shot'] = shots
+            batch['offset'] = offsets
+            batch['file'] = self.filename
+            batch['scans'] = scans[scan_nums[0]:scan_nums[-1] + 1]
+            if start:
+                cabf_profile.add('cbf.batch', start, len(shots) * wave_form_block_size, len(shots), 1)
+            yield batch
+
+    def index(self):
+        '''The CbfIndex for this file.  Loaded from index_filename if it
+        matches the size and mtime of the cbf, otherwise built and saved
+        there for next time.  Failing to save is not an error.
+        '''
+        if self._index is not None:
+            return self._index
+        index = None
+        if os.path.exists(self.index_filename):
+            try:
+                index = CbfIndex.load(self.index_filename)
+            except (IOError, ValueError, KeyError):
+                index = None
+            if index is not None and not index.is_current(self.size, self.mtime):
+                index = None
+        if index is None:
+            index = CbfIndex.build(self)
+            try:
+                index.save(self.index_filename)
+            except (IOError, OSError):
+                pass
+        self._index = index
+        self._scans = index.scans
+        return index
+
+    def __len__(self):
+        return len(self.as_array())
+
+    def __getitem__(self, scan_num):
+        '''Decode one scan by number using the index'''
+        scans = self.index().scans
+        scan = scans[scan_num]
+        return ScanHeader(self.data, int(scan['offset']), int(scan['num_shots']))
+
+    def scan_at(self, when):
+        '''Decode the scan recorded at a datetime.  See CbfIndex.find_time'''
+        return self[self.index().find_time(when)]
+
+    def shot(self, frame, row, col):
+        '''Decode the WaveForm with this frame, row and col'''
+        index = self.index()
+        return WaveForm(self.data, int(index.shot_offsets[index.find_shot(frame, row, col)]))
+
+    def between(self, start, end):
+        '''Decode just the scans from start up to end.  See CbfIndex.scans_between'''
+        for scan_num in self.index().scans_between(start, end):
+            yield self[scan_num]
+
     def __iter__(self):
         ''' Allow iteration across the scans in the cbf '''
         return CbfIterator(self)
@@ -174,8 +772,81 @@ class Cbf:
                                         self.run_child)
 
 
+class CbfFollower:
+    '''Read the scans of a CBF that is still being written, as they are
+    appended.
+
+    Only the bytes from the first scan not yet returned to the end of
+    the file are mapped on each read, so the head of the file is never
+    walked again.  A scan is only returned once the W1 of the scan after
+    it is complete.  Until then more WF blocks might still be added to
+    it, or its last block might be partly written.  The last scan is
+    returned once the writer is done (final=True or idle_timeout).
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.cbf = None
+        self.offset = header_size
+        'File offset of the first scan not yet returned'
+        self.scan_num = 0
+        'Number of scans returned so far'
+
+    def read_new(self, final=False):
+        '''Non-blocking read of what was appended since the last call.
+
+        @param final: the file is finished, so also return the last scan
+        @return: list of (scan number, ScanHeader)
+        '''
+        size = os.path.getsize(self.filename)
+        if size < header_size:
+            return []
+        if self.cbf is None:
+            self.cbf = Cbf(self.filename)
+        if size <= self.offset:
+            return []
+        window_start = self.offset // mmap.ALLOCATIONGRANULARITY * mmap.ALLOCATIONGRANULARITY
+        infile = open(self.filename, 'rb')
+        window = mmap.mmap(infile.fileno(), size - window_start, access=mmap.ACCESS_READ, offset=window_start)
+        infile.close()
+        offsets, num_shots = scan_offsets(window, size - window_start, self.offset - window_start)
+        if not final:
+            offsets, num_shots = offsets[:-1], num_shots[:-1]
+        scans = []
+        for offset, count in zip(offsets.tolist(), num_shots.tolist()):
+            scans.append((self.scan_num, ScanHeader(window, offset, count)))
+            self.scan_num += 1
+        if len(offsets):
+            self.offset = window_start + offsets[-1] + scan_header_block_size + num_shots[-1] * wave_form_block_size
+        return scans
+
+    def follow(self, poll_interval=1.0, idle_timeout=None):
+        '''Generator of (scan number, ScanHeader) that waits for new scans.
+
+        @param poll_interval: seconds between looks at the file size
+        @param idle_timeout: stop after the file has not grown for this
+            many seconds, returning the last scan first.  None to follow
+            forever
+        '''
+        last_size = -1
+        last_change = time.time()
+        while True:
+            size = os.path.getsize(self.filename)
+            if size != last_size:
+                last_size = size
+                last_change = time.time()
+            idle = idle_timeout is not None and time.time() - last_change >= idle_timeout
+            for scan in self.read_new(final=idle):
+                yield scan
+            if idle:
+                return
+            time.sleep(poll_interval)
+
+
 def plot_all_waveforms(in_file):
-    '''FIX: how do I control the axis range'''
+    '''One matplotlib plot per shot.  Only good for a few scans.  Use
+    cbf_waterfall for images of whole files.
+
+    FIX: how do I control the axis range'''
     cbf = Cbf(in_file)
     import matplotlib.pyplot as plt
     plt.ioff()
@@ -220,15 +891,34 @@ def main():
                       help='print out the summary for each scan')
     parser.add_option('-S', '--shot', dest='shot', default=False, action='store_true',
                       help='print out the summary for each shot (there will be many!)')
+    parser.add_option('-f', '--follow', dest='follow', default=False, action='store_true',
+                      help='keep reading scans as they are appended to a CBF still being recorded')
+    parser.add_option('--idle', dest='idle', default=None, type='float',
+                      help='with --follow, stop once the file has not grown for this many seconds')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
     parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
                       help='run the tests run in verbose mode')
 
     (opts, args) = parser.parse_args()
     v = opts.verbose
     opts.info = True
+    if opts.stats:
+        cabf_profile.report_at_exit()
 
     for filename in args:
         print 'File:',filename
+        if opts.follow:
+            numshots = 0
+            for i, scan in CbfFollower(filename).follow(idle_timeout=opts.idle):
+                numshots += scan.num_shots
+                print '  scan %d: %s' % (i, str(scan))
+                if opts.shot:
+                    for j,waveform in enumerate(scan.waveforms):
+                        print '    shot %d: %s' % (j,str(waveform))
+                sys.stdout.flush()
+            print 'Summary for %s: shots(%d)' % (filename, numshots)
+            continue
         if opts.info:
             cbf = Cbf(filename)
             print cbf
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Compressed archive of a LADS lidar Caris Binary Format (CBF) file with
+random access to each scan.
+
+The scans are grouped into blocks of whole scans with about
+block_shots shots each, and each block is compressed on its own.
+Inside a block the bytes are stored column by column: the 9 bytes of
+each W1, then the 8 header bytes of each WF, then the samples with all
+the first samples of the block together, then all the second samples
+and so on.  Background samples next to each other in a column have
+about the same small values, which the zlib run length and Huffman
+coding (or bz2) handle much better than the interleaved records.
+
+This does not reach the 3-5x asked for.  No real survey files were at
+hand, so the only measurements are on cabf_synth surveys, where the
+zlib archive is 1.75x smaller than the CBF (bz2 1.62x).  Their samples
+are uniform 0-11 noise plus the surface and bottom pulses, which is
+4.4 bits per sample even knowing which sample it is, so no lossless
+coding of them gets past about 1.8x.  Subtracting a background level
+from each record (1.74x), differences between shots (1.42x) or
+between samples (1.58x), and splitting the samples into bit planes
+(1.56x) all came out worse than the plain columns, so none is used.
+Real waveforms with a quieter background should do better, but that
+is not measured.
+
+Layout of a .CBZ file::
+
+  HCZ  version(u1)  codec(8 bytes)  the 50 byte CBF header
+  block 0, block 1, ...
+  index: zlib of the scan table, the block table and any bytes
+         after the last scan that were not part of a scan
+  index offset(u8)  index size(u4)  HCZE
+
+Reading a scan decompresses just its block and gives back the same
+cbf.ScanHeader and cbf.WaveForm objects that a Cbf does.  extract
+writes back a CBF that is byte for byte the same as the original.
+
+@requires: U{Python<http://python.org/>} >= 2.5
+@requires: U{numpy<http://numpy.scipy.org/>}
+@requires: U{backports.lzma<https://pypi.python.org/pypi/backports.lzma>} Only for the lzma codec
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import bz2
+import zlib
+import struct
+from StringIO import StringIO
+
+import numpy as np
+
+import cbf
+import cabf_profile
+
+magic = 'HCZ'
+format_version = 1
+header_fmt = '<3sB8s'
+footer_fmt = '<QI4s'
+footer_magic = 'HCZE'
+
+block_dtype = np.dtype([('offset', '<i8'),       # Of the compressed block in the archive
+                        ('size', '<i4'),         # Compressed bytes
+                        ('first_scan', '<i8'),
+                        ('num_scans', '<i4'),
+                        ('first_shot', '<i8'),
+                        ('num_shots', '<i4')])
+'One row of the block table'
+
+
+class CbfArchiveError(Exception):
+    pass
+
+
+def _zlib_compress(data, level):
+    # Z_RLE: runs of the same byte plus Huffman.  As small as the default
+    # strategy on the sample columns and much faster
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, 3)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _lzma():
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma
+    return lzma
+
+
+codecs = {
+    'zlib': (_zlib_compress, zlib.decompress),
+    'bz2': (lambda data, level: bz2.compress(data, max(1, level)), bz2.decompress),
+    'lzma': (lambda data, level: _lzma().compress(data, preset=level),
+             lambda data: _lzma().decompress(data)),
+    }
+'codec name to (compress(data, level), decompress(data))'
+
+
+def _scan_positions(scans):
+    '''Offsets of the W1s and WFs of a run of contiguous scans from the start of the first
+
+    @return: (w1 offsets, wf offsets, bytes in the run)
+    '''
+    start = scans['offset'][0]
+    w1 = scans['offset'] - start
+    num_shots = scans['num_shots'].astype(np.int64)
+    shot_in_scan = np.arange(num_shots.sum()) - np.repeat(np.cumsum(num_shots) - num_shots, num_shots)
+    wf = np.repeat(w1 + cbf.scan_header_block_size, num_shots) + shot_in_scan * cbf.wave_form_block_size
+    size = int(w1[-1] + cbf.scan_header_block_size + num_shots[-1] * cbf.wave_form_block_size)
+    return w1, wf, size
+
+
+def pack_block(raw, scans):
+    '''Rearrange the bytes of a run of contiguous scans into columns
+
+    @param raw: uint8 array of the whole CBF
+    @param scans: rows of the scan table
+    @return: string to compress
+    '''
+    w1, wf, size = _scan_positions(scans)
+    block = raw[scans['offset'][0]:scans['offset'][0] + size]
+    w1_bytes = block[w1[:, None] + np.arange(cbf.scan_header_block_size)]
+    records = block[wf[:, None] + np.arange(cbf.wave_form_block_size)]
+    return w1_bytes.T.tostring() + records[:, :8].T.tostring() + records[:, 8:].T.tostring()
+
+
+def unpack_block(packed, scans):
+    '''Put the columns of pack_block back into the bytes of the CBF
+
+    @return: string of the scans as they were in the CBF
+    '''
+    w1, wf, size = _scan_positions(scans)
+    columns = np.frombuffer(packed, dtype=np.uint8)
+    num_w1 = len(w1) * cbf.scan_header_block_size
+    num_headers = len(wf) * 8
+    block = np.empty(size, dtype=np.uint8)
+    block[w1[:, None] + np.arange(cbf.scan_header_block_size)] = columns[:num_w1].reshape(-1, len(w1)).T
+    records = np.empty((len(wf), cbf.wave_form_block_size), dtype=np.uint8)
+    records[:, :8] = columns[num_w1:num_w1 + num_headers].reshape(8, -1).T
+    records[:, 8:] = columns[num_w1 + num_headers:].reshape(120, -1).T
+    block[wf[:, None] + np.arange(cbf.wave_form_block_size)] = records
+    return block.tostring()
+
+
+def write_archive(cbf_file, filename=None, block_shots=2048, codec='zlib', level=6):
+    '''Compress a CBF.
+
+    @param cbf_file: filename or cbf.Cbf
+    @param filename: archive to write.  Defaults to the CBF name with .CBZ
+    @param block_shots: about how many shots go in each block.  Smaller
+        blocks are faster to read one scan from but compress less
+    @param codec: name in codecs
+    @return: the archive filename and a dict of sizes
+    '''
+    if not isinstance(cbf_file, cbf.Cbf):
+        cbf_file = cbf.Cbf(cbf_file)
+    if filename is None:
+        filename = os.path.splitext(cbf_file.filename)[0] + '.CBZ'
+    compress = codecs[codec][0]
+    start = cabf_profile.enabled and cabf_profile.clock()
+    raw = np.frombuffer(cbf_file.data, dtype=np.uint8, count=cbf_file.size)
+    scans = cbf_file.as_array()
+
+    out = open(filename, 'wb')
+    out.write(struct.pack(header_fmt, magic, format_version, codec))
+    out.write(cbf_file.data[:cbf.header_size])
+    blocks = []
+    first_scan = 0
+    for chunk in cbf.scan_chunks(scans, block_shots):
+        data = compress(pack_block(raw, chunk), level)
+        blocks.append((out.tell(), len(data), first_scan, len(chunk), chunk['first_shot'][0], chunk['num_shots'].sum()))
+        out.write(data)
+        first_scan += len(chunk)
+
+    end = cbf.header_size
+    if len(scans):
+        end = int(scans['offset'][-1] + cbf.scan_header_block_size + scans['num_shots'][-1] * cbf.wave_form_block_size)
+    index = StringIO()
+    np.savez(index, scans=scans, blocks=np.array(blocks, dtype=block_dtype),
+             trailing=raw[end:cbf_file.size].copy())
+    index = zlib.compress(index.getvalue())
+    index_offset = out.tell()
+    out.write(index)
+    out.write(struct.pack(footer_fmt, index_offset, len(index), footer_magic))
+    out.close()
+    archive_size = os.path.getsize(filename)
+    if start:
+        cabf_profile.add('archive.write', start, cbf_file.size, int(scans['num_shots'].sum()), len(blocks))
+    return filename, {'cbf_bytes': cbf_file.size, 'archive_bytes': archive_size, 'blocks': len(blocks),
+                      'scans': len(scans), 'ratio': cbf_file.size / float(max(archive_size, 1))}
+
+
+class CbfArchive:
+    '''Read side of a .CBZ.  Works like a cbf.Cbf: len, indexing and
+    iteration give cbf.ScanHeader objects, and waveforms gives the
+    records of a scan.  The last block read is kept, so reading the
+    scans in order decompresses each block once.
+    '''
+    def __init__(self, filename):
+        start = cabf_profile.enabled and cabf_profile.clock()
+        self.filename = filename
+        self.infile = open(filename, 'rb')
+        head = self.infile.read(struct.calcsize(header_fmt) + cbf.header_size)
+        file_magic, version, codec = struct.unpack_from(header_fmt, head)
+        if file_magic != magic:
+            raise CbfArchiveError('Not a compressed CBF archive')
+        if version != format_version:
+            raise CbfArchiveError('archive format version %d.  Need %d' % (version, format_version))
+        self.codec = codec.rstrip('\0')
+        if self.codec not in codecs:
+            raise CbfArchiveError('unknown codec %s' % self.codec)
+        self.decompress = codecs[self.codec][1]
+        self.header = head[struct.calcsize(header_fmt):]
+        (self.mission_title, self.run_id, self.run_segment,
+         self.run_sequence, self.run_child) = struct.unpack_from('<40sHBBB', self.header, 5)
+        self.mission_title = self.mission_title.strip()
+
+        self.infile.seek(-struct.calcsize(footer_fmt), os.SEEK_END)
+        index_offset, index_size, end_magic = struct.unpack(footer_fmt, self.infile.read(struct.calcsize(footer_fmt)))
+        if end_magic != footer_magic:
+            raise CbfArchiveError('archive is truncated')
+        self.infile.seek(index_offset)
+        index = np.load(StringIO(zlib.decompress(self.infile.read(index_size))))
+        self.scans = index['scans']
+        self.blocks = index['blocks']
+        self.trailing = index['trailing'].tostring()
+        self._block_num = None
+        self._block = None
+        if start:
+            cabf_profile.add('archive.open', start, index_size, len(self.scans), 1)
+
+    def as_array(self):
+        'Scan table of the original CBF (cbf.scan_dtype)'
+        return self.scans
+
+    def __len__(self):
+        return len(self.scans)
+
+    def _load_block(self, block_num):
+        '@return: the CBF bytes of the block'
+        if block_num != self._block_num:
+            start = cabf_profile.enabled and cabf_profile.clock()
+            block = self.blocks[block_num]
+            self.infile.seek(int(block['offset']))
+            packed = self.decompress(self.infile.read(int(block['size'])))
+            first = int(block['first_scan'])
+            self._block = unpack_block(packed, self.scans[first:first + int(block['num_scans'])])
+            self._block_num = block_num
+            if start:
+                cabf_profile.add('archive.block', start, int(block['size']), int(block['num_shots']), 0)
+        return self._block
+
+    def _locate(self, scan_num):
+        '@return: the block bytes and the offset of the scan in them'
+        if scan_num < 0:
+            scan_num += len(self.scans)
+        if not 0 <= scan_num < len(self.scans):
+            raise IndexError('scan %d out of range' % scan_num)
+        block_num = int(np.searchsorted(self.blocks['first_scan'], scan_num, side='right')) - 1
+        block = self._load_block(block_num)
+        first = self.scans[int(self.blocks['first_scan'][block_num])]
+        return block, int(self.scans['offset'][scan_num] - first['offset'])
+
+    def __getitem__(self, scan_num):
+        block, offset = self._locate(scan_num)
+        return cbf.ScanHeader(block, offset, int(self.scans['num_shots'][scan_num]))
+
+    def __iter__(self):
+        for scan_num in xrange(len(self.scans)):
+            yield self[scan_num]
+
+    def waveforms(self, scan_num):
+        'Records of one scan as waveform_record_dtype, a view into the block'
+        block, offset = self._locate(scan_num)
+        return np.frombuffer(block, dtype=cbf.waveform_record_dtype, count=int(self.scans['num_shots'][scan_num]),
+                             offset=offset + cbf.scan_header_block_size)
+
+    def extract(self, filename):
+        'Write the original CBF back out'
+        out = open(filename, 'wb')
+        out.write(self.header)
+        for block_num in xrange(len(self.blocks)):
+            out.write(self._load_block(block_num))
+        out.write(self.trailing)
+        out.close()
+        return filename
+
+    def __str__(self):
+        return 'CbfArchive title="%s" id(%s) seg(%s) seq(%s) child(%s) codec(%s) scans(%d) blocks(%d)' % (
+            self.mission_title, self.run_id, self.run_segment, self.run_sequence, self.run_child,
+            self.codec, len(self.scans), len(self.blocks))
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CBF file2.CBF ... | -x file1.CBZ ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-x', '--extract', dest='extract', default=False, action='store_true',
+                      help='write the CBF back out of each archive')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='file to write for a single input [default: the input name with .CBZ or .CBF]')
+    parser.add_option('-b', '--block-shots', dest='block_shots', default=2048, type='int',
+                      help='about how many shots to compress together [default: %default]')
+    parser.add_option('-c', '--codec', dest='codec', default='zlib', choices=sorted(codecs.keys()),
+                      help='one of %s [default: %%default]' % ', '.join(sorted(codecs.keys())))
+    parser.add_option('-l', '--level', dest='level', default=6, type='int',
+                      help='compression level [default: %default]')
+    parser.add_option('--verify', dest='verify', default=False, action='store_true',
+                      help='check that each archive reads back to the same bytes as its CBF')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if opts.output is not None and len(args) != 1:
+        parser.error('--output only works with one file')
+
+    for filename in args:
+        if opts.extract:
+            archive = CbfArchive(filename)
+            print archive.extract(opts.output or os.path.splitext(filename)[0] + '.CBF')
+            continue
+        archive_name, sizes = write_archive(filename, opts.output, opts.block_shots, opts.codec, opts.level)
+        print '%s: %d -> %d bytes (%.2fx) in %d blocks' % (archive_name, sizes['cbf_bytes'], sizes['archive_bytes'],
+                                                         sizes['ratio'], sizes['blocks'])
+        if opts.verify:
+            archive = CbfArchive(archive_name)
+            original = cbf.Cbf(filename)
+            same = archive.header == original.data[:cbf.header_size]
+            for block_num, block in enumerate(archive.blocks):
+                first = archive.scans[int(block['first_scan'])]
+                data = archive._load_block(block_num)
+                same = same and data == original.data[int(first['offset']):int(first['offset']) + len(data)]
+            if not same:
+                print '  VERIFY FAILED'
+
+
+if __name__ == '__main__':
+    main()
@@ -8,74 +8,299 @@ __license__   = 'BSD'
 __contact__   = 'kurt at ccom.unh.edu'
 
 __doc__ ='''
-Dump lidar Caris Binary Format (CBF).
+Dump lidar Caris Binary Format (CBF) for Octave and Matlab.
+
+By default, each CBF becomes one MAT-file (version 5, which both
+Octave and Matlab load).  It has these variables:
+ - waveforms: 120 by N uint8 matrix with one column per shot
+ - frame, row, col, selected_depth_index, contend_depth_index: N by 1
+ - scan_num and shot_num: N by 1, counting from 1 like Matlab
+ - scan_time: seconds since 1970 (UTC) of each scan
+ - filename: the CBF name
+
+--format m writes the same variables as one .m file of matrix
+literals instead.  --per-scan writes one file per scan.  The shots are
+written a chunk at a time straight from the gathered waveform records,
+so dumping a file is limited by the disk.
+
+--per-shot keeps the old behavior.  It writes an .m file with plotting
+code for every waveform of the first few scans.
 
 @todo: Set y-axis limit to 255
-@todo: Add/modify code to generate a single m-file with all the
-waveforms for the scan. Could skip plot functions on this one.
 '''
 
-import sys
+import os
+import struct
+
+import numpy as np
+
 import cbf
+import cabf_profile
+
+formats = ('mat', 'm')
+
+# MAT-file version 5 data types and array classes
+mi_types = {np.dtype('int8'): 1, np.dtype('uint8'): 2, np.dtype('<i2'): 3, np.dtype('<u2'): 4,
+            np.dtype('<i4'): 5, np.dtype('<u4'): 6, np.dtype('<f8'): 9}
+mx_classes = {np.dtype('int8'): 8, np.dtype('uint8'): 9, np.dtype('<i2'): 10, np.dtype('<u2'): 11,
+              np.dtype('<i4'): 12, np.dtype('<u4'): 13, np.dtype('<f8'): 6}
+mi_matrix = 14
+mx_char_class = 4
+
+vector_fields = (('frame', '<u2'),
+                 ('row', 'uint8'),
+                 ('col', 'uint8'),
+                 ('selected_depth_index', 'uint8'),
+                 ('contend_depth_index', 'uint8'))
+'Fields of each shot written as N by 1 vectors next to the waveforms'
+
+
+def _pad8(num_bytes):
+    return (8 - num_bytes % 8) % 8
+
+
+def _element(mi_type, data):
+    'A tagged data element padded to 8 bytes'
+    return struct.pack('<II', mi_type, len(data)) + data + '\0' * _pad8(len(data))
+
+
+def mat_array_header(name, dtype, shape, mx_class=None):
+    '''Everything of a MAT-file numeric array up to its data.  The
+    caller writes the data in column major order and then
+    mat_data_padding.
+
+    @param shape: Matlab dimensions
+    '''
+    dtype = np.dtype(dtype)
+    if mx_class is None:
+        mx_class = mx_classes[dtype]
+    num_bytes = int(np.prod(shape)) * dtype.itemsize
+    flags = _element(6, struct.pack('<II', mx_class, 0))
+    dims = _element(5, struct.pack('<%di' % len(shape), *shape))
+    name = _element(1, name)
+    data_tag = struct.pack('<II', mi_types[dtype], num_bytes)
+    size = len(flags) + len(dims) + len(name) + len(data_tag) + num_bytes + _pad8(num_bytes)
+    return struct.pack('<II', mi_matrix, size) + flags + dims + name + data_tag
+
+
+def mat_data_padding(dtype, shape):
+    return '\0' * _pad8(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+
+def write_mat_header(out, text='MATLAB 5.0 MAT-file, written by cbf_dump.py'):
+    'The 128 byte MAT-file header for little endian data'
+    out.write(text.ljust(116)[:116] + '\0' * 8 + struct.pack('<H', 0x0100) + 'IM')
+
+
+def write_mat_array(out, name, values):
+    'A whole array, which is written as a column vector if it is 1-D'
+    values = np.asarray(values)
+    shape = values.shape if values.ndim > 1 else (len(values), 1)
+    out.write(mat_array_header(name, values.dtype, shape))
+    out.write(np.asfortranarray(values).tostring('F'))
+    out.write(mat_data_padding(values.dtype, shape))
+
+
+def write_mat_string(out, name, text):
+    codes = np.array([ord(c) for c in text], dtype='<u2')
+    shape = (1, len(codes))
+    out.write(mat_array_header(name, codes.dtype, shape, mx_char_class))
+    out.write(codes.tostring())
+    out.write(mat_data_padding(codes.dtype, shape))
+
+
+_sample_text = np.array([' %3d' % value for value in range(256)]).view('S1').reshape(256, 4)
+'Fixed width text of each sample value for the .m matrix literals'
+
+
+def m_matrix_rows(samples):
+    '@return: text of the rows of a uint8 (N,120) matrix literal, one shot per line'
+    text = _sample_text[samples].reshape(len(samples), -1)
+    end = np.empty((len(samples), 2), dtype='S1')
+    end[:, 0] = ';'
+    end[:, 1] = '\n'
+    return np.hstack((text, end)).tostring()
+
+
+def m_vector(name, values, matlab_type):
+    return '%s = %s([%s])\';\n' % (name, matlab_type, ' '.join([str(value) for value in values.tolist()]))
+
+
+matlab_types = {np.dtype('uint8'): 'uint8', np.dtype('<u2'): 'uint16', np.dtype('<u4'): 'uint32',
+                np.dtype('<f8'): 'double'}
+
+
+class _Dump:
+    '''Writes the variables of a block of scans to one file.  The
+    waveforms are streamed a chunk of scans at a time and the per shot
+    vectors are kept, at 9 bytes a shot, until the end.
+    '''
+    def __init__(self, filename, format, cbf_name, num_shots):
+        self.out = open(filename, 'wb')
+        self.format = format
+        self.num_shots = num_shots
+        self.vectors = dict([(name, []) for name, dtype in vector_fields + (('scan_num', '<u4'), ('shot_num', '<u2'))])
+        if format == 'mat':
+            write_mat_header(self.out)
+            write_mat_string(self.out, 'filename', cbf_name)
+            self.out.write(mat_array_header('waveforms', np.uint8, (120, num_shots)))
+        else:
+            self.out.write('% Lidar CBF dump for octave/matlab\n')
+            self.out.write('% plot(waveforms(:,1)) draws the first shot\n\n')
+            self.out.write("filename = '%s';\n" % cbf_name.replace("'", "''"))
+            self.out.write('waveforms = [\n')
+
+    def append(self, records, scans, scan_offset):
+        '''Add the shots of some scans
+
+        @param scans: the scan table rows of records
+        @param scan_offset: scan number of the first of scans, from 0
+        '''
+        start = cabf_profile.enabled and cabf_profile.clock()
+        if self.format == 'mat':
+            self.out.write(records['samples'].tostring()) # C order (N,120) is column major 120 by N
+        else:
+            self.out.write(m_matrix_rows(records['samples']))
+        for name, dtype in vector_fields:
+            self.vectors[name].append(records[name].astype(dtype))
+        num_shots = scans['num_shots']
+        self.vectors['scan_num'].append(np.repeat(np.arange(len(scans), dtype='<u4') + scan_offset + 1, num_shots))
+        first = np.repeat(scans['first_shot'] - scans['first_shot'][0], num_shots)
+        self.vectors['shot_num'].append((np.arange(len(records)) - first + 1).astype('<u2'))
+        if start:
+            cabf_profile.add('dump.' + self.format, start, records.nbytes, len(records), 0)
+
+    def close(self, scan_times):
+        vectors = [(name, np.concatenate(self.vectors[name]) if self.vectors[name] else np.zeros(0, dtype))
+                   for name, dtype in vector_fields + (('scan_num', '<u4'), ('shot_num', '<u2'))]
+        vectors.append(('scan_time', np.asarray(scan_times, dtype='<f8')))
+        if self.format == 'mat':
+            self.out.write(mat_data_padding(np.uint8, (120, self.num_shots)))
+            for name, values in vectors:
+                write_mat_array(self.out, name, values)
+        else:
+            self.out.write("];\nwaveforms = uint8(waveforms');\n")
+            for name, values in vectors:
+                self.out.write(m_vector(name, values, matlab_types[values.dtype]))
+        self.out.close()
+
+
+def dump_scans(cbf_file, scans, scan_offset, filename, format='mat', chunk_shots=1<<15):
+    '''Write the shots of a run of contiguous scans to one file
+
+    @param scans: rows of the scan table of cbf_file
+    @param scan_offset: scan number of the first row of scans
+    '''
+    dump = _Dump(filename, format, os.path.basename(cbf_file.filename), int(scans['num_shots'].sum()))
+    done = 0
+    for chunk in cbf.scan_chunks(scans, chunk_shots):
+        dump.append(cbf.gather_waveforms(cbf_file.data, cbf_file.size, chunk), chunk, scan_offset + done)
+        done += len(chunk)
+    dump.close(cbf.scan_epochs(scans))
+    return filename
+
+
+def dump_cbf(filename, prefix=None, format='mat', per_scan=False, chunk_shots=1<<15):
+    '''Dump a whole CBF to prefix.mat, or prefix_001.mat and on with
+    per_scan.  The prefix defaults to the CBF name without its extension.
+
+    @return: list of the files written
+    '''
+    if format not in formats:
+        raise ValueError('unknown format %s.  Use one of %s' % (format, ', '.join(formats)))
+    cbf_file = cbf.Cbf(filename)
+    if prefix is None:
+        prefix = os.path.splitext(filename)[0]
+    scans = cbf_file.as_array()
+    if not per_scan:
+        return [dump_scans(cbf_file, scans, 0, '%s.%s' % (prefix, format), format, chunk_shots)]
+    return [dump_scans(cbf_file, scans[i:i+1], i, '%s_%03d.%s' % (prefix, i + 1, format), format, chunk_shots)
+            for i in range(len(scans))]
+
+
+def write_shot_m_files(filename, max_scans=5):
+    '''The old dump: one .m file with plotting code for each waveform
+    of the first max_scans scans
+    '''
+    cbf_file = cbf.Cbf(filename)
+    for i,scan in enumerate(cbf_file):
+        if i >= max_scans:
+            break
+        for j,waveform in enumerate(scan.waveforms):
+            print '    scan %d shot %d: %s' % (i+1,j+1,str(waveform))
+            outfilename = '%s_%03d_%03d.m' % (filename[:-4],i+1,j+1)  # changed - to _
+            o = file(outfilename,'w')
+            o.write('%#!/usr/bin/env octave  needed to run in Octave environment (not matlab)\n\n')
+            o.write('%% filename: %s\n' % outfilename)
+            o.write('% Lidar CBF dump for octave/matlab\n\n')
+            o.write('clear all;\n')  #clears out the matlab variables
+            o.write('close all;\n') #closes out any open matlab figures
+            o.write('clc;\n\n') #clears out the command window
+            o.write('set(0,\'defaulttextinterpreter\',\'none\');\n') # turn off matlab Latex interpreter
+            o.write('scaninfo = \'%s\';\n' % str(scan))
+            o.write('waveforminfo = \'%s\';\n' % str(waveform))
+            o.write('filename = \'%s_%03d_%03d\';\n' % (filename[:-4],i+1,j+1)) # assign filename as variable for graph title
+            # o.write('when = %s\n' % scan.datetime.strftime('%Y\t%m\t%d\t%H\t%M\t%S\t'))
+            # o.write(' = %s\n' % scan.)
+            o.write('frame = %s;\n' % waveform.frame)
+            o.write('row = %s;\n' % waveform.row)
+            o.write('col = %s;\n' % waveform.col)
+            o.write('scan_num = %s;\n' %(i+1)) 
+            o.write('shot_num = %s;\n' %(j+1))
+            o.write('selected_depth_index = %s;\n' % waveform.selected_depth_index)
+            o.write('contend_depth_index = %s;\n' % waveform.contend_depth_index)
+            o.write('waveform = [')
+            for sample in waveform.waveform[:-1]:
+                o.write('%d; ' % sample)
+            o.write('%d ];\n' % waveform.waveform[-1])
+            o.write('\n% Plot the waveform\n')
+            o.write('plot(waveform);\n')
+            o.write('hold on\n') # turn on plot overlay function
+            o.write('x_selec = selected_depth_index;\n')
+            o.write('x_contend = contend_depth_index;\n')
+            o.write('y = 255;\n') # set y-limits for depth index lines
+            o.write('stem(x_selec,y,\'g\',\'marker\',\'none\');\n') # add line for selected depth
+            o.write('stem(x_contend,y,\'r\',\'marker\',\'none\');\n') # add line for contender depth
+            o.write('title({[(filename)];[\'Scan: \',num2str(scan_num),\'  Shot: \',num2str(shot_num)]});\n')
+            o.close()
+
 
 def main():
     from optparse import OptionParser
     parser = OptionParser(usage="%prog [options] file1.CBF file2.CBF ...",
                           version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-f', '--format', dest='format', default='mat', choices=formats,
+                      help='one of %s [default: %%default]' % ', '.join(formats))
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='output name without the extension for a single CBF [default: the CBF name]')
+    parser.add_option('--per-scan', dest='per_scan', default=False, action='store_true',
+                      help='write one file per scan')
+    parser.add_option('--per-shot', dest='per_shot', default=False, action='store_true',
+                      help='old style: an .m file with plot code for each waveform of the first scans')
+    parser.add_option('--max-scans', dest='max_scans', default=5, type='int',
+                      help='scans to dump with --per-shot [default: %default]')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
     parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
                       help='run the tests run in verbose mode')
 
     (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
     v = opts.verbose
-    opts.info = True
+    if opts.output is not None and len(args) != 1:
+        parser.error('--output only works with one CBF')
 
     for filename in args:
-        cbf_file = cbf.Cbf(filename)
-        print cbf
-        numscans = 0
-        numshots = 0
-        #try:
-            #loc,mission,survey,line,remainder = line.split('_')
-        for i,scan in enumerate(cbf_file):
-            if i>4: sys.exit('EARLY!') #limits program to first two scans worth of data to save space
-            numscans += 1
-            numshots += len(scan.waveforms)
-            for j,waveform in enumerate(scan.waveforms):
-                print '    scan %d shot %d: %s' % (i+1,j+1,str(waveform))
-                outfilename = '%s_%03d_%03d.m' % (filename[:-4],i+1,j+1)  # changed - to _
-                o = file(outfilename,'w')
-		o.write('%#!/usr/bin/env octave  needed to run in Octave environment (not matlab)\n\n')
-		o.write('%% filename: %s\n' % outfilename)
-                o.write('% Lidar CBF dump for octave/matlab\n\n')
-		o.write('clear all;\n')  #clears out the matlab variables
-		o.write('close all;\n') #closes out any open matlab figures
-		o.write('clc;\n\n') #clears out the command window
-		o.write('set(0,\'defaulttextinterpreter\',\'none\');\n') # turn off matlab Latex interpreter
-                o.write('scaninfo = \'%s\';\n' % str(scan))
-                o.write('waveforminfo = \'%s\';\n' % str(waveform))
-		o.write('filename = \'%s_%03d_%03d\';\n' % (filename[:-4],i+1,j+1)) # assign filename as variable for graph title
-                # o.write('when = %s\n' % scan.datetime.strftime('%Y\t%m\t%d\t%H\t%M\t%S\t'))
-                # o.write(' = %s\n' % scan.)
-                o.write('frame = %s;\n' % waveform.frame)
-                o.write('row = %s;\n' % waveform.row)
-                o.write('col = %s;\n' % waveform.col)
-		o.write('scan_num = %s;\n' %(i+1)) 
-		o.write('shot_num = %s;\n' %(j+1))
-                o.write('selected_depth_index = %s;\n' % waveform.selected_depth_index)
-                o.write('contend_depth_index = %s;\n' % waveform.contend_depth_index)
-                o.write('waveform = [')
-                for sample in waveform.waveform[:-1]:
-                    o.write('%d; ' % sample)
-                o.write('%d ];\n' % waveform.waveform[-1])
-                o.write('\n% Plot the waveform\n')
-		o.write('plot(waveform);\n')
-		o.write('hold on\n') # turn on plot overlay function
-		o.write('x_selec = selected_depth_index;\n')
-		o.write('x_contend = contend_depth_index;\n')
-		o.write('y = 255;\n') # set y-limits for depth index lines
-		o.write('stem(x_selec,y,\'g\',\'marker\',\'none\');\n') # add line for selected depth
-		o.write('stem(x_contend,y,\'r\',\'marker\',\'none\');\n') # add line for contender depth
-		o.write('title({[(filename)];[\'Scan: \',num2str(scan_num),\'  Shot: \',num2str(shot_num)]});\n')
+        if opts.per_shot:
+            write_shot_m_files(filename, opts.max_scans)
+            continue
+        written = dump_cbf(filename, opts.output, opts.format, opts.per_scan)
+        if v:
+            for name in written:
+                print name
+        print '%s: %d file(s)' % (filename, len(written))
+
 
 if __name__ == '__main__':
     main()
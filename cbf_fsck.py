@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Check the structure of LADS lidar Caris Binary Format (CBF) files.
+
+The W1 blocks are walked with cbf.scan_offsets, which checks the WF
+tags of each scan a chunk at a time, and the W1 and WF fields are then
+checked as numpy columns, so a file is checked at about the speed it
+can be read.  Problems are counted by kind:
+
+ - header: too short for the 50 byte header or no HCB
+ - spec_version: a specification version other than 1.0
+ - misaligned: something other than a W1 or WF where a record should start
+ - truncated: a W1 or WF cut off by the end of the file
+ - empty_scan: a W1 with no WF records after it
+ - bad_time: a W1 with a julian day, hour, minute or second out of range
+ - time_backwards: a W1 with an earlier time than the scan before it
+ - row_range and col_range: a WF with a row or col over the limit
+ - depth_index: a WF selected or contender index past the 120 samples
+
+Without recovery, the check stops at the first misaligned or truncated
+record.  With recovery, it skips ahead to the next W1 that
+cbf.find_scan_start believes in and reports each byte range it
+skipped.  The scans that were found can be written to a new CBF.
+
+@requires: U{Python<http://python.org/>} >= 2.5
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import sys
+import mmap
+import struct
+
+import numpy as np
+
+import cabf_profile
+import cbf
+from cabf_time import scan_epochs
+
+kinds = ('header', 'spec_version', 'misaligned', 'truncated', 'empty_scan', 'bad_time',
+         'time_backwards', 'row_range', 'col_range', 'depth_index')
+'Every kind of problem, in the order they are reported'
+
+max_row = 63
+'Largest WF row that is not reported as out of range'
+
+max_col = 63
+'Largest WF col that is not reported as out of range'
+
+min_year = 1990
+'Scans from before this year have a bad time'
+
+num_samples = 120
+'Samples in each WF.  The selected and contender indices must be below this'
+
+
+def scan_ends(scans):
+    '@return: byte offset just past the last WF of each scan'
+    return scans['offset'] + cbf.scan_header_block_size + scans['num_shots'] * cbf.wave_form_block_size
+
+
+def contiguous(scans):
+    '''Split a scan table where a scan does not start right where the one
+    before it ended.
+
+    @return: list of (i, j) so that scans[i:j] are back to back in the file
+    '''
+    breaks = list(np.flatnonzero(scans['offset'][1:] != scan_ends(scans)[:-1]) + 1)
+    bounds = [0] + breaks + [len(scans)]
+    return [(i, j) for i, j in zip(bounds[:-1], bounds[1:]) if j > i]
+
+
+class FsckReport:
+    '''What was found in one CBF.  Every problem is counted by kind and
+    the first max_examples of each kind are kept with their byte offsets.
+    '''
+    def __init__(self, filename, size, max_examples=10):
+        self.filename = filename
+        self.size = size
+        self.max_examples = max_examples
+        self.counts = {}
+        self.examples = {}
+        self.skipped = []
+        'Byte ranges (start, end) that recovery jumped over'
+        self.unchecked = None
+        'Byte range (start, end) that was not checked because recovery was off'
+        self.scans = np.zeros(0, dtype=cbf.scan_dtype)
+        'Scan table of every scan found'
+
+    def add(self, kind, offset, message, count=1):
+        self.counts[kind] = self.counts.get(kind, 0) + count
+        examples = self.examples.setdefault(kind, [])
+        if len(examples) < self.max_examples:
+            examples.append((offset, message))
+
+    @property
+    def ok(self):
+        return not self.counts
+
+    @property
+    def num_shots(self):
+        return int(self.scans['num_shots'].sum())
+
+    def ranges(self):
+        '''@return: list of (start, end) byte ranges of back to back scans'''
+        ends = scan_ends(self.scans)
+        return [(int(self.scans['offset'][i]), int(ends[j-1])) for i, j in contiguous(self.scans)]
+
+    def __str__(self):
+        lines = ['%s: %d bytes, %d scans, %d shots: %s'
+                 % (self.filename, self.size, len(self.scans), self.num_shots, 'ok' if self.ok else 'PROBLEMS')]
+        for kind in kinds:
+            if kind not in self.counts:
+                continue
+            lines.append('  %-15s %d' % (kind, self.counts[kind]))
+            for offset, message in self.examples[kind]:
+                lines.append('    %12d  %s' % (offset, message))
+            if self.counts[kind] > len(self.examples[kind]):
+                lines.append('    ...')
+        for start, end in self.skipped:
+            lines.append('  skipped bytes %d to %d (%d bytes)' % (start, end, end - start))
+        if self.unchecked:
+            start, end = self.unchecked
+            lines.append('  not checked: bytes %d to %d (%d bytes).  Try recovery' % (start, end, end - start))
+        return '\n'.join(lines)
+
+
+def check_header(data, size, report):
+    '''@return: True if the header is good enough to go on to the scans'''
+    if size < cbf.header_size:
+        report.add('header', 0, 'file is %d bytes, less than the %d byte header' % (size, cbf.header_size))
+        return False
+    if data[0:3] != 'HCB':
+        report.add('header', 0, 'starts with %r, not HCB' % data[0:3])
+        return False
+    spec_major, spec_minor = struct.unpack('<BB', data[3:5])
+    if spec_major != 1 or spec_minor != 0:
+        report.add('spec_version', 3, 'specification %d.%d, not 1.0' % (spec_major, spec_minor))
+    return True
+
+
+def _bad_record(data, size, offset):
+    '''@return: (kind, message) for the thing at offset that stopped a scan walk'''
+    tag = data[offset:offset+2]
+    remaining = size - offset
+    if tag in ('W1', 'W') and remaining < cbf.scan_header_block_size:
+        return 'truncated', 'W1 cut off after %d of %d bytes' % (remaining, cbf.scan_header_block_size)
+    if tag in ('WF', 'W') and remaining < cbf.wave_form_block_size:
+        return 'truncated', 'WF cut off after %d of %d bytes' % (remaining, cbf.wave_form_block_size)
+    return 'misaligned', 'found %r where a W1 or WF should start' % tag
+
+
+def check_structure(data, size, report, recover=False):
+    '''Walk the W1 and WF records after the header and fill in
+    report.scans.  Stops at the first record that is not a W1 or WF
+    unless recover is set.
+    '''
+    offsets = []
+    num_shots = []
+    o = cbf.header_size
+    while o < size:
+        scan_offsets, scan_shots = cbf.scan_offsets(data, size, o)
+        if len(scan_offsets):
+            offsets.append(scan_offsets)
+            num_shots.append(scan_shots)
+            o = int(scan_offsets[-1] + cbf.scan_header_block_size + scan_shots[-1] * cbf.wave_form_block_size)
+        if o >= size:
+            break
+        kind, message = _bad_record(data, size, o)
+        report.add(kind, o, message)
+        if not recover:
+            report.unchecked = (o, size)
+            break
+        next_scan = cbf.find_scan_start(data, size, o + 1)
+        if next_scan is None:
+            next_scan = size
+        report.skipped.append((o, next_scan))
+        o = next_scan
+    if offsets:
+        report.scans = cbf.scan_table(data, size, np.concatenate(offsets), np.concatenate(num_shots))
+
+
+def valid_times(scans):
+    '@return: mask of the scans in a scan table with a time that could be real'
+    return ((scans['year'] >= min_year) & (scans['julian_day'] >= 1) & (scans['julian_day'] <= 366)
+            & (scans['hour'] < 24) & (scans['minute'] < 60) & (scans['second'] < 61))
+
+
+def check_scans(scans, report):
+    'Check the W1 fields of a scan table'
+    for i in np.flatnonzero(scans['num_shots'] == 0):
+        report.add('empty_scan', int(scans['offset'][i]), 'W1 with no WF records')
+
+    good = valid_times(scans)
+    for i in np.flatnonzero(~good):
+        scan = scans[i]
+        report.add('bad_time', int(scan['offset']), 'year %d day %d %02d:%02d:%02d'
+                   % (scan['year'], scan['julian_day'], scan['hour'], scan['minute'], scan['second']))
+
+    timed = scans[good]
+    epochs = scan_epochs(timed)
+    for i in np.flatnonzero(np.diff(epochs) < 0):
+        report.add('time_backwards', int(timed['offset'][i+1]), '%d seconds before the scan at %d'
+                   % (epochs[i] - epochs[i+1], timed['offset'][i]))
+
+
+def check_waveforms(data, size, scans, report, max_row=max_row, max_col=max_col, chunk_shots=1<<16):
+    '''Check the WF fields of every shot in the scan table, chunk_shots
+    at a time.
+    '''
+    start = cabf_profile.enabled and cabf_profile.clock()
+    total = 0
+    chunks = [chunk for i, j in contiguous(scans) for chunk in cbf.scan_chunks(scans[i:j], chunk_shots)]
+    for chunk in chunks:
+        records = cbf.gather_waveforms(data, size, chunk)
+        total += len(records)
+        first_shot = chunk['first_shot'][0]
+        tests = (('row_range', records['row'] > max_row, 'row', max_row),
+                 ('col_range', records['col'] > max_col, 'col', max_col),
+                 ('depth_index', records['selected_depth_index'] >= num_samples, 'selected_depth_index', num_samples - 1),
+                 ('depth_index', records['contend_depth_index'] >= num_samples, 'contend_depth_index', num_samples - 1))
+        for kind, bad, field, limit in tests:
+            shots = np.flatnonzero(bad)
+            if not len(shots):
+                continue
+            examples = shots[:report.max_examples]
+            scan_nums = np.searchsorted(chunk['first_shot'], examples + first_shot, side='right') - 1
+            offsets = (chunk['offset'][scan_nums] + cbf.scan_header_block_size
+                       + (examples + first_shot - chunk['first_shot'][scan_nums]) * cbf.wave_form_block_size)
+            report.add(kind, int(offsets[0]), '%s %d is over %d' % (field, records[field][examples[0]], limit),
+                       len(shots))
+            for offset, shot in zip(offsets[1:], examples[1:]):
+                report.add(kind, int(offset), '%s %d is over %d' % (field, records[field][shot], limit), 0)
+    if start:
+        cabf_profile.add('cbf.fsck', start, total * cbf.wave_form_block_size, total, 0)
+
+
+def fsck(filename, recover=False, max_row=max_row, max_col=max_col, max_examples=10):
+    '''Check one CBF.  See the module docstring for what is checked.
+
+    @param recover: skip past bad records to the next W1 instead of stopping
+    @return: FsckReport
+    '''
+    size = os.path.getsize(filename)
+    report = FsckReport(filename, size, max_examples)
+    if size == 0:
+        check_header('', 0, report)
+        return report
+    infile = open(filename, 'rb')
+    data = mmap.mmap(infile.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        if check_header(data, size, report):
+            check_structure(data, size, report, recover)
+            check_scans(report.scans, report)
+            check_waveforms(data, size, report.scans, report, max_row, max_col)
+    finally:
+        data.close()
+        infile.close()
+    return report
+
+
+def write_recovered(report, filename):
+    '''Write the header and every scan found in the checked CBF to
+    filename, leaving out the skipped bytes.
+    '''
+    infile = open(report.filename, 'rb')
+    out = open(filename, 'wb')
+    out.write(infile.read(cbf.header_size))
+    for start, end in report.ranges():
+        infile.seek(start)
+        while start < end:
+            block = infile.read(min(end - start, 1<<24))
+            out.write(block)
+            start += len(block)
+    out.close()
+    infile.close()
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CBF [file2.CBF ...]",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-r', '--recover', dest='recover', default=False, action='store_true',
+                      help='skip past bad records to the next good W1 and report the bytes skipped')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='with one file, write the header and the scans found to this CBF')
+    parser.add_option('--max-row', dest='max_row', default=max_row, type='int',
+                      help='largest WF row that is good [default: %default]')
+    parser.add_option('--max-col', dest='max_col', default=max_col, type='int',
+                      help='largest WF col that is good [default: %default]')
+    parser.add_option('-e', '--examples', dest='examples', default=10, type='int',
+                      help='number of problems of each kind to list [default: %default]')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if not args:
+        parser.error('give at least one CBF')
+    if opts.output and len(args) != 1:
+        parser.error('--output needs exactly one CBF')
+
+    bad = 0
+    for filename in args:
+        report = fsck(filename, opts.recover, opts.max_row, opts.max_col, opts.examples)
+        if opts.verbose or not report.ok:
+            print report
+        if not report.ok:
+            bad += 1
+        if opts.output:
+            write_recovered(report, opts.output)
+    if bad:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Find the surface and bottom returns in the 120 sample waveforms of a
+LADS lidar Caris Binary Format (CBF) file.
+
+Every shot is worked on at once as rows of an (N,120) matrix, so there
+is no Python loop per waveform.  For each shot the noise is estimated
+from the quartiles of its samples.  A local maximum that is min_snr
+noise levels above the median counts as a return.  The first return is
+the surface.  The strongest return at least min_separation samples
+after it is the bottom.  The picks can then be checked against the
+selected and contender depth indices recorded in the file.
+
+@requires: U{Python<http://python.org/>} >= 2.6 for multiprocessing
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import sys
+import mmap
+
+import numpy as np
+
+import cbf
+import cabf_profile
+
+peak_dtype = np.dtype([('surface_index', '<i2'),
+                       ('surface_amplitude', 'u1'),
+                       ('surface_width', 'u1'),
+                       ('bottom_index', '<i2'),
+                       ('bottom_amplitude', 'u1'),
+                       ('bottom_width', 'u1'),
+                       ('baseline', '<f4'),
+                       ('noise', '<f4'),
+                       ('snr', '<f4')])
+'''Picks for one waveform.  An index is -1 when no return was found.
+Widths are the full width at half height in samples and snr is for
+the bottom return'''
+
+shot_peak_dtype = np.dtype([('frame', '<u2'),
+                            ('row', 'u1'),
+                            ('col', 'u1'),
+                            ('selected_depth_index', 'u1'),
+                            ('contend_depth_index', 'u1')] + peak_dtype.descr)
+'peak_dtype plus the shot and the depth indices recorded with it in the CBF'
+
+
+def _widths(samples, peak, baseline, found):
+    'Full width at half height around the peak index of each row'
+    index = np.arange(samples.shape[1])
+    rows = np.arange(len(samples))
+    level = baseline + (samples[rows, np.maximum(peak, 0)] - baseline) / 2.
+    below = samples < level[:, None]
+    left = np.where(below & (index < peak[:, None]), index, -1).max(axis=1)
+    right = np.where(below & (index > peak[:, None]), index, samples.shape[1]).min(axis=1)
+    return np.where(found, np.minimum(right - left - 1, 255), 0)
+
+
+def find_peaks(samples, min_snr=4.0, min_separation=4):
+    '''Surface and bottom picks for a matrix of waveforms.
+
+    @param samples: (N,120) array of waveform samples
+    @param min_snr: how many noise levels above the median a local
+        maximum has to be to count as a return
+    @param min_separation: samples between the surface and the earliest
+        allowed bottom
+    @return: array of peak_dtype with one row per waveform
+    '''
+    s = np.asarray(samples).astype(np.int16)
+    n, width = s.shape
+    rows = np.arange(n)
+    index = np.arange(width)
+
+    quartiles = np.partition(s, (width // 4, width // 2, 3 * width // 4), axis=1)
+    baseline = quartiles[:, width // 2].astype(np.float32)
+    noise = np.maximum((quartiles[:, 3 * width // 4] - quartiles[:, width // 4]) / 1.349, 1.).astype(np.float32)
+    threshold = baseline + min_snr * noise
+
+    middle = s[:, 1:-1]
+    is_peak = np.zeros(s.shape, dtype=bool)
+    is_peak[:, 1:-1] = (middle >= s[:, :-2]) & (middle > s[:, 2:]) & (middle > threshold[:, None])
+
+    has_surface = is_peak.any(axis=1)
+    surface = np.where(has_surface, is_peak.argmax(axis=1), -1)
+
+    after = is_peak & (index >= (surface + min_separation)[:, None]) & has_surface[:, None]
+    candidates = np.where(after, s, -1)
+    bottom = candidates.argmax(axis=1)
+    has_bottom = candidates[rows, bottom] >= 0
+    bottom = np.where(has_bottom, bottom, -1)
+
+    peaks = np.zeros(n, dtype=peak_dtype)
+    peaks['surface_index'] = surface
+    peaks['surface_amplitude'] = np.where(has_surface, s[rows, np.maximum(surface, 0)], 0)
+    peaks['surface_width'] = _widths(s, surface, baseline, has_surface)
+    peaks['bottom_index'] = bottom
+    bottom_amplitude = np.where(has_bottom, s[rows, np.maximum(bottom, 0)], 0)
+    peaks['bottom_amplitude'] = bottom_amplitude
+    peaks['bottom_width'] = _widths(s, bottom, baseline, has_bottom)
+    peaks['baseline'] = baseline
+    peaks['noise'] = noise
+    peaks['snr'] = np.where(has_bottom, (bottom_amplitude - baseline) / noise, 0)
+    return peaks
+
+
+def record_peaks(records, **options):
+    '''find_peaks on an array of waveform_record_dtype
+
+    @return: array of shot_peak_dtype
+    '''
+    picks = find_peaks(records['samples'], **options)
+    out = np.empty(len(records), dtype=shot_peak_dtype)
+    for name in ('frame', 'row', 'col', 'selected_depth_index', 'contend_depth_index'):
+        out[name] = records[name]
+    for name in peak_dtype.names:
+        out[name] = picks[name]
+    return out
+
+
+def compare_picks(picks, tolerance=2):
+    '''Check the bottom picks against the recorded depth indices.  A
+    recorded selected index of 0 means the system found no bottom.
+
+    @param picks: array of shot_peak_dtype
+    @param tolerance: samples a pick can be off and still agree
+    @return: dict of counts and the offset of the picks from the selected index
+    '''
+    picked = picks['bottom_index'] >= 0
+    recorded = picks['selected_depth_index'] > 0
+    both = picked & recorded
+    bottom = picks['bottom_index'].astype(np.int32)
+    offset = (bottom - picks['selected_depth_index'])[both]
+    near_selected = both & (np.abs(bottom - picks['selected_depth_index']) <= tolerance)
+    near_contender = both & ~near_selected & (np.abs(bottom - picks['contend_depth_index']) <= tolerance)
+    report = {
+        'shots': len(picks),
+        'surfaces': int((picks['surface_index'] >= 0).sum()),
+        'picked': int(picked.sum()),
+        'recorded': int(recorded.sum()),
+        'agree_selected': int(near_selected.sum()),
+        'agree_contender': int(near_contender.sum()),
+        'disagree': int((both & ~near_selected & ~near_contender).sum()),
+        'missed': int((recorded & ~picked).sum()),
+        'extra': int((picked & ~recorded).sum()),
+        'mean_offset': float(offset.mean()) if len(offset) else 0.,
+        'rms_offset': float(np.sqrt((offset.astype(np.float64) ** 2).mean())) if len(offset) else 0.,
+        }
+    return report
+
+
+def _fill_peaks(data, size, scans, out, chunk_shots, options):
+    'Pick the shots of scans a chunk at a time into out, which starts at the first shot of scans'
+    if len(scans) == 0:
+        return
+    first = scans['first_shot'][0]
+    for chunk in cbf.scan_chunks(scans, chunk_shots):
+        records = cbf.gather_waveforms(data, size, chunk)
+        start_time = cabf_profile.enabled and cabf_profile.clock()
+        start = chunk['first_shot'][0] - first
+        out[start:start + len(records)] = record_peaks(records, **options)
+        if start_time:
+            cabf_profile.add('peaks.find', start_time, records.nbytes, len(records), 0)
+
+
+def _peaks_shard(shots):
+    first, last = shots
+    shared = cbf._shared
+    scans = shared['scans']
+    i = np.searchsorted(scans['first_shot'], first)
+    j = np.searchsorted(scans['first_shot'], last)
+    _fill_peaks(shared['data'], shared['size'], scans[i:j], shared['out'][first:last],
+                shared['chunk_shots'], shared['options'])
+
+
+def cbf_peaks(cbf_file, jobs=1, chunk_shots=1<<16, **options):
+    '''Surface and bottom picks for every shot in a cbf.  The waveforms
+    are gathered and worked on chunk_shots at a time so the whole
+    waveform matrix is never in memory at once.
+
+    @param cbf_file: filename or cbf.Cbf
+    @param jobs: split the shots across this many processes.  They write
+        into shared anonymous memory like cbf.parallel_gather_waveforms
+    @param options: passed to find_peaks
+    @return: array of shot_peak_dtype with one row per shot in file order
+    '''
+    if not isinstance(cbf_file, cbf.Cbf):
+        cbf_file = cbf.Cbf(cbf_file)
+    scans = cbf_file.as_array(jobs)
+    total = int(scans['num_shots'].sum())
+    if total == 0 or jobs < 2:
+        out = np.empty(total, dtype=shot_peak_dtype)
+        _fill_peaks(cbf_file.data, cbf_file.size, scans, out, chunk_shots, options)
+        return out
+    buf = mmap.mmap(-1, total * shot_peak_dtype.itemsize)
+    out = np.frombuffer(buf, dtype=shot_peak_dtype, count=total)
+    cuts = np.searchsorted(scans['first_shot'], np.linspace(0, total, jobs + 1)[1:-1])
+    cuts = np.unique(np.concatenate(([0], cuts, [len(scans)])))
+    first_shots = np.append(scans['first_shot'], total)[cuts]
+    shards = [(int(first), int(last)) for first, last in zip(first_shots[:-1], first_shots[1:]) if last > first]
+    cbf._run_shards(_peaks_shard, shards, jobs, data=cbf_file.data, size=cbf_file.size, scans=scans,
+                    out=out, chunk_shots=chunk_shots, options=options)
+    return out
+
+
+def format_report(filename, report):
+    return ('%s: shots(%d) surfaces(%d) bottoms(%d) recorded(%d) agree: selected(%d) contender(%d) '
+            'disagree(%d) missed(%d) extra(%d) offset: mean(%.2f) rms(%.2f)') % (
+        filename, report['shots'], report['surfaces'], report['picked'], report['recorded'],
+        report['agree_selected'], report['agree_contender'], report['disagree'],
+        report['missed'], report['extra'], report['mean_offset'], report['rms_offset'])
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CBF file2.CBF ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-j', '--jobs', dest='jobs', default=1, type='int',
+                      help='number of worker processes [default: %default]')
+    parser.add_option('--min-snr', dest='min_snr', default=4.0, type='float',
+                      help='noise levels above the median for a return [default: %default]')
+    parser.add_option('--min-separation', dest='min_separation', default=4, type='int',
+                      help='samples from the surface to the earliest bottom [default: %default]')
+    parser.add_option('-t', '--tolerance', dest='tolerance', default=2, type='int',
+                      help='samples a pick can be from a recorded index and agree [default: %default]')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='save the picks of each file to OUTPUT_<file>.npy')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if opts.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    for filename in args:
+        picks = cbf_peaks(filename, jobs=opts.jobs, min_snr=opts.min_snr,
+                          min_separation=opts.min_separation)
+        print format_report(filename, compare_picks(picks, opts.tolerance))
+        if opts.output:
+            np.save('%s_%s.npy' % (opts.output, os.path.splitext(os.path.basename(filename))[0]), picks)
+        if opts.verbose:
+            for pick in picks[:10]:
+                print '   ', pick
+    if not args:
+        sys.exit('No files given')
+
+
+if __name__ == '__main__':
+    main()
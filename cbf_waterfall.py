@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+__author__    = 'Kurt Schwehr'
+__version__   = '$Revision: 10786 $'.split()[1]
+__revision__  = __version__ # For pylint
+__date__ = '$Date: 2008-11-18 12:03:11 -0500 (Tue, 18 Nov 2008) $'.split()[1]
+__copyright__ = '2008'
+__license__   = 'BSD'
+__contact__   = 'kurt at ccom.unh.edu'
+
+__doc__ ='''
+Stacked waveform (waterfall or echogram) images of LADS lidar Caris
+Binary Format (CBF) files.
+
+Each shot is one column of the image and each of its 120 samples is
+one row, with the first sample at the top.  The image is made
+straight from the (N,120) waveform matrix with numpy and written as
+a PNG with zlib, so matplotlib is not needed.  A whole run goes into
+one image, or into tiles of tile_shots shots for long runs.  The tiles
+only break between scans.
+
+The selected and contender depth indices can be drawn over the
+samples in green and red, the same colors cbf_dump uses for its
+Octave plots.
+
+@requires: U{Python<http://python.org/>} >= 2.5
+@requires: U{numpy<http://numpy.scipy.org/>}
+
+@undocumented: __doc__
+@since: 2008-Nov-18
+@status: under development
+@organization: U{CCOM<http://ccom.unh.edu/>}
+'''
+
+import os
+import zlib
+import struct
+
+import numpy as np
+
+import cbf
+import cabf_profile
+
+
+def _heat_lut():
+    'black to red to yellow to white'
+    x = np.arange(256) / 255.
+    lut = np.empty((256, 3))
+    lut[:, 0] = np.clip(3 * x, 0, 1)
+    lut[:, 1] = np.clip(3 * x - 1, 0, 1)
+    lut[:, 2] = np.clip(3 * x - 2, 0, 1)
+    return (lut * 255).round().astype(np.uint8)
+
+
+colormaps = {
+    'gray': np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1),
+    'heat': _heat_lut(),
+    }
+'Name to a (256,3) uint8 lookup table of sample value to RGB'
+
+selected_color = (0, 255, 0)
+contender_color = (255, 0, 0)
+
+
+def write_png(filename, image, level=1):
+    '''Write an 8 bit gray (H,W) or RGB (H,W,3) image as a PNG
+
+    @param level: zlib compression level.  The noise in the waveforms
+        does not compress well, so higher levels are much slower for
+        only a little smaller files
+    '''
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    color_type = 2 if image.ndim == 3 else 0
+    rows = image.reshape(height, -1)
+    raw = np.zeros((height, rows.shape[1] + 1), dtype=np.uint8) # Filter type 0 on every row
+    raw[:, 1:] = rows
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    out = open(filename, 'wb')
+    out.write('\x89PNG\r\n\x1a\n')
+    out.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+    out.write(chunk('IDAT', zlib.compress(raw.tostring(), level)))
+    out.write(chunk('IEND', ''))
+    out.close()
+
+
+def waterfall(records, colormap='gray', scale=1, decimate=1, picks=False):
+    '''Make the image for a block of shots.
+
+    @param records: array of cbf.waveform_record_dtype
+    @param colormap: name in colormaps
+    @param scale: rows of the image for each sample
+    @param decimate: shots per column.  The largest sample of the shots
+        in a column is drawn so thin returns do not vanish
+    @param picks: draw the recorded selected and contender depth indices
+    @return: (120*scale, ceil(shots/decimate), 3) uint8 RGB image, or
+        just (120*scale, ceil(shots/decimate)) for gray without picks
+    '''
+    samples = records['samples']
+    selected = records['selected_depth_index']
+    contender = records['contend_depth_index']
+    if decimate > 1 and len(samples):
+        starts = np.arange(0, len(samples), decimate) # The last column may have fewer shots
+        samples = np.maximum.reduceat(samples, starts, axis=0)
+        selected = selected[starts]
+        contender = contender[starts]
+    if colormap == 'gray' and not picks:
+        image = samples.T
+    else:
+        image = colormaps[colormap][samples.T]
+    if picks:
+        columns = np.arange(image.shape[1])
+        for index, color in ((contender, contender_color), (selected, selected_color)):
+            has_pick = (index > 0) & (index < image.shape[0]) # 0 is no bottom.  Skip any past the samples
+            image[index[has_pick], columns[has_pick]] = color
+    if scale > 1:
+        image = np.repeat(image, scale, axis=0)
+    return image
+
+
+def tile_filenames(prefix, num_tiles):
+    'prefix.png for one tile, otherwise prefix_000.png and on'
+    if num_tiles == 1:
+        return [prefix + '.png']
+    return ['%s_%03d.png' % (prefix, i) for i in range(num_tiles)]
+
+
+def render_cbf(cbf_file, prefix=None, tile_shots=8192, **options):
+    '''Write the waterfall of a whole CBF, in tiles of whole scans with
+    about tile_shots shots each.  Only one tile of waveforms is in
+    memory at a time.
+
+    @param cbf_file: filename or cbf.Cbf
+    @param prefix: output name without .png.  Defaults to the CBF name
+        without its extension
+    @param options: passed to waterfall
+    @return: list of the png files written
+    '''
+    if not isinstance(cbf_file, cbf.Cbf):
+        cbf_file = cbf.Cbf(cbf_file)
+    if prefix is None:
+        prefix = os.path.splitext(cbf_file.filename)[0]
+    chunks = list(cbf.scan_chunks(cbf_file.as_array(), tile_shots))
+    filenames = tile_filenames(prefix, len(chunks))
+    for chunk, filename in zip(chunks, filenames):
+        records = cbf.gather_waveforms(cbf_file.data, cbf_file.size, chunk)
+        start = cabf_profile.enabled and cabf_profile.clock()
+        write_png(filename, waterfall(records, **options))
+        if start:
+            cabf_profile.add('waterfall.render', start, records.nbytes, len(records), 0)
+    return filenames
+
+
+def render_scan(cbf_file, scan_num, filename, **options):
+    '''Write the waterfall of one scan.  The records are a view into the
+    mmap so nothing is gathered.
+    '''
+    if not isinstance(cbf_file, cbf.Cbf):
+        cbf_file = cbf.Cbf(cbf_file)
+    write_png(filename, waterfall(cbf_file.waveforms(scan_num), **options))
+    return filename
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] file1.CBF file2.CBF ...",
+                          version="%prog "+__version__+' ('+__date__+')')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='prefix for the png files of a single CBF [default: the CBF name]')
+    parser.add_option('-t', '--tile-shots', dest='tile_shots', default=8192, type='int',
+                      help='shots in each tile image [default: %default]')
+    parser.add_option('-s', '--scan', dest='scan', default=None, type='int',
+                      help='only draw this scan number')
+    parser.add_option('-c', '--colormap', dest='colormap', default='gray', choices=sorted(colormaps.keys()),
+                      help='one of %s [default: %%default]' % ', '.join(sorted(colormaps.keys())))
+    parser.add_option('--scale', dest='scale', default=1, type='int',
+                      help='image rows per sample [default: %default]')
+    parser.add_option('-d', '--decimate', dest='decimate', default=1, type='int',
+                      help='shots per image column, keeping the largest sample [default: %default]')
+    parser.add_option('-p', '--picks', dest='picks', default=False, action='store_true',
+                      help='draw the selected (green) and contender (red) depth indices')
+    parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                      help='print the time, bytes, records and objects of each reader stage')
+    parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                      help='run the tests run in verbose mode')
+
+    (opts, args) = parser.parse_args()
+    if opts.stats:
+        cabf_profile.report_at_exit()
+    if opts.output is not None and len(args) != 1:
+        parser.error('--output only works with one CBF')
+    if opts.tile_shots < 1 or opts.scale < 1 or opts.decimate < 1:
+        parser.error('--tile-shots, --scale and --decimate must be at least 1')
+    options = {'colormap': opts.colormap, 'scale': opts.scale, 'decimate': opts.decimate, 'picks': opts.picks}
+
+    for filename in args:
+        prefix = opts.output or os.path.splitext(filename)[0]
+        if opts.scan is not None:
+            written = [render_scan(filename, opts.scan, '%s_scan%05d.png' % (prefix, opts.scan), **options)]
+        else:
+            written = render_cbf(filename, prefix, opts.tile_shots, **options)
+        if opts.verbose:
+            for name in written:
+                print name
+        else:
+            print '%s: %d image(s)' % (filename, len(written))
+
+
+if __name__ == '__main__':
+    main()